@@ -0,0 +1,271 @@
+"""A library interface for printing to Athena queues.
+
+This resolves queues the same way the wrappers do, but sends jobs
+straight to the print server over IPP, rather than exec'ing cups-lpr,
+and keeps connections open between jobs. For example:
+
+  from debathena.printing import api
+
+  job = api.submit(['thesis.pdf'], 'ajax', {'sides': 'two-sided-long-edge'})
+  print job.name, api.job_state(job)
+
+  pending = [api.submit_async([f], 'ajax') for f in files]
+  jobs = [p.result() for p in pending]
+
+Jobs are submitted as whoever cups.getUser() says the current user
+is, unless a Spooler is given a user to submit them as.
+"""
+
+
+import os
+import sys
+import threading
+
+from debathena.printing import common
+
+
+DEFAULT_WORKERS = 4
+
+# IPP job-state values (RFC 8011, section 5.3.7)
+JOB_STATES = {
+    3: 'pending',
+    4: 'pending-held',
+    5: 'processing',
+    6: 'processing-stopped',
+    7: 'canceled',
+    8: 'aborted',
+    9: 'completed',
+    }
+
+
+class PrintError(Exception):
+    """A job couldn't be submitted, or its state couldn't be found."""
+
+
+class Job(object):
+    """A submitted print job.
+
+    Attributes:
+      queue: The Athena queue the job was sent to
+      server: The print server it was sent to (None for the local
+        cupsd)
+      id: The job ID the print server gave it
+      files: The files that were printed
+    """
+
+    def __init__(self, queue, server, id, files):
+        self.queue = queue
+        self.server = server
+        self.id = id
+        self.files = files
+
+    @property
+    def name(self):
+        """The job's name the way lpr reports it, e.g. ajax-123."""
+        return '%s-%d' % (self.queue, self.id)
+
+    def __repr__(self):
+        return '<Job %s on %s>' % (self.name, self.server or 'localhost')
+
+
+class PendingJob(object):
+    """A job that submit_async() is still submitting."""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._job = None
+        self._exc_info = None
+
+    def _finish(self, job=None, exc_info=None):
+        self._job = job
+        self._exc_info = exc_info
+        self._done.set()
+
+    def done(self):
+        """Return whether the job has been submitted (or failed to be)."""
+        return self._done.isSet()
+
+    def result(self, timeout=None):
+        """Wait for the job to be submitted.
+
+        Args:
+          timeout: How long to wait, in seconds (default forever)
+
+        Returns:
+          The Job
+
+        Raises:
+          PrintError if the job couldn't be submitted, or if it
+          wasn't submitted within timeout
+        """
+        self._done.wait(timeout)
+        if not self._done.isSet():
+            raise PrintError('Timed out waiting for the job to be submitted')
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._job
+
+
+class Spooler(object):
+    """Submits print jobs to Athena queues.
+
+    Connections to print servers come from the pool in common, so
+    they're kept open between jobs. Jobs from submit_async() are
+    submitted by a pool of worker threads.
+
+    Args:
+      workers: The most jobs submit_async() submits at once
+      user: The user to submit jobs as, if not the current user
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, user=None):
+        self.workers = workers
+        self.user = user
+        self._lock = threading.Lock()
+        self._tasks = None
+        self._threads = []
+
+    def resolve(self, queue):
+        """Work out where jobs for a queue should go.
+
+        This is the same as what the wrappers do, including failing
+        over to a live frontend if the queue's print server is down.
+
+        Returns:
+          A tuple of (print_server, queue_name), where print_server is
+          None for the local cupsd
+        """
+        system, server, queue = common.Resolution(queue).find_queue()
+        return server, queue
+
+    def _call(self, server, method, *args, **kwargs):
+        """Make a request of server over a pooled connection."""
+        import cups
+        if self.user:
+            # libcups remembers the user per thread
+            cups.setUser(self.user)
+        try:
+            return common.ipp_request(server, method, *args, **kwargs)
+        except (cups.IPPError, cups.HTTPError, RuntimeError), e:
+            raise PrintError('%s: %s' % (server or 'localhost', e))
+
+    def submit(self, files, queue, options=None, title=None):
+        """Print files to a queue, as a single job.
+
+        Args:
+          files: A list of files to print
+          queue: The name of the queue to print to
+          options: A dict of CUPS job options (as for lpr -o)
+          title: The job's title (default the name of the first file)
+
+        Returns:
+          A Job
+
+        Raises:
+          PrintError if the job couldn't be submitted
+        """
+        if isinstance(files, basestring):
+            files = [files]
+        if not files:
+            raise PrintError('No files to print')
+        options = dict((k, str(v)) for k, v in (options or {}).iteritems())
+        if title is None:
+            title = os.path.basename(files[0])
+
+        server, queue = self.resolve(queue)
+        if len(files) == 1:
+            job_id = self._call(server, 'printFile',
+                                queue, files[0], title, options)
+        else:
+            job_id = self._call(server, 'printFiles',
+                                queue, list(files), title, options)
+        return Job(queue, server, job_id, list(files))
+
+    def _work(self):
+        while True:
+            pending, args = self._tasks.get()
+            try:
+                pending._finish(job=self.submit(*args))
+            except:
+                pending._finish(exc_info=sys.exc_info())
+
+    def submit_async(self, files, queue, options=None, title=None):
+        """Like submit, but without waiting for the job to be submitted.
+
+        Jobs are submitted in the order they're given to submit_async,
+        up to workers at a time.
+
+        Returns:
+          A PendingJob
+        """
+        import Queue
+        self._lock.acquire()
+        try:
+            if self._tasks is None:
+                self._tasks = Queue.Queue()
+            if len(self._threads) < self.workers:
+                t = threading.Thread(target=self._work)
+                t.setDaemon(True)
+                t.start()
+                self._threads.append(t)
+        finally:
+            self._lock.release()
+
+        pending = PendingJob()
+        self._tasks.put((pending, (files, queue, options, title)))
+        return pending
+
+    def job_state(self, job):
+        """Find out what's happened to a job.
+
+        Returns:
+          The job's state, as one of the names in JOB_STATES
+
+        Raises:
+          PrintError if the job's state couldn't be found
+        """
+        attrs = self._call(job.server, 'getJobAttributes', job.id,
+                           requested_attributes=['job-state'])
+        return JOB_STATES.get(attrs.get('job-state'))
+
+
+_spooler = None
+_spooler_lock = threading.Lock()
+
+
+def _get_spooler():
+    """Return the Spooler shared by the module-level functions."""
+    global _spooler
+    _spooler_lock.acquire()
+    try:
+        if _spooler is None:
+            _spooler = Spooler()
+        return _spooler
+    finally:
+        _spooler_lock.release()
+
+
+def submit(files, queue, options=None, title=None):
+    """Print files to a queue, with a shared Spooler (see Spooler.submit)."""
+    return _get_spooler().submit(files, queue, options, title)
+
+
+def submit_async(files, queue, options=None, title=None):
+    """Like submit, but returns a PendingJob (see Spooler.submit_async)."""
+    return _get_spooler().submit_async(files, queue, options, title)
+
+
+def job_state(job):
+    """Find out what's happened to a job (see Spooler.job_state)."""
+    return _get_spooler().job_state(job)
+
+
+__all__ = ['JOB_STATES',
+           'PrintError',
+           'Job',
+           'PendingJob',
+           'Spooler',
+           'submit',
+           'submit_async',
+           'job_state',
+           ]
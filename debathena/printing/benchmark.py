@@ -0,0 +1,438 @@
+#!/usr/bin/python
+"""Startup and latency benchmarks for the Debathena printing wrappers.
+
+Each wrapper's _main is run end to end, up to the point where it
+would exec the real command, against local stand-ins for the
+environment:
+
+  * Hesiod lookups are answered from a table (FakeHesiod)
+  * cups.Connection is replaced with FakeConnection, which sleeps for
+    a configurable time on each request
+  * port probes of the print servers (common.is_cups_server) take as
+    long as an IPP request, and always succeed
+  * os.execvp is captured instead of run
+
+Every wrapper invocation is a fresh process, so between iterations
+the in-process state is thrown away. In the cold-cache scenario the
+on-disk caches are emptied too; in the warm-cache scenario they're
+left as the previous iteration left them.
+
+The results are written out as JSON, e.g.:
+
+  python -m debathena.printing.benchmark -n 500 -o results.json
+
+This module deliberately doesn't import anything from
+debathena.printing at load time, so that the stand-ins can be put in
+place before the modules under test are imported.
+"""
+
+
+import errno
+import json
+import math
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+
+DEFAULT_ITERATIONS = 200
+DEFAULT_LATENCY = 0.002
+IMPORT_SAMPLES = 5
+
+WRAPPERS = ['lpr', 'lpq', 'lprm', 'lp']
+
+# The command line each wrapper is benchmarked with
+SCENARIOS = {
+    'lpr': ['lpr', '-Pajax', '/etc/hostname'],
+    'lpq': ['lpq', '-Pajax'],
+    'lprm': ['lprm', '-Pajax', '123'],
+    'lp': ['lp', '-d', 'ajax', '/etc/hostname'],
+    }
+
+HESIOD_DATA = {
+    ('ajax', 'pcap'): ['ajax:rp=ajax:rm=GET-PRINT.MIT.EDU:ka#0:mc#0:'],
+    ('cups-print', 'sloc'): ['GET-PRINT.MIT.EDU'],
+    ('cups-cluster', 'sloc'): ['CLUSTER-PRINT.MIT.EDU'],
+    }
+
+LOCAL_PRINTERS = {
+    'ajax': {'device-uri': 'ipp://printers.mit.edu:631/printers/ajax'},
+    'home': {'device-uri': 'usb://HP/LaserJet%201020'},
+    }
+
+
+class Dispatched(Exception):
+    """Raised by the captured os.execvp in place of running a command."""
+
+    def __init__(self, file, argv):
+        Exception.__init__(self, file, argv)
+        self.file = file
+        self.argv = argv
+
+
+class FakeHesiod(object):
+    """A stand-in for the hesiod module.
+
+    Args:
+      data: A dict mapping (name, type) pairs to lists of results
+      latency: How long, in seconds, each lookup takes
+    """
+
+    def __init__(self, data=None, latency=0):
+        self.data = data or HESIOD_DATA
+        self.latency = latency
+        self.lookups = 0
+
+    def module(self):
+        fake = self
+
+        class Lookup(object):
+            def __init__(self, name, type):
+                fake.lookups += 1
+                time.sleep(fake.latency)
+                if (name, type) not in fake.data:
+                    raise IOError(errno.ENOENT, os.strerror(errno.ENOENT))
+                self.results = list(fake.data[(name, type)])
+
+        mod = types.ModuleType('hesiod')
+        mod.Lookup = Lookup
+        return mod
+
+
+class FakeCups(object):
+    """A stand-in for the cups module.
+
+    Args:
+      printers: A dict of the local cupsd's printers, as
+        cups.Connection.getPrinters returns them
+      default: The local cupsd's default destination
+      latency: How long, in seconds, each IPP request takes
+    """
+
+    def __init__(self, printers=None, default='ajax', latency=0):
+        self.printers = printers or LOCAL_PRINTERS
+        self.default = default
+        self.latency = latency
+        self.requests = 0
+        self.server = 'localhost'
+
+    def _request(self):
+        self.requests += 1
+        time.sleep(self.latency)
+
+    def is_cups_server(self, rm, timeout=None):
+        """A stand-in for common.is_cups_server."""
+        self._request()
+        return True
+
+    def module(self):
+        fake = self
+
+        class IPPError(Exception):
+            pass
+
+        class HTTPError(Exception):
+            pass
+
+        class FakeConnection(object):
+            def __init__(self, host=None, port=None, encryption=None):
+                fake._request()
+                self.host = host
+
+            def getDefault(self):
+                fake._request()
+                return fake.default
+
+            def getPrinters(self):
+                fake._request()
+                return dict(fake.printers)
+
+            def getClasses(self):
+                fake._request()
+                return {}
+
+            def getJobs(self, *args, **kwargs):
+                fake._request()
+                return {}
+
+        def getServer():
+            return fake.server
+
+        def setServer(server):
+            fake.server = server
+
+        def setUser(user):
+            pass
+
+        mod = types.ModuleType('cups')
+        mod.Connection = FakeConnection
+        mod.IPPError = IPPError
+        mod.HTTPError = HTTPError
+        mod.HTTP_OK = 200
+        mod.HTTP_NOT_MODIFIED = 304
+        mod.getServer = getServer
+        mod.setServer = setServer
+        mod.setUser = setUser
+        return mod
+
+
+class Fakes(object):
+    """Puts the stand-ins in place, and takes them away again.
+
+    The fake modules are installed in sys.modules, so that modules
+    imported afterwards pick them up, and also swapped into any
+    debathena.printing modules that have already been imported.
+    """
+
+    def __init__(self, hesiod=None, cups=None):
+        self.hesiod = hesiod or FakeHesiod()
+        self.cups = cups or FakeCups()
+        self._saved = []
+
+    def _set(self, obj, name, value):
+        if isinstance(obj, dict):
+            self._saved.append((obj, name, obj.get(name)))
+            obj[name] = value
+        else:
+            self._saved.append((obj, name, getattr(obj, name, None)))
+            setattr(obj, name, value)
+
+    def install(self):
+        modules = {'hesiod': self.hesiod.module(),
+                   'cups': self.cups.module()}
+        for name, mod in modules.items():
+            self._set(sys.modules, name, mod)
+            for loaded_name, loaded in sys.modules.items():
+                if (loaded_name.startswith('debathena.printing.') and
+                    getattr(loaded, name, None) is not None):
+                    self._set(loaded, name, mod)
+
+        from debathena.printing import common
+        self._set(common, 'is_cups_server', self.cups.is_cups_server)
+
+        def execvp(file, args):
+            raise Dispatched(file, args)
+        self._set(os, 'execvp', execvp)
+
+    def uninstall(self):
+        while self._saved:
+            obj, name, value = self._saved.pop()
+            if isinstance(obj, dict):
+                if value is None:
+                    obj.pop(name, None)
+                else:
+                    obj[name] = value
+            else:
+                setattr(obj, name, value)
+
+
+def percentile(samples, p):
+    """Return the p'th percentile of samples, by the nearest-rank method."""
+    ordered = sorted(samples)
+    rank = int(math.ceil(p / 100.0 * len(ordered)))
+    return ordered[max(rank, 1) - 1]
+
+
+def summarize(samples):
+    """Summarize a list of timings, in seconds.
+
+    Returns:
+      A dict of statistics, in milliseconds
+    """
+    return {'n': len(samples),
+            'min': 1000 * min(samples),
+            'mean': 1000 * sum(samples) / len(samples),
+            'p50': 1000 * percentile(samples, 50),
+            'p99': 1000 * percentile(samples, 99),
+            'max': 1000 * max(samples),
+            }
+
+
+def time_import(module, samples=IMPORT_SAMPLES):
+    """Time importing a wrapper module in a fresh interpreter.
+
+    Returns:
+      A list of import times, in seconds
+    """
+    code = ('import sys, time\n'
+            'from debathena.printing import benchmark\n'
+            'benchmark.Fakes().install()\n'
+            'start = time.time()\n'
+            '__import__(%r)\n'
+            'sys.stdout.write(repr(time.time() - start))\n' % module)
+    path = os.path.dirname(os.path.dirname(os.path.dirname(
+                os.path.abspath(__file__))))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [path] + filter(None, [env.get('PYTHONPATH')]))
+    times = []
+    for i in range(samples):
+        p = subprocess.Popen([sys.executable, '-c', code], env=env,
+                             stdout=subprocess.PIPE)
+        output = p.communicate()[0]
+        if p.returncode == 0:
+            times.append(float(output))
+    return times
+
+
+def _reset(environ, cache_directory, cold):
+    """Make the next iteration look like a fresh process."""
+    from debathena.printing import common
+    from debathena.printing import lpd
+
+    os.environ.clear()
+    os.environ.update(environ)
+    common._forget_materialized()
+    common._hesiod_memory.clear()
+    lpd._clients.clear()
+    if cold:
+        for name in os.listdir(cache_directory):
+            os.unlink(os.path.join(cache_directory, name))
+
+
+def time_dispatch(wrapper, iterations, cold, cache_directory):
+    """Time running a wrapper up to the point where it execs.
+
+    Returns:
+      A list of times, in seconds
+    """
+    from debathena.printing import lp, lpq, lpr, lprm
+    main = {'lpr': lpr._main, 'lpq': lpq._main,
+            'lprm': lprm._main, 'lp': lp._main}[wrapper]
+
+    environ = dict((k, v) for k, v in os.environ.items()
+                   if k not in ('PRINTER', 'CUPS_SERVER', 'ATHENA_USER',
+                                'DEBATHENA_DEBUG'))
+    environ['DEBATHENA_PRINTING_CACHE'] = cache_directory
+    environ['DEBATHENA_PCAP_SNAPSHOT'] = ''
+    environ['DEBATHENA_RESOLVER_SOCKET'] = ''
+
+    saved = dict(os.environ)
+    times = []
+    try:
+        # Warm the caches up, in case this is the warm-cache run
+        _reset(environ, cache_directory, True)
+        try:
+            main(list(SCENARIOS[wrapper]))
+        except Dispatched:
+            pass
+
+        for i in range(iterations):
+            _reset(environ, cache_directory, cold)
+            start = time.time()
+            try:
+                main(list(SCENARIOS[wrapper]))
+            except Dispatched:
+                pass
+            times.append(time.time() - start)
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+    return times
+
+
+def run(iterations=DEFAULT_ITERATIONS, latency=DEFAULT_LATENCY,
+        hesiod_latency=DEFAULT_LATENCY, wrappers=WRAPPERS,
+        import_samples=IMPORT_SAMPLES):
+    """Run the benchmarks.
+
+    Returns:
+      A dict of results, suitable for writing out as JSON
+    """
+    results = {'python': sys.version.split()[0],
+               'iterations': iterations,
+               'latency': latency,
+               'hesiod_latency': hesiod_latency,
+               'import': {},
+               'dispatch': {'cold': {}, 'warm': {}},
+               }
+
+    if import_samples:
+        for wrapper in wrappers:
+            times = time_import('debathena.printing.%s' % wrapper,
+                                import_samples)
+            if times:
+                results['import'][wrapper] = summarize(times)
+
+    fakes = Fakes(FakeHesiod(latency=hesiod_latency),
+                  FakeCups(latency=latency))
+    cache_directory = tempfile.mkdtemp()
+    fakes.install()
+    try:
+        for state in ('cold', 'warm'):
+            for wrapper in wrappers:
+                times = time_dispatch(wrapper, iterations, state == 'cold',
+                                      cache_directory)
+                results['dispatch'][state][wrapper] = summarize(times)
+    finally:
+        fakes.uninstall()
+        shutil.rmtree(cache_directory)
+    return results
+
+
+def parser():
+    parser = optparse.OptionParser(
+        usage="usage: %prog [options] [<wrapper> ...]")
+    parser.add_option('-n', '--iterations', type='int',
+                      default=DEFAULT_ITERATIONS,
+                      help="Run each wrapper N times (default %default)",
+                      metavar='N')
+    parser.add_option('--latency', type='float', default=DEFAULT_LATENCY,
+                      help="Seconds each IPP request takes (default %default)")
+    parser.add_option('--hesiod-latency', type='float',
+                      default=DEFAULT_LATENCY,
+                      help="Seconds each Hesiod lookup takes "
+                      "(default %default)")
+    parser.add_option('--import-samples', type='int', default=IMPORT_SAMPLES,
+                      help="Time importing each wrapper N times "
+                      "(default %default)", metavar='N')
+    parser.add_option('-o', '--output',
+                      help="Write the results to FILE instead of stdout",
+                      metavar='FILE')
+    return parser
+
+
+def _main(args):
+    options, wrappers = parser().parse_args(args[1:])
+    for wrapper in wrappers:
+        if wrapper not in WRAPPERS:
+            parser().error('unknown wrapper %s' % wrapper)
+
+    results = run(options.iterations, options.latency,
+                  options.hesiod_latency, wrappers or WRAPPERS,
+                  options.import_samples)
+
+    if options.output:
+        out = open(options.output, 'w')
+    else:
+        out = sys.stdout
+    try:
+        json.dump(results, out, indent=2, sort_keys=True)
+        out.write('\n')
+    finally:
+        if options.output:
+            out.close()
+    return 0
+
+
+__all__ = ['Fakes',
+           'FakeCups',
+           'FakeHesiod',
+           'Dispatched',
+           'percentile',
+           'summarize',
+           'run',
+           ]
+
+
+def main():
+    sys.exit(_main(sys.argv)) # pragma: nocover
+
+
+if __name__ == '__main__':
+    main() # pragma: nocover
@@ -0,0 +1,405 @@
+"""Small on-disk caches shared by the Debathena printing wrappers.
+
+Every wrapper invocation is a fresh process, so anything we want to
+remember between invocations (such as the result of resolving a queue
+name through the local cupsd and Hesiod) has to live on disk. The
+caches in this module are stored as JSON files in a per-user cache
+directory, and are safe to update from several processes at once.
+"""
+
+
+import collections
+import errno
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+CACHE_ENV = 'DEBATHENA_PRINTING_CACHE'
+
+FRESH = 'fresh'
+STALE = 'stale'
+MISS = 'miss'
+
+
+def cache_dir():
+    """Find (and create, if necessary) the cache directory.
+
+    The directory can be overridden with the DEBATHENA_PRINTING_CACHE
+    environment variable; setting it to the empty string disables
+    caching altogether. Otherwise, we use a directory under
+    $XDG_RUNTIME_DIR, or a private directory in /tmp. We avoid the
+    home directory, since on Athena that's in AFS.
+
+    Returns:
+      The path to the cache directory, or None if caching is disabled
+      or no safe directory could be found.
+    """
+    if CACHE_ENV in os.environ:
+        path = os.environ[CACHE_ENV]
+        if not path:
+            return None
+    elif os.environ.get('XDG_RUNTIME_DIR'):
+        path = os.path.join(os.environ['XDG_RUNTIME_DIR'],
+                            'debathena-printing')
+    else:
+        path = os.path.join(tempfile.gettempdir(),
+                            'debathena-printing-%d' % os.getuid())
+
+    try:
+        os.mkdir(path, 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            return None
+
+    # Don't trust a directory someone else could have planted for us
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+    if st.st_uid != os.getuid() or st.st_mode & 022 or not os.path.isdir(path):
+        return None
+    return path
+
+
+def _encode(obj):
+    """Convert the unicode strings json hands back into byte strings."""
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    elif isinstance(obj, list):
+        return [_encode(o) for o in obj]
+    elif isinstance(obj, dict):
+        return dict((_encode(k), _encode(v)) for k, v in obj.iteritems())
+    return obj
+
+
+def detach(func, *args):
+    """Run func(*args) in a detached background process.
+
+    The process is double-forked so that nobody has to reap it, and
+    its standard file descriptors point at /dev/null so that it
+    doesn't hold open a pipe the user is waiting on. Any errors are
+    silently discarded.
+    """
+    try:
+        pid = os.fork()
+    except OSError:
+        return
+    if pid:
+        os.waitpid(pid, 0)
+        return
+
+    try:
+        os.setsid()
+        if os.fork() == 0:
+            null = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(null, fd)
+            func(*args)
+    finally:
+        os._exit(0)
+
+
+def in_background(func, *args, **kwargs):
+    """Run func(*args) in the background, without waiting for it.
+
+    A single-threaded process detaches a child process to do the work
+    (see detach), so that it can finish after we've exited. Forking a
+    process with other threads isn't safe, though: the child gets any
+    lock another thread held at the time, held forever. So in that
+    case, func runs in a daemon thread instead. Any errors are
+    silently discarded.
+
+    Args:
+      forked: What to run instead of func in a detached process, if
+        it's different (e.g. to start by discarding state inherited
+        from the parent)
+    """
+    forked = kwargs.pop('forked', func)
+    if threading.active_count() == 1:
+        detach(forked, *args)
+        return
+
+    def run():
+        try:
+            func(*args)
+        except:
+            pass
+
+    t = threading.Thread(target=run)
+    t.setDaemon(True)
+    t.start()
+
+
+class LRUCache(object):
+    """A bounded in-memory cache with per-entry expiry.
+
+    Once more than size entries have been stored, the least recently
+    used ones are evicted.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._data = collections.OrderedDict()
+
+    def lookup(self, key, now=None):
+        """Look up a key in the cache.
+
+        Returns:
+          A tuple of (value, found). value is None if found is False.
+        """
+        if now is None:
+            now = time.time()
+        try:
+            expires, value = self._data.pop(key)
+        except KeyError:
+            return None, False
+        if now >= expires:
+            return None, False
+        self._data[key] = (expires, value)
+        return value, True
+
+    def store(self, key, value, ttl, now=None):
+        """Store a value in the cache for ttl seconds."""
+        if now is None:
+            now = time.time()
+        self._data.pop(key, None)
+        self._data[key] = (now + ttl, value)
+        while len(self._data) > self.size:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        """Forget everything in the cache."""
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class FileCache(object):
+    """A cache of JSON-serializable values, stored in a single file.
+
+    Entries are fresh for ttl seconds after they're stored (or for the
+    ttl passed to store(), if any). For a further stale seconds
+    they're still returned by get(), but a new value is computed out
+    of band (stale-while-revalidate).
+
+    If max_entries is set, the oldest entries are evicted whenever the
+    cache grows past that size.
+
+    Readers never lock; writers take an exclusive lock, merge their
+    change into the current contents of the file, and atomically
+    rename a new copy into place.
+    """
+
+    def __init__(self, name, ttl, stale=0, directory=None, max_entries=None):
+        self.name = name
+        self.ttl = ttl
+        self.stale = stale
+        self.directory = directory
+        self.max_entries = max_entries
+
+    def _path(self):
+        directory = self.directory or cache_dir()
+        if directory:
+            return os.path.join(directory, '%s.json' % self.name)
+
+    def _load(self, path):
+        try:
+            f = open(path)
+        except IOError:
+            return {}
+        try:
+            try:
+                data = json.load(f)
+            except ValueError:
+                return {}
+        finally:
+            f.close()
+        if not isinstance(data, dict):
+            return {}
+        return _encode(data)
+
+    def lookup(self, key, now=None):
+        """Look up a key in the cache.
+
+        Returns:
+          A tuple of (value, state), where state is one of FRESH,
+          STALE or MISS. value is None on a MISS.
+        """
+        path = self._path()
+        if not path:
+            return None, MISS
+        if now is None:
+            now = time.time()
+
+        entry = self._load(path).get(key)
+        if not entry:
+            return None, MISS
+        state = self._state(entry, now)
+        if state == MISS:
+            return None, MISS
+        return entry[1], state
+
+    def _state(self, entry, now):
+        stored, value = entry[:2]
+        ttl = self.ttl
+        if len(entry) > 2:
+            ttl = entry[2]
+        age = now - stored
+        if 0 <= age < ttl:
+            return FRESH
+        elif 0 <= age < ttl + self.stale:
+            return STALE
+        return MISS
+
+    def items(self, now=None):
+        """List the entries in the cache that haven't expired.
+
+        Returns:
+          A list of (key, value) pairs
+        """
+        path = self._path()
+        if not path:
+            return []
+        if now is None:
+            now = time.time()
+        return [(k, entry[1]) for k, entry in self._load(path).iteritems()
+                if self._state(entry, now) != MISS]
+
+    def _update(self, change, now=None):
+        path = self._path()
+        if not path:
+            return
+        if now is None:
+            now = time.time()
+
+        try:
+            lock = open(path + '.lock', 'a')
+        except IOError:
+            return
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            data = self._load(path)
+            change(data)
+            # Drop anything that's too old to ever be returned again
+            for k, entry in data.items():
+                if self._state(entry, now) == MISS:
+                    del data[k]
+            if self.max_entries is not None and len(data) > self.max_entries:
+                by_age = sorted(data, key=lambda k: data[k][0])
+                for k in by_age[:len(data) - self.max_entries]:
+                    del data[k]
+
+            fd, tmp = tempfile.mkstemp(prefix='.%s.' % self.name,
+                                       dir=os.path.dirname(path))
+            try:
+                f = os.fdopen(fd, 'w')
+                try:
+                    json.dump(data, f)
+                finally:
+                    f.close()
+                os.rename(tmp, path)
+            except (IOError, OSError):
+                try:
+                    os.unlink(tmp)
+                except OSError:
+                    pass
+        finally:
+            lock.close()
+
+    def store(self, key, value, now=None, ttl=None):
+        """Store a value in the cache.
+
+        Args:
+          key: The cache key
+          value: A JSON-serializable value
+          now: The time to record the value as stored at
+          ttl: How long this entry is fresh for, if different from
+            the cache's ttl
+        """
+        if now is None:
+            now = time.time()
+        def change(data):
+            if ttl is None:
+                data[key] = [now, value]
+            else:
+                data[key] = [now, value, ttl]
+        self._update(change, now)
+
+    def invalidate(self, key=None):
+        """Remove a key from the cache, or everything if key is None."""
+        def change(data):
+            if key is None:
+                data.clear()
+            else:
+                data.pop(key, None)
+        self._update(change)
+
+    def invalidate_matching(self, predicate):
+        """Remove every key for which predicate(key) is true."""
+        def change(data):
+            for k in data.keys():
+                if predicate(k):
+                    del data[k]
+        self._update(change)
+
+    def get(self, key, compute, revalidate=None):
+        """Return the cached value for key, computing it if needed.
+
+        Args:
+          key: The cache key
+          compute: A function of no arguments that returns the value
+            for key. If it returns None, nothing is stored.
+          revalidate: A function of no arguments that computes and
+            stores a new value in the background, used when an entry
+            is stale. Defaults to running compute in the background
+            (see in_background).
+
+        Returns:
+          The value for key.
+        """
+        value, state = self.lookup(key)
+        if state == FRESH:
+            return value
+        elif state == STALE:
+            if revalidate is None:
+                revalidate = lambda: in_background(self._refresh, key,
+                                                   compute)
+            revalidate()
+            return value
+
+        value = compute()
+        if value is not None:
+            self.store(key, value)
+        return value
+
+    def _refresh(self, key, compute):
+        value = compute()
+        if value is not None:
+            self.store(key, value)
+
+
+class NullCache(FileCache):
+    """A cache that never remembers anything."""
+
+    def __init__(self, name='null', ttl=0, stale=0):
+        super(NullCache, self).__init__(name, ttl, stale)
+
+    def _path(self):
+        return None
+
+
+__all__ = ['FileCache',
+           'LRUCache',
+           'NullCache',
+           'cache_dir',
+           'detach',
+           'in_background',
+           'FRESH',
+           'STALE',
+           'MISS',
+           ]
@@ -1,25 +1,46 @@
 """Debathena printing configuration"""
 
 
+import errno
 import getopt
 import os
-import socket
 import sys
-import urllib
-import string
-import re
-import subprocess
-import cups
-import hesiod
+import threading
+import time
+
+# cups, hesiod and the heavier standard library modules are imported
+# where they're used, so that a wrapper only pays to load the modules
+# it actually needs
+
+from debathena.printing import cache
+from debathena.printing import pcapdb
 
 
-_loaded = False
 CUPS_FRONTENDS = [
     'printers.mit.edu',
     'cluster-printers.mit.edu',
     ]
+# Print servers that should be queried over LPD rather than IPP
+LPD_SERVERS = [
+    'pharos-prodp1.mit.edu',
+    ]
+# CUPS_BACKENDS and cupsd are set up lazily by _get_cups_backends()
+# and _get_cupsd(), respectively
 CUPS_BACKENDS = []
 cupsd = None
+_destinations = None
+_pcap_snapshot = None
+_materialized = set()
+# pycups connections aren't thread-safe, so callers resolving queues
+# from several threads take turns with the local cupsd
+_cupsd_lock = threading.RLock()
+
+# Connections to CUPS servers are pooled (see ConnectionPool). One
+# that's been idle for CONNECTION_IDLE_TIMEOUT seconds is closed, and
+# one that's been idle for CONNECTION_CHECK_AFTER seconds is checked
+# before it's used again.
+CONNECTION_IDLE_TIMEOUT = 60
+CONNECTION_CHECK_AFTER = 5
 
 
 SYSTEM_CUPS = 0
@@ -29,27 +50,653 @@ SYSTEM_CUPS = 0
 SYSTEMS = [SYSTEM_CUPS]
 
 
+# Queue resolutions are remembered across invocations. An entry is
+# used as-is for RESOLUTION_TTL seconds, and for up to RESOLUTION_STALE
+# seconds after that while a fresh answer is looked up in the
+# background. Entries are only used with the CUPS server and local
+# queue configuration they were resolved against, and resolutions
+# made while a lookup was failing aren't remembered at all.
+RESOLUTION_TTL = 15 * 60
+RESOLUTION_STALE = 24 * 60 * 60
+_resolution_cache = cache.FileCache('resolution',
+                                    RESOLUTION_TTL, RESOLUTION_STALE)
+
+# How many Hesiod or local cupsd lookups have failed in this process,
+# other than for names that don't exist
+_lookup_failures = 0
+_failures_lock = threading.Lock()
+
+# Whether each CUPS server is answering, and how quickly, is
+# remembered for a short while, so that a dead print server is only
+# waited on once. Live servers are remembered for LIVENESS_TTL seconds
+# and dead ones for LIVENESS_NEGATIVE_TTL seconds.
+LIVENESS_TTL = 60
+LIVENESS_NEGATIVE_TTL = 15
+_liveness_cache = cache.FileCache('liveness', LIVENESS_TTL)
+
+# Print servers are probed happy-eyeballs style: the queue's own server
+# gets a head start of PROBE_STAGGER seconds before each of the
+# CUPS_FRONTENDS is tried in turn, and the first to accept a connection
+# within PROBE_TIMEOUT seconds is used
+PROBE_TIMEOUT = 0.3
+PROBE_STAGGER = 0.1
+
+# A wrapper has DEADLINE seconds in all to work out where a job should
+# go, shared between every stage (Hesiod, the local cupsd, getcluster,
+# probing print servers, LPD). Once it's passed, the wrapper makes do
+# with what's cached, or sends the queue to the first of the
+# CUPS_FRONTENDS. DEBATHENA_PRINTING_DEADLINE overrides it; 0 turns it
+# off.
+DEADLINE = 3.0
+DEADLINE_ENV = 'DEBATHENA_PRINTING_DEADLINE'
+_deadline = None
+
+# Likewise for the output of getcluster, which only changes when the
+# cluster configuration does
+CLUSTERINFO_TTL = 60 * 60
+CLUSTERINFO_STALE = 7 * 24 * 60 * 60
+_clusterinfo_cache = cache.FileCache('clusterinfo',
+                                     CLUSTERINFO_TTL, CLUSTERINFO_STALE)
+
+# The index of local destinations is kept until the local cupsd's
+# configuration changes. (It was once keyed by the names' original
+# case, in a cache called 'destinations'.)
+DESTINATIONS_TTL = 24 * 60 * 60
+_destinations_cache = cache.FileCache('destination-index', DESTINATIONS_TTL)
+PRINTERS_CONF = '/etc/cups/printers.conf'
+CLASSES_CONF = '/etc/cups/classes.conf'
+
+# Package version checks are remembered until dpkg's status file
+# changes (or CAPABILITY_TTL passes, just in case)
+CAPABILITY_TTL = 7 * 24 * 60 * 60
+_capability_cache = cache.FileCache('capabilities', CAPABILITY_TTL)
+
+DPKG_STATUS = '/var/lib/dpkg/status'
+LSB_RELEASE = '/etc/lsb-release'
+DEBIAN_VERSION = '/etc/debian_version'
+OS_RELEASE = '/etc/os-release'
+
+
+# Hesiod answers are cached both in memory and on disk. libhesiod
+# doesn't tell us the TTL on the underlying DNS records, so we use our
+# own: HESIOD_TTL for answers, and the shorter HESIOD_NEGATIVE_TTL for
+# names that don't exist.
+HESIOD_TTL = 60 * 60
+HESIOD_NEGATIVE_TTL = 5 * 60
+HESIOD_CACHE_SIZE = 256
+_hesiod_memory = cache.LRUCache(HESIOD_CACHE_SIZE)
+_hesiod_cache = cache.FileCache('hesiod', HESIOD_TTL,
+                                max_entries=HESIOD_CACHE_SIZE)
+_hesiod_stats = {'hits': 0, 'negative_hits': 0, 'misses': 0}
+# Lookups can run in several threads at once (see _find_queue)
+_hesiod_lock = threading.Lock()
+
+
+# With DEBATHENA_DEBUG set, the time spent in each stage of a wrapper
+# is traced, as JSON lines on stderr or appended to the file named by
+# DEBATHENA_TRACE_FILE
+TRACE_FILE_ENV = 'DEBATHENA_TRACE_FILE'
+_trace_epoch = time.time()
+_trace_stack = threading.local()
+
+
+def _emit_trace(record):
+    import json
+    line = json.dumps(record, sort_keys=True) + '\n'
+    path = os.environ.get(TRACE_FILE_ENV)
+    if not path:
+        sys.stderr.write(line)
+        return
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0600)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
+class _Span(object):
+    """A timed stage of a wrapper, from trace_span() to finish()."""
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+        if not hasattr(_trace_stack, 'spans'):
+            _trace_stack.spans = []
+        self.parent = (_trace_stack.spans or [None])[-1]
+        _trace_stack.spans.append(name)
+        self.start = time.time()
+
+    def set(self, **fields):
+        """Add fields to the span's record."""
+        self.fields.update(fields)
+
+    def finish(self, **fields):
+        """End the span and write out its record."""
+        end = time.time()
+        _trace_stack.spans.pop()
+        record = dict(self.fields, **fields)
+        record.update({'span': self.name,
+                       'start': round(self.start - _trace_epoch, 6),
+                       'duration': round(end - self.start, 6),
+                       'pid': os.getpid()})
+        if self.parent:
+            record['parent'] = self.parent
+        _emit_trace(record)
+
+
+class _NullSpan(object):
+    """What trace_span() returns when tracing is off."""
+
+    def set(self, **fields):
+        pass
+
+    def finish(self, **fields):
+        pass
+
+
+_null_span = _NullSpan()
+
+
+def trace_span(name, **fields):
+    """Start timing a stage, if tracing is on.
+
+    Callers should end the span with its finish() method (usually in
+    a finally clause); any keyword arguments to trace_span(), set()
+    and finish() are included in the span's record.
+
+    Args:
+      name: The name of the stage
+    """
+    if not os.environ.get('DEBATHENA_DEBUG'):
+        return _null_span
+    return _Span(name, fields)
+
+
+def trace_event(name, **fields):
+    """Record an instant in the trace, such as the final exec."""
+    trace_span(name, **fields).finish()
+
+
+class Deadline(object):
+    """A point in time by which a wrapper has to have made up its mind.
+
+    Args:
+      seconds: How long from now the deadline is
+    """
+
+    def __init__(self, seconds, now=None):
+        if now is None:
+            now = time.time()
+        self.expires = now + seconds
+
+    def remaining(self, now=None):
+        """Return how many seconds are left, or 0 if it's passed."""
+        if now is None:
+            now = time.time()
+        return max(self.expires - now, 0)
+
+    def expired(self, now=None):
+        return self.remaining(now) == 0
+
+
+def start_deadline(seconds=None):
+    """Start the clock on the current wrapper invocation.
+
+    Args:
+      seconds: How long the wrapper has. Defaults to the value of
+        DEBATHENA_PRINTING_DEADLINE, or DEADLINE.
+
+    Returns:
+      The Deadline, or None if there isn't one
+    """
+    global _deadline
+    if seconds is None:
+        seconds = DEADLINE
+        try:
+            seconds = float(os.environ[DEADLINE_ENV])
+        except (KeyError, ValueError):
+            pass
+    if seconds > 0:
+        _deadline = Deadline(seconds)
+    else:
+        _deadline = None
+    return _deadline
+
+
+def deadline_timeout(timeout):
+    """Cut a timeout short so that it ends by the deadline, if any."""
+    if _deadline is None:
+        return timeout
+    return min(timeout, _deadline.remaining())
+
+
+def run_within_deadline(stage, func, fallback):
+    """Call func, but give up on it if the deadline passes first.
+
+    func runs in a thread of its own, so that it can be abandoned
+    halfway through a blocking call into libhesiod or pycups. Without
+    a deadline, it's simply called.
+
+    Args:
+      stage: The name of the stage, for tracing
+      func: A function of no arguments
+      fallback: A function of no arguments to call for an answer
+        instead, once the deadline has passed
+
+    Returns:
+      What func returns, or what fallback returns if the deadline
+      passes first. Exceptions raised by func are passed on.
+    """
+    deadline = _deadline
+    if deadline is None:
+        return func()
+
+    result = []
+    def run():
+        try:
+            result.append((True, func()))
+        except:
+            result.append((False, sys.exc_info()))
+
+    if not deadline.expired():
+        t = threading.Thread(target=run)
+        t.setDaemon(True)
+        t.start()
+        # Python 2's Thread.join(timeout) polls, starting at half a
+        # millisecond, which is longer than most stages take; poll
+        # more finely
+        delay = 0.00005
+        while not result:
+            remaining = deadline.remaining()
+            if not remaining:
+                break
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.001)
+    if not result:
+        trace_event('deadline', stage=stage)
+        return fallback()
+
+    ok, value = result[0]
+    if not ok:
+        raise value[0], value[1], value[2]
+    return value
+
+
+def _in_background(func, *args):
+    """Start calling func(*args) in a thread of its own.
+
+    This is for lookups that can run alongside others, but whose
+    answer might not be needed. If it isn't, the thread is simply
+    abandoned (it still fills in any caches).
+
+    Returns:
+      A function of no arguments that waits for func to finish, and
+      returns what it returned. Exceptions raised by func are raised
+      from there instead.
+    """
+    result = []
+    def run():
+        try:
+            result.append((True, func(*args)))
+        except:
+            result.append((False, sys.exc_info()))
+
+    t = threading.Thread(target=run)
+    t.setDaemon(True)
+    t.start()
+    def wait():
+        t.join()
+        ok, value = result[0]
+        if not ok:
+            raise value[0], value[1], value[2]
+        return value
+    return wait
+
+
+def _note_lookup_failure():
+    """Record that a lookup failed, so answers based on it aren't cached."""
+    global _lookup_failures
+    _failures_lock.acquire()
+    try:
+        _lookup_failures += 1
+    finally:
+        _failures_lock.release()
+
+
 def _hesiod_lookup(hes_name, hes_type):
-    """A wrapper with somewhat graceful error handling."""
+    """A wrapper with somewhat graceful error handling.
+
+    Answers are cached, and so are lookups for names that don't
+    exist. Other errors (such as timeouts) aren't cached.
+    """
+    span = trace_span('_hesiod_lookup', hes_name=hes_name,
+                      hes_type=hes_type)
+    try:
+        results, source = _cached_hesiod_lookup(hes_name, hes_type)
+        span.set(source=source, results=len(results))
+        return results
+    finally:
+        span.finish()
+
+
+def _cached_hesiod_lookup(hes_name, hes_type):
+    """Look up a Hesiod name, and say where the answer came from."""
+    key = '%s.%s' % (hes_name, hes_type)
+    _hesiod_lock.acquire()
+    try:
+        results, found = _hesiod_memory.lookup(key)
+    finally:
+        _hesiod_lock.release()
+    source = 'memory'
+    if not found:
+        results, state = _hesiod_cache.lookup(key)
+        found = state == cache.FRESH
+        source = 'disk'
+    _hesiod_lock.acquire()
+    try:
+        if found:
+            if source == 'disk':
+                _hesiod_memory.store(key, results, results and HESIOD_TTL
+                                     or HESIOD_NEGATIVE_TTL)
+            if results:
+                _hesiod_stats['hits'] += 1
+            else:
+                _hesiod_stats['negative_hits'] += 1
+            return results, source
+        _hesiod_stats['misses'] += 1
+    finally:
+        _hesiod_lock.release()
+
+    import hesiod
     try:
         h = hesiod.Lookup(hes_name, hes_type)
-        return h.results
-    except IOError:
-        return []
+        results = h.results
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            _note_lookup_failure()
+            return [], 'error'
+        results = []
+
+    ttl = results and HESIOD_TTL or HESIOD_NEGATIVE_TTL
+    _hesiod_lock.acquire()
+    try:
+        _hesiod_memory.store(key, results, ttl)
+    finally:
+        _hesiod_lock.release()
+    _hesiod_cache.store(key, results, ttl=ttl)
+    return results, 'hesiod'
+
 
+def hesiod_cache_stats():
+    """Return the Hesiod cache counters for this process.
 
-def _setup():
-    global _loaded, cupsd
-    if not _loaded:
-        CUPS_BACKENDS = [s.lower() for s in
-                         _hesiod_lookup('cups-print', 'sloc') +
-                         _hesiod_lookup('cups-cluster', 'sloc')]
+    Returns:
+      A dict with the number of cached answers (hits), cached
+      nonexistent names (negative_hits), and live lookups (misses).
+    """
+    return dict(_hesiod_stats)
+
+
+def _get_cups_backends():
+    """Return the Athena CUPS backend servers.
+
+    They're looked up in Hesiod the first time they're needed, with
+    both lookups running at once.
+    """
+    global CUPS_BACKENDS
+    if 'backends' not in _materialized:
+        span = trace_span('setup', resource='backends')
+        try:
+            cluster = _in_background(_hesiod_lookup, 'cups-cluster', 'sloc')
+            backends = [s.lower() for s in
+                        _hesiod_lookup('cups-print', 'sloc') + cluster()]
+        finally:
+            span.finish()
+        if 'backends' not in _materialized:
+            CUPS_BACKENDS = backends
+            _materialized.add('backends')
+    return CUPS_BACKENDS
+
+
+class ConnectionPool(object):
+    """Reusable connections to CUPS servers.
+
+    Connections are keyed by (host, port, encryption), where None
+    means libcups' default (so a host of None is the local cupsd).
+    pycups connections can't be used from two threads at once, so a
+    connection belongs to whoever got it until they put it back. A
+    thread is given back the connection it used last, if it's idle.
+
+    Args:
+      idle_timeout: How long, in seconds, an idle connection is kept
+      check_after: How long, in seconds, a connection can be idle
+        before it's checked (with a CUPS-Get-Default request) before
+        being used again
+    """
+
+    def __init__(self, idle_timeout=CONNECTION_IDLE_TIMEOUT,
+                 check_after=CONNECTION_CHECK_AFTER):
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+        self._lock = threading.Lock()
+        # key -> [(conn, thread, idle since), ...]
+        self._idle = {}
+        # id(conn) -> key, for connections that are handed out
+        self._keys = {}
+
+    def _take_idle(self, key, now):
+        """Take the best idle connection for key out of the pool."""
+        self._lock.acquire()
+        try:
+            idle = self._idle.get(key, [])
+            idle[:] = [entry for entry in idle
+                       if now - entry[2] < self.idle_timeout]
+            if not idle:
+                return None, None
+            # The most recently used connection, preferably one this
+            # thread used
+            thread = threading.currentThread()
+            index = len(idle) - 1
+            for i, entry in enumerate(idle):
+                if entry[1] is thread:
+                    index = i
+            conn, owner, since = idle.pop(index)
+            self._keys[id(conn)] = key
+            return conn, since
+        finally:
+            self._lock.release()
+
+    def _healthy(self, conn):
+        import cups
         try:
-            cupsd = cups.Connection()
-        except RuntimeError:
+            conn.getDefault()
+        except cups.IPPError:
+            # The server answered, at least
             pass
+        except (cups.HTTPError, RuntimeError):
+            return False
+        return True
+
+    def get(self, host=None, port=None, encryption=None):
+        """Get a connection to a CUPS server.
+
+        The connection must be handed back with put() (or discard(),
+        if it's broken) once the caller is done with it.
+
+        Raises:
+          RuntimeError if a new connection can't be opened
+        """
+        key = (host and host.lower(), port, encryption)
+        while True:
+            now = time.time()
+            conn, since = self._take_idle(key, now)
+            if conn is None:
+                break
+            if now - since < self.check_after or self._healthy(conn):
+                return conn
+            self.discard(conn)
+
+        import cups
+        kwargs = {}
+        for name, value in (('host', host), ('port', port),
+                            ('encryption', encryption)):
+            if value is not None:
+                kwargs[name] = value
+        span = trace_span('setup', resource='connection', host=host)
+        try:
+            conn = cups.Connection(**kwargs)
+        finally:
+            span.finish()
+        self._lock.acquire()
+        try:
+            self._keys[id(conn)] = key
+        finally:
+            self._lock.release()
+        return conn
+
+    def put(self, conn):
+        """Give a connection back, to be reused."""
+        self._lock.acquire()
+        try:
+            key = self._keys.pop(id(conn), None)
+            if key is not None:
+                self._idle.setdefault(key, []).append(
+                    (conn, threading.currentThread(), time.time()))
+        finally:
+            self._lock.release()
+
+    def discard(self, conn):
+        """Give a connection back, to be closed rather than reused."""
+        self._lock.acquire()
+        try:
+            self._keys.pop(id(conn), None)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Close all the idle connections."""
+        self._lock.acquire()
+        try:
+            self._idle.clear()
+        finally:
+            self._lock.release()
 
-        _loaded = True
+
+_connections = ConnectionPool()
+
+
+def get_connection(host=None, port=None, encryption=None):
+    """Get a pooled connection to a CUPS server (see ConnectionPool.get)."""
+    return _connections.get(host, port, encryption)
+
+
+def put_connection(conn, broken=False):
+    """Hand back a connection from get_connection.
+
+    Args:
+      conn: The connection
+      broken: Whether the connection failed, and shouldn't be reused
+    """
+    if broken:
+        _connections.discard(conn)
+    else:
+        _connections.put(conn)
+
+
+def ipp_request(host, method, *args, **kwargs):
+    """Make one request of a CUPS server over a pooled connection.
+
+    Args:
+      host: The server (None for the local cupsd)
+      method: The name of the cups.Connection method to call
+
+    Any other arguments are passed on to the method.
+
+    Returns:
+      What the method returns
+
+    Raises:
+      Whatever the method does (cups.IPPError, cups.HTTPError or
+      RuntimeError). The connection is only reused if the server
+      answered.
+    """
+    import cups
+    conn = get_connection(host)
+    try:
+        result = getattr(conn, method)(*args, **kwargs)
+    except cups.IPPError:
+        put_connection(conn)
+        raise
+    except:
+        put_connection(conn, broken=True)
+        raise
+    put_connection(conn)
+    return result
+
+
+def _get_cupsd():
+    """Return a connection to the local cupsd, or None.
+
+    The connection is taken from the pool the first time it's needed,
+    and kept for the rest of the process.
+    """
+    global cupsd
+    _cupsd_lock.acquire()
+    try:
+        if 'cupsd' not in _materialized:
+            span = trace_span('setup', resource='cupsd')
+            try:
+                cupsd = get_connection()
+            except RuntimeError:
+                cupsd = None
+            span.finish(connected=cupsd is not None)
+            _materialized.add('cupsd')
+        return cupsd
+    finally:
+        _cupsd_lock.release()
+
+
+def materialized():
+    """List the lazily-initialized resources set up by this process.
+
+    Returns:
+      A sorted list containing 'backends' if the CUPS backends have
+      been looked up in Hesiod, 'cupsd' if a connection to the local
+      cupsd has been opened, 'destinations' if the local destination
+      index has been loaded, and 'pcap' if the pcap snapshot has been
+      opened.
+    """
+    return sorted(_materialized)
+
+
+def _forget_materialized():
+    """Forget all lazily-initialized resources."""
+    global CUPS_BACKENDS, cupsd, _destinations, _pcap_snapshot, _deadline
+    global _connections
+    CUPS_BACKENDS = []
+    cupsd = None
+    _connections = ConnectionPool()
+    _destinations = None
+    _pcap_snapshot = None
+    _deadline = None
+    _materialized.clear()
+
+
+def _get_pcap_snapshot():
+    """Return the pcap snapshot (see debathena.printing.pcapdb), or None.
+
+    The snapshot is opened the first time it's needed.
+    """
+    global _pcap_snapshot
+    if 'pcap' not in _materialized:
+        span = trace_span('setup', resource='pcap')
+        _pcap_snapshot = pcapdb.open_snapshot()
+        span.finish(found=_pcap_snapshot is not None)
+        _materialized.add('pcap')
+    return _pcap_snapshot
 
 
 def error(code, message):
@@ -58,14 +705,147 @@ def error(code, message):
     sys.exit(code)
 
 
-def get_cups_uri(printer):
-    _setup()
-    if cupsd:
+def _conf_mtimes():
+    mtimes = []
+    for path in (PRINTERS_CONF, CLASSES_CONF):
         try:
-            attrs = cupsd.getPrinterAttributes(printer)
-            return attrs.get('device-uri')
-        except cups.IPPError:
-            pass
+            mtimes.append(os.stat(path).st_mtime)
+        except OSError:
+            mtimes.append(None)
+    return mtimes
+
+
+def _fetch_destinations():
+    """Fetch every destination from the local cupsd in one go.
+
+    Returns:
+      An index of the destinations, as for get_destinations, or None
+      if the local cupsd couldn't be reached.
+    """
+    import cups
+    cupsd = _get_cupsd()
+    if not cupsd:
+        return None
+    _cupsd_lock.acquire()
+    try:
+        try:
+            printers = cupsd.getPrinters()
+            classes = cupsd.getClasses()
+        except (cups.IPPError, cups.HTTPError):
+            return None
+    finally:
+        _cupsd_lock.release()
+
+    # CUPS destination names are case-insensitive
+    index = dict((name.lower(), [name, attrs.get('device-uri')])
+                 for name, attrs in printers.iteritems())
+    # Classes don't have device URIs of their own
+    for name in classes:
+        index.setdefault(name.lower(), [name, None])
+    return index
+
+
+def get_destinations():
+    """Return an index of the destinations in the local cupsd.
+
+    The index is fetched with a single pair of IPP requests, and
+    cached on disk until the local cupsd's printers.conf or
+    classes.conf changes.
+
+    Returns:
+      A dict mapping lowercased destination names (since CUPS
+      destination names are case-insensitive) to [name, device_uri]
+      lists, where name is as the local cupsd has it, and device_uri
+      is None for destinations without one, such as classes
+    """
+    global _destinations
+    _cupsd_lock.acquire()
+    try:
+        if 'destinations' in _materialized:
+            return _destinations
+
+        span = trace_span('setup', resource='destinations')
+        import cups
+        key = cups.getServer()
+        mtimes = _conf_mtimes()
+        value, state = _destinations_cache.lookup(key)
+        if state != cache.MISS and value[0] == mtimes:
+            index = value[1]
+            span.set(source='disk')
+        else:
+            index = _fetch_destinations()
+            if index is not None:
+                _destinations_cache.store(key, [mtimes, index])
+            span.set(source='cupsd')
+        span.finish()
+        if index is None:
+            # Try again next time, rather than treating every queue
+            # as non-local for the rest of the process
+            _note_lookup_failure()
+            return {}
+        _destinations = index
+        _materialized.add('destinations')
+        return _destinations
+    finally:
+        _cupsd_lock.release()
+
+
+def _known_destinations():
+    """Return the local destination index, if it's known without asking.
+
+    Returns:
+      The index, as for get_destinations, if it's already been
+      fetched or is cached on disk for the current printers.conf and
+      classes.conf; otherwise None
+    """
+    if 'destinations' in _materialized:
+        return _destinations
+    import cups
+    value, state = _destinations_cache.lookup(cups.getServer())
+    if state == cache.MISS or value[0] != _conf_mtimes():
+        return None
+    return value[1]
+
+
+def invalidate_destinations():
+    """Forget the local destination index, so it's fetched again."""
+    global _destinations
+    _cupsd_lock.acquire()
+    try:
+        _destinations = None
+        _materialized.discard('destinations')
+        _destinations_cache.invalidate()
+    finally:
+        _cupsd_lock.release()
+
+
+def invalidate_queue(queue=None):
+    """Forget what's cached about a queue in the local cupsd.
+
+    This is for when the local cupsd adds, changes or removes a queue
+    (see debathena.printing.notify). The destination index is fetched
+    again, and resolutions of the queue (or any of its instances) are
+    looked up again.
+
+    Args:
+      queue: The name of the local queue, or None to forget every
+        resolution
+    """
+    invalidate_destinations()
+    if queue is None:
+        _resolution_cache.invalidate()
+    else:
+        queue = queue.lower()
+        _resolution_cache.invalidate_matching(
+            lambda key: key.split('/')[0].lower() == queue)
+
+
+def get_cups_uri(printer):
+    span = trace_span('get_cups_uri', printer=printer)
+    try:
+        return get_destinations().get(printer.lower(), [None, None])[1]
+    finally:
+        span.finish()
 
 
 def parse_args(args, optinfos):
@@ -107,6 +887,8 @@ def parse_args(args, optinfos):
           continue
     
     # If we got this far, they both failed (read: syntax error)
+    import re
+    import string
     error(2, "Syntax Error: Incorrect option passed.  See the man page for more information.\nA common cause is using old LPRng syntax.\nValid options: %s\n" % 
           (string.replace(re.sub(r'([a-zA-Z])', r'-\1 ',
                                  optinfos[SYSTEM_CUPS][1]), ':', '[arg] ')))
@@ -142,23 +924,193 @@ def extract_opt(options, optname):
 
 def get_default_printer():
     """Find and return the default printer"""
-    _setup()
-
-    if 'PRINTER' in os.environ:
-        return os.environ['PRINTER']
-
+    span = trace_span('get_default_printer')
+    try:
+        if 'PRINTER' in os.environ:
+            span.set(source='environment')
+            return os.environ['PRINTER']
+
+        # The resolver daemon isn't asked: libcups answers this from
+        # the caller's LPDEST and ~/.cups/lpoptions, which the daemon
+        # can't see
+        return run_within_deadline('get_default_printer',
+                                   lambda: _get_default_printer(span),
+                                   _cached_default_printer)
+    finally:
+        span.finish()
+
+
+def _get_default_printer(span):
+    """Ask the local cupsd, then getcluster, for the default printer."""
+    cupsd = _get_cupsd()
     if cupsd:
         default = cupsd.getDefault()
         if default:
+            span.set(source='cupsd')
             return default
 
-    clusterinfo = subprocess.Popen("getcluster -p $(lsb_release -sr)",
-                                   stdout=subprocess.PIPE,
-                                   shell=True).communicate()[0]
-    for line in clusterinfo.splitlines():
-        (k,v) = line.split(None, 1)
-        if k == "LPR":
-            return v.strip()
+    span.set(source='getcluster')
+    return get_cluster_info().get('LPR')
+
+
+def _cached_default_printer():
+    """Find the default printer without waiting on anything.
+
+    Returns:
+      The default printer according to the last getcluster run that's
+      still cached, if any
+    """
+    release = get_os_release()
+    if release:
+        info, state = _clusterinfo_cache.lookup(release)
+        if info:
+            return info.get('LPR')
+
+
+def _read_release_file(path, key):
+    """Find the value of key in a shell-style KEY=value file."""
+    try:
+        f = open(path)
+    except IOError:
+        return None
+    try:
+        for line in f:
+            if '=' not in line:
+                continue
+            k, v = line.split('=', 1)
+            if k.strip() == key:
+                return v.strip().strip('"\'')
+    finally:
+        f.close()
+
+
+def get_os_release():
+    """Find the release number of the running OS.
+
+    This returns the same thing as `lsb_release -sr`, without the cost
+    of running lsb_release.
+
+    Returns:
+      The OS release number (e.g. '14.04'), or None if it couldn't be
+      determined.
+    """
+    release = _read_release_file(LSB_RELEASE, 'DISTRIB_RELEASE')
+    if release:
+        return release
+
+    # lsb_release on Debian reports the full point release from here,
+    # rather than the major version in os-release
+    try:
+        f = open(DEBIAN_VERSION)
+        try:
+            release = f.read().strip()
+        finally:
+            f.close()
+        if release[:1].isdigit():
+            return release
+    except IOError:
+        pass
+
+    return _read_release_file(OS_RELEASE, 'VERSION_ID')
+
+
+def _read_cluster_info(release):
+    """Run getcluster, and parse its output.
+
+    Returns:
+      A dict of cluster information, or None if getcluster failed.
+    """
+    import subprocess
+    span = trace_span('getcluster', release=release)
+    try:
+        try:
+            p = subprocess.Popen(['getcluster', '-p', release],
+                                 stdout=subprocess.PIPE)
+        except OSError:
+            return None
+        output = p.communicate()[0]
+        span.set(returncode=p.returncode)
+        if p.returncode != 0:
+            return None
+    finally:
+        span.finish()
+
+    info = {}
+    for line in output.splitlines():
+        fields = line.split(None, 1)
+        if len(fields) == 2:
+            info[fields[0]] = fields[1].strip()
+    return info
+
+
+def get_cluster_info():
+    """Find the cluster information for this machine.
+
+    Cluster information comes from getcluster, but is cached on disk,
+    and refreshed in the background once it gets old.
+
+    Returns:
+      A dict mapping cluster information keys (such as 'LPR') to
+      their values. The dict is empty if no information could be
+      found.
+    """
+    release = get_os_release()
+    if not release:
+        return {}
+    return _clusterinfo_cache.get(release,
+                                  lambda: _read_cluster_info(release)) or {}
+
+
+def _compare_package_version(package, op, version):
+    import subprocess
+    try:
+        installed = subprocess.Popen(
+            ["dpkg-query", "-W", "-f", "${Version}", package],
+            stdout=subprocess.PIPE).communicate()[0]
+        return subprocess.call(
+            ["dpkg", "--compare-versions", installed, op, version]) == 0
+    except OSError:
+        return False
+
+
+def compare_package_version(package, op, version):
+    """Compare the installed version of a Debian package.
+
+    The answer is cached, and only recomputed once the dpkg database
+    changes.
+
+    Args:
+      package: The name of a Debian package
+      op: A comparison operator understood by dpkg --compare-versions
+        (e.g. 'lt-nl')
+      version: The version to compare against
+
+    Returns:
+      True if the installed version of package compares as requested,
+      False otherwise, including on non-Debian-based systems.
+    """
+    try:
+        mtime = os.stat(DPKG_STATUS).st_mtime
+    except OSError:
+        return False
+
+    key = '%s %s %s' % (package, op, version)
+    value, state = _capability_cache.lookup(key)
+    if state != cache.MISS and value[0] == mtime:
+        return value[1]
+
+    result = _compare_package_version(package, op, version)
+    _capability_cache.store(key, [mtime, result])
+    return result
+
+
+def local_queues():
+    """List the queues configured in the local cupsd.
+
+    Returns:
+      A sorted list of queue names
+    """
+    return sorted(name for name, uri in get_destinations().itervalues())
 
 
 def is_local(queue):
@@ -171,10 +1123,23 @@ def is_local(queue):
       True if the queue is defined in whatever the default CUPS
       daemon is, False otherwise
     """
-    _setup()
-    return queue in [dest(0) for dest in cupsd.getDests()]
+    return queue.lower() in get_destinations()
+
+def is_athena_print_server(host):
+    """Determine if a host is one of the Athena CUPS print servers
 
-def canonicalize_queue(queue):
+    Args:
+      host: A hostname
+
+    Return:
+      True if host is one of the CUPS_FRONTENDS or CUPS_BACKENDS,
+      False otherwise
+    """
+    host = host.lower()
+    return host in CUPS_FRONTENDS or host in _get_cups_backends()
+
+
+def canonicalize_queue(queue, resolution=None):
     """Canonicalize local queue names to Athena queue names
 
     If the passed-in queue name is a local print queue that bounces to
@@ -187,17 +1152,22 @@ def canonicalize_queue(queue):
     Athena queue (such as a local printer), then return None
 
     Args:
-      The name of either a local or Athena print queue
+      queue: The name of either a local or Athena print queue
+      resolution: A Resolution to look up the queue's device URI
+        through, if any
 
     Return:
       The name of the canonicalized Athena queue, or None if the queue
       does not refer to an Athena queue.
     """
-    _setup()
-    uri = get_cups_uri(queue)
+    if resolution:
+        uri = resolution.get_cups_uri(queue)
+    else:
+        uri = get_cups_uri(queue)
     if not uri:
         return queue
 
+    import urllib
     proto = rest = hostport = path = host = port = None
     (proto, rest) = urllib.splittype(uri)
     if rest:
@@ -206,7 +1176,7 @@ def canonicalize_queue(queue):
         (host, port) = urllib.splitport(hostport)
     if (proto and host and path and
         proto == 'ipp' and
-        host.lower() in CUPS_FRONTENDS + CUPS_BACKENDS):
+        is_athena_print_server(host)):
         # Canonicalize the queue name to Athena's, in case someone has
         # a local printer called something memorable like 'w20' that
         # points to 'ajax' or something
@@ -219,6 +1189,11 @@ def canonicalize_queue(queue):
 def get_hesiod_print_server(queue):
     """Find the print server for a given queue from Hesiod
 
+    The queue's pcap record is taken from the pcap snapshot if it's
+    there and the snapshot hasn't expired. Otherwise it's looked up
+    live, falling back on an expired snapshot if that finds nothing
+    (e.g. because Hesiod is unreachable).
+
     Args:
       The name of an Athena print queue
 
@@ -226,34 +1201,187 @@ def get_hesiod_print_server(queue):
       The print server the queue is served by, or None if the queue
       does not exist
     """
-    pcap = _hesiod_lookup(queue, 'pcap')
+    pcap = None
+    stale = []
+    snapshot = _get_pcap_snapshot()
+    if snapshot:
+        record = snapshot.get(queue)
+        if record is not None:
+            if snapshot.expired():
+                stale = [record]
+            else:
+                pcap = [record]
+    if pcap is None:
+        pcap = _hesiod_lookup(queue, 'pcap') or stale
     if pcap:
         for field in pcap[0].split(':'):
             if field[0:3] == 'rm=':
                 return field[3:]
 
 
-def is_cups_server(rm):
-    """See if a host is accepting connections on port 631.
+def is_lpd_server(rm):
+    """See if a print server should be queried over LPD.
 
     Args:
       A hostname
 
+    Returns:
+      True if the server is one we talk to with our own LPD client
+    """
+    return bool(rm) and rm.lower() in LPD_SERVERS
+
+
+def is_cups_server(rm, timeout=PROBE_TIMEOUT):
+    """See if a host is accepting connections on port 631.
+
+    Args:
+      rm: A hostname
+      timeout: How long to wait for the connection, in seconds
+
     Returns:
       True if the server is accepting connections, otherwise False
     """
+    import socket
+    span = trace_span('connect', host=rm, port=631)
     try:
         s = socket.socket()
-        s.settimeout(0.3)
+        s.settimeout(timeout)
         s.connect((rm, 631))
         s.close()
 
+        span.set(connected=True)
         return True
     except (socket.error, socket.timeout):
+        span.set(connected=False)
         return False
+    finally:
+        span.finish()
 
 
-def find_queue(queue):
+def probe_cups_servers(hosts, timeout=PROBE_TIMEOUT, stagger=PROBE_STAGGER):
+    """Probe CUPS servers concurrently until one of them answers.
+
+    The hosts are tried in order, each stagger seconds after the one
+    before it (or as soon as the one before it has failed), and
+    probing stops at the first host that accepts a connection. Probes
+    that are still outstanding by then are abandoned.
+
+    Args:
+      hosts: The hostnames to try, most preferred first
+      timeout: How long to wait for each host, in seconds
+      stagger: How long to give each host before starting on the next
+
+    Returns:
+      A dict mapping each host that has been heard from to the time,
+      in seconds, it took to accept a connection, or to None if it
+      didn't
+    """
+    import Queue
+    results = Queue.Queue()
+
+    def probe(host):
+        start = time.time()
+        if is_cups_server(host, timeout):
+            results.put((host, time.time() - start))
+        else:
+            results.put((host, None))
+
+    found = {}
+    started = 0
+    next_start = time.time()
+    # Name lookups aren't covered by the socket timeout, so put a bound
+    # on the whole thing too
+    deadline = next_start + stagger * max(len(hosts) - 1, 0) + timeout
+    while len(found) < len(hosts):
+        now = time.time()
+        if now >= deadline:
+            break
+        if started < len(hosts) and now >= next_start:
+            t = threading.Thread(target=probe, args=(hosts[started],))
+            t.setDaemon(True)
+            t.start()
+            started += 1
+            next_start = now + stagger
+            continue
+
+        if started < len(hosts):
+            wait = min(next_start, deadline) - now
+        else:
+            wait = deadline - now
+        try:
+            host, rtt = results.get(timeout=wait)
+        except Queue.Empty:
+            continue
+        found[host] = rtt
+        if rtt is not None:
+            break
+        # Don't wait out the stagger for a host that's already failed
+        next_start = time.time()
+    return found
+
+
+def select_cups_server(server):
+    """Pick a live CUPS server to send a queue's jobs to.
+
+    The server Hesiod names for the queue is preferred, but if it
+    isn't answering, the first of the CUPS_FRONTENDS that is will do
+    instead; they accept jobs for every Athena queue. Liveness is
+    cached (see LIVENESS_TTL), so in the common case nothing is
+    probed at all.
+
+    Args:
+      server: The print server Hesiod names for the queue
+
+    Returns:
+      The server to use. If no server is answering, or the server is
+      one we talk LPD to, it's server itself.
+    """
+    if not server or is_lpd_server(server):
+        return server
+
+    candidates = [server]
+    for frontend in CUPS_FRONTENDS:
+        if frontend.lower() not in [c.lower() for c in candidates]:
+            candidates.append(frontend)
+
+    known = {}
+    for host in candidates:
+        rtt, state = _liveness_cache.lookup(host.lower())
+        if state == cache.FRESH:
+            known[host] = rtt
+    for host in candidates:
+        if host not in known:
+            break
+        if known[host] is not None:
+            return host
+    else:
+        # Nothing's answering; there's no point in waiting again
+        return server
+
+    span = trace_span('select_server', server=server)
+    try:
+        to_probe = [h for h in candidates
+                    if h not in known or known[h] is not None]
+        found = probe_cups_servers(to_probe)
+        for host, rtt in found.iteritems():
+            if rtt is None:
+                _liveness_cache.store(host.lower(), None,
+                                      ttl=LIVENESS_NEGATIVE_TTL)
+            else:
+                _liveness_cache.store(host.lower(), rtt)
+        known.update(found)
+
+        for host in candidates:
+            if known.get(host) is not None:
+                span.set(selected=host, rtt=known[host])
+                return host
+        span.set(selected=None)
+        return server
+    finally:
+        span.finish()
+
+
+def find_queue(queue, resolution=None):
     """Figure out which printing system to use for a given printer
 
     This function makes a best effort to figure out which server and
@@ -281,26 +1409,96 @@ def find_queue(queue):
     name. Therefore, find_queue includes the translated queue name in
     its return values.
 
+    Resolutions are cached on disk (see debathena.printing.cache), so
+    that repeated invocations don't have to go back to the network.
+
     Args:
       queue: The name of a print queue
+      resolution: The Resolution this lookup is on behalf of, if any,
+        so that anything it has already looked up is reused
 
     Returns:
       A tuple of (printing_system, print_server, queue_name)
 
       printing_system is one of the PRINT_* constants in this module
     """
-    athena_queue = canonicalize_queue(queue)
-    # If a queue isn't an Athena queue, punt straight to the default
-    # CUPS server
-    if not athena_queue:
-        return SYSTEM_CUPS, None, queue
-    queue = athena_queue
+    span = trace_span('find_queue', queue=queue)
+    try:
+        result, state = _cached_resolution(queue)
+        if state == cache.STALE:
+            cache.in_background(_resolve, queue, forked=_refresh_queue)
+        elif state == cache.MISS:
+            result = _resolve(queue, resolution)
+        span.set(server=result[1], canonical=result[2])
+        return result
+    finally:
+        span.finish()
+
 
+def _resolution_context():
+    """Describe what a queue's resolution depends on, besides Hesiod.
+
+    Returns:
+      A list of the CUPS server and the mtimes of its printers.conf
+      and classes.conf
+    """
+    import cups
+    return [cups.getServer(), _conf_mtimes()]
+
+
+def _cached_resolution(queue):
+    """Look up a queue's resolution in the resolution cache.
+
+    Entries resolved against a different CUPS server, or before the
+    local queues last changed, are ignored.
+
+    Returns:
+      A tuple of (resolution, state), as for FileCache.lookup.
+      resolution is a tuple, or None on a MISS.
+    """
+    value, state = _resolution_cache.lookup(queue)
+    if (state == cache.MISS or not isinstance(value, list) or
+        len(value) != 2 or value[1] != _resolution_context()):
+        return None, cache.MISS
+    return tuple(value[0]), state
+
+
+def _resolve(queue, resolution=None):
+    """Resolve a queue, and cache the answer if no lookups failed."""
+    context = _resolution_context()
+    failures = _lookup_failures
+    result = _find_queue(queue, resolution)
+    if _lookup_failures == failures:
+        _resolution_cache.store(queue, [list(result), context])
+    return result
+
+
+def _find_queue(queue, resolution=None):
+    """Resolve a queue without consulting the resolution cache.
+
+    A queue that's never been resolved, and that the local cupsd
+    isn't known to have, is usually an Athena queue, so its print
+    server is looked up in Hesiod while the local cupsd is asked about
+    it, rather than afterwards. If the local cupsd says otherwise,
+    that lookup is wasted (or, for a local queue that bounces to a
+    differently-named Athena queue, done again).
+    """
     # Get rid of any instance on the queue name
     # TODO The purpose of instances is to have different sets of default
     # options. Queues may also have default options on the null
     # instance. Figure out if we need to do anything about them
-    queue = queue.split('/')[0]
+    guess = queue.split('/')[0]
+    speculative = None
+    if (_cached_resolution(queue)[1] == cache.MISS and
+        guess.lower() not in (_known_destinations() or {})):
+        speculative = _in_background(get_hesiod_print_server, guess)
+
+    athena_queue = canonicalize_queue(queue, resolution)
+    # If a queue isn't an Athena queue, punt straight to the default
+    # CUPS server
+    if not athena_queue:
+        return SYSTEM_CUPS, None, queue
+    queue = athena_queue.split('/')[0]
 
     # If we're still here, the queue is definitely an Athena print
     # queue; it was either in the local cupsd pointing to Athena, or the
@@ -308,7 +1506,10 @@ def find_queue(queue):
     # Figure out what Athena thinks the backend server is, and whether
     # that server is running a cupsd; if not, fall back to LPRng
 
-    rm = get_hesiod_print_server(queue)
+    if queue == guess and speculative:
+        rm = speculative()
+    else:
+        rm = get_hesiod_print_server(queue)
     if not rm:
         # In the unlikely event we're wrong about it being an Athena
         # print queue, the local cupsd is good enough
@@ -319,6 +1520,156 @@ def find_queue(queue):
     return SYSTEM_CUPS, rm, queue
 
 
+def _refresh_queue(queue):
+    """Re-resolve a queue and update the resolution cache.
+
+    This runs in a detached child process (see cache.in_background),
+    so it must not share the parent's connection to the local cupsd.
+    """
+    _forget_materialized()
+    _resolve(queue)
+
+
+def _fallback_resolution(queue):
+    """Resolve a queue as well as possible without waiting on anything.
+
+    A cached resolution is used if there is one, even a stale one.
+    Failing that, queues the local cupsd is known to have are left to
+    it, and anything else is assumed to be an Athena queue and sent to
+    the first of the CUPS_FRONTENDS.
+
+    Returns:
+      A tuple of (printing_system, print_server, queue_name), as for
+      find_queue
+    """
+    result, state = _cached_resolution(queue)
+    if result is not None:
+        return result
+
+    if 'destinations' in _materialized:
+        destinations = _destinations or {}
+    else:
+        import cups
+        index, state = _destinations_cache.lookup(cups.getServer())
+        destinations = index and index[1] or {}
+    if queue.lower() in destinations:
+        return SYSTEM_CUPS, None, queue
+    return SYSTEM_CUPS, CUPS_FRONTENDS[0], queue.split('/')[0]
+
+
+def _ask_resolver(name, *args):
+    """Ask the resolver daemon (debathena.printing.resolverd) something.
+
+    The daemon only knows about the default CUPS server, so it isn't
+    asked anything if CUPS_SERVER points somewhere else. Nor is it
+    asked for the default printer, which depends on the caller's
+    environment (see get_default_printer).
+
+    Returns:
+      A tuple of (answered, answer). If answered is False, the
+      question has to be answered in this process.
+    """
+    if os.environ.get('CUPS_SERVER'):
+        return False, None
+    from debathena.printing import resolver
+    span = trace_span('resolver', query=name)
+    try:
+        answer = resolver.query(
+            name, *args, timeout=deadline_timeout(resolver.TIMEOUT))
+    except resolver.ResolverError:
+        span.finish(answered=False)
+        return False, None
+    span.finish(answered=True)
+    return True, answer
+
+
+class Resolution(object):
+    """Everything learned while resolving a single queue name.
+
+    A wrapper makes one Resolution for the queue it was asked about
+    and passes it around, instead of calling find_queue() and
+    get_cups_uri() over and over. Each piece of information is looked
+    up at most once, the first time it's needed.
+
+    Attributes:
+      queue: The queue name as given
+      system: The printing system to use (a SYSTEM_* constant)
+      server: The print server to use for the queue, or None. This is
+        the one Hesiod names, unless it isn't answering (see
+        select_cups_server)
+      canonical: The Athena name of the queue
+      uri: The local cupsd's device URI for the canonical queue, if
+        it has one
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        self._uris = {}
+        self._found = None
+
+    def get_cups_uri(self, printer):
+        """Like get_cups_uri, but remembers the answer.
+
+        The resolver daemon is asked first, if it's running. If the
+        deadline passes first, the printer is taken not to have a URI.
+        """
+        if printer not in self._uris:
+            answered, uri = _ask_resolver('get_cups_uri', printer)
+            if not answered:
+                uri = run_within_deadline(
+                    'get_cups_uri', lambda: get_cups_uri(printer),
+                    self._uri_unknown)
+            self._uris[printer] = uri
+        return self._uris[printer]
+
+    def _uri_unknown(self):
+        # Guessing that there's no URI mustn't end up in the cache
+        _note_lookup_failure()
+        return None
+
+    def find_queue(self):
+        """Like find_queue, but remembers the answer.
+
+        The resolver daemon is asked first, if it's running; its
+        answer includes the resolved queue's URI. Otherwise, the
+        server is checked with select_cups_server. If the deadline
+        passes first, the answer comes from _fallback_resolution.
+        """
+        if self._found is None:
+            answered, answer = _ask_resolver('find_queue', self.queue)
+            if answered:
+                system, server, queue, uri = answer
+                self._uris.setdefault(queue, uri)
+                self._found = system, server, queue
+            else:
+                self._found = run_within_deadline(
+                    'find_queue', self._find_queue,
+                    lambda: _fallback_resolution(self.queue))
+        return self._found
+
+    def _find_queue(self):
+        system, server, queue = find_queue(self.queue, self)
+        if server:
+            server = select_cups_server(server)
+        return system, server, queue
+
+    @property
+    def system(self):
+        return self.find_queue()[0]
+
+    @property
+    def server(self):
+        return self.find_queue()[1]
+
+    @property
+    def canonical(self):
+        return self.find_queue()[2]
+
+    @property
+    def uri(self):
+        return self.get_cups_uri(self.canonical)
+
+
 def dispatch_command(system, command, args):
     """Dispatch a command to a printing-system-specific version of command.
 
@@ -345,17 +1696,46 @@ def dispatch_command(system, command, args):
                           prefix,
                           command,
                           ' '.join(args)))
+        sys.stderr.write('I: Hesiod cache: %(hits)d hits, '
+                         '%(negative_hits)d negative hits, '
+                         '%(misses)d misses\n' % hesiod_cache_stats())
+        trace_event('exec', command='%s%s' % (prefix, command), args=args,
+                    cups_server=os.environ.get('CUPS_SERVER'))
     os.execvp('%s%s' % (prefix, command), [command] + args)
 
 
 __all__ = ['SYSTEM_CUPS', 'SYSTEMS'
            'get_cups_uri',
+           'get_destinations',
+           'invalidate_destinations',
+           'invalidate_queue',
            'parse_args',
            'extract_opt',
            'extract_last_opt',
            'get_default_printer',
+           'get_os_release',
+           'compare_package_version',
+           'get_cluster_info',
+           'local_queues',
+           'is_athena_print_server',
            'canonicalize_queue',
            'get_hesiod_print_server',
+           'hesiod_cache_stats',
+           'trace_span',
+           'trace_event',
            'is_cups_server',
+           'is_lpd_server',
+           'probe_cups_servers',
+           'select_cups_server',
+           'materialized',
+           'ConnectionPool',
+           'get_connection',
+           'put_connection',
+           'ipp_request',
+           'Deadline',
+           'start_deadline',
+           'deadline_timeout',
+           'run_within_deadline',
            'find_queue',
+           'Resolution',
            ]
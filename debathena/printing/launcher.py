@@ -0,0 +1,70 @@
+#!/usr/bin/python
+"""Multi-call launcher for the Debathena printing wrappers.
+
+lpr.debathena, lpq.debathena, lprm.debathena and lp.debathena are all
+links to a single small script, which calls this module to pick the
+wrapper to run from the name it was invoked as. Unlike the launchers
+setuptools generates for console_scripts, it doesn't need to import
+pkg_resources (which scans every installed distribution) before the
+wrapper can start.
+
+The wrapper can also be named explicitly, e.g.:
+
+  debathena-printing lpr -Pajax file.ps
+"""
+
+
+import os
+import sys
+
+
+WRAPPERS = ('lpr', 'lpq', 'lprm', 'lp')
+
+# The suffix the wrappers are installed with, alongside the diverted
+# originals
+SUFFIX = '.debathena'
+
+
+def wrapper_name(arg0):
+    """Work out which wrapper a program name refers to.
+
+    Args:
+      arg0: The name the launcher was invoked as
+
+    Returns:
+      The name of the wrapper, or None if it isn't one
+    """
+    name = os.path.basename(arg0)
+    if name.endswith(SUFFIX):
+        name = name[:-len(SUFFIX)]
+    if name in WRAPPERS:
+        return name
+    return None
+
+
+def _main(args):
+    name = wrapper_name(args[0])
+    if name is None and len(args) > 1:
+        # Invoked as "debathena-printing <wrapper> ..."
+        name = wrapper_name(args[1])
+        args = args[1:]
+    if name is None:
+        sys.stderr.write('Usage: %s {%s} [<args> ...]\n' %
+                         (os.path.basename(args[0]), '|'.join(WRAPPERS)))
+        return 2
+
+    module = __import__('debathena.printing.%s' % name, fromlist=['_main'])
+    return module._main(args)
+
+
+__all__ = ['WRAPPERS',
+           'wrapper_name',
+           ]
+
+
+def main():
+    sys.exit(_main(sys.argv)) # pragma: nocover
+
+
+if __name__ == '__main__':
+    main() # pragma: nocover
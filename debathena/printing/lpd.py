@@ -0,0 +1,235 @@
+"""A client for the Line Printer Daemon protocol (RFC 1179).
+
+Some Athena print servers (such as the Pharos servers) are best
+queried over LPD rather than IPP. This module implements the queue
+state and job removal commands, and streams the server's replies to a
+file as they arrive instead of buffering them.
+
+An LPD server closes the connection after answering each command, so
+a connection can't carry more than one request. Instead, LPDClient
+objects (one per server, from client_for()) remember the server's
+address, so that querying several queues on the same server only
+resolves its name once.
+"""
+
+
+import os
+import re
+import socket
+import StringIO
+import sys
+
+from debathena.printing import common
+
+
+LPD_PORT = 515
+DEFAULT_TIMEOUT = 10
+CHUNK_SIZE = 4096
+
+# RFC 1179 says that clients must connect from a port in this range.
+# Most servers don't check for queries, but some do for removals.
+RESERVED_PORTS = range(721, 732)
+
+PRINT_WAITING_JOBS = '\x01'
+SHORT_QUEUE_STATE = '\x03'
+LONG_QUEUE_STATE = '\x04'
+REMOVE_JOBS = '\x05'
+
+# The lines of a reply to REMOVE_JOBS that aren't errors: BSD lpd's
+# "cfA123host dequeued", and LPRng's "Printer ajax@host:", "checking
+# perms 'cfA123host'" and "dequeued 'cfA123host'"
+REMOVAL_PROGRESS = re.compile(r"dequeued|^Printer \S+:$|^checking perms ")
+
+
+class LPDError(Exception):
+    """An error talking to an LPD server."""
+
+
+class LPDRefused(LPDError):
+    """An LPD server answered, but refused to do what it was asked."""
+
+
+class LPDClient(object):
+    """A client for a single LPD server.
+
+    Args:
+      host: The hostname of the LPD server
+      port: The port the LPD server listens on
+      timeout: How long, in seconds, to wait to connect to the server,
+        and then for each chunk of its reply
+    """
+
+    def __init__(self, host, port=LPD_PORT, timeout=DEFAULT_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._addrinfo = None
+
+    def _resolve(self):
+        if self._addrinfo is None:
+            try:
+                self._addrinfo = socket.getaddrinfo(self.host, self.port,
+                                                    socket.AF_UNSPEC,
+                                                    socket.SOCK_STREAM)
+            except socket.gaierror, e:
+                raise LPDError('Unable to resolve %s: %s' % (self.host, e))
+        return self._addrinfo
+
+    def _bind_reserved(self, s):
+        for port in RESERVED_PORTS:
+            try:
+                s.bind(('', port))
+                return
+            except socket.error:
+                continue
+
+    def _connect(self, reserved=False):
+        span = common.trace_span('connect', host=self.host, port=self.port)
+        try:
+            error = None
+            for family, socktype, proto, _, addr in self._resolve():
+                s = socket.socket(family, socktype, proto)
+                try:
+                    s.settimeout(self.timeout)
+                    if reserved:
+                        self._bind_reserved(s)
+                    s.connect(addr)
+                    span.set(connected=True)
+                    return s
+                except (socket.error, socket.timeout), e:
+                    s.close()
+                    error = e
+            span.set(connected=False, error=str(error))
+            raise LPDError('Unable to connect to %s: %s' % (self.host, error))
+        finally:
+            span.finish()
+
+    def command(self, code, queue, operands=(), out=None, reserved=False):
+        """Send a command to the server, and copy its reply to out.
+
+        Args:
+          code: One of the command codes in this module
+          queue: The name of the queue the command applies to
+          operands: A list of further operands for the command
+          out: A file to write the reply to as it arrives. Defaults
+            to sys.stdout.
+          reserved: Whether to connect from a reserved port, as
+            RFC 1179 requires. This only works as root.
+
+        Returns:
+          The number of bytes of reply received.
+
+        Raises:
+          LPDError if the command couldn't be sent, or no reply was
+          received. An error partway through the reply just ends it
+          early, since part of it has already been written out.
+        """
+        if out is None:
+            out = sys.stdout
+        line = code + ' '.join([queue] + list(operands)) + '\n'
+
+        s = self._connect(reserved)
+        received = 0
+        try:
+            try:
+                s.sendall(line)
+                while True:
+                    chunk = s.recv(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    out.write(chunk)
+                    out.flush()
+                    received += len(chunk)
+            except (socket.error, socket.timeout), e:
+                if not received:
+                    raise LPDError('Error talking to %s: %s' % (self.host, e))
+        finally:
+            s.close()
+        return received
+
+    def short_queue_state(self, queue, jobs=(), out=None):
+        """Write the short form of a queue's state to out.
+
+        Args:
+          queue: The name of the queue
+          jobs: An optional list of user names or job numbers to
+            limit the listing to
+          out: A file to write the listing to (default sys.stdout)
+        """
+        return self.command(SHORT_QUEUE_STATE, queue, jobs, out)
+
+    def long_queue_state(self, queue, jobs=(), out=None):
+        """Write the long form of a queue's state to out.
+
+        Args are the same as for short_queue_state.
+        """
+        return self.command(LONG_QUEUE_STATE, queue, jobs, out)
+
+    def remove_jobs(self, queue, agent, jobs=(), out=None):
+        """Remove jobs from a queue.
+
+        RFC 1179 servers answer a removal with nothing at all, or with
+        progress messages like "... dequeued" for each file removed
+        (see REMOVAL_PROGRESS); anything else is an error message. Only root can connect from a reserved port,
+        as RFC 1179 requires, and servers that check will refuse
+        removals from anyone else.
+
+        Args:
+          queue: The name of the queue
+          agent: The name of the user requesting the removal
+          jobs: A list of user names or job numbers to remove. If
+            empty, the server removes the agent's active job.
+          out: A file to write the server's reply to (default
+            sys.stdout)
+
+        Returns:
+          The number of bytes of reply received.
+
+        Raises:
+          LPDRefused if the server answered with an error, and
+          LPDError if it couldn't be asked.
+        """
+        if out is None:
+            out = sys.stdout
+        reserved = os.geteuid() == 0
+        reply = StringIO.StringIO()
+        received = self.command(REMOVE_JOBS, queue, [agent] + list(jobs),
+                                reply, reserved=reserved)
+        out.write(reply.getvalue())
+        out.flush()
+
+        errors = [line.strip() for line in reply.getvalue().splitlines()
+                  if line.strip() and
+                  not REMOVAL_PROGRESS.search(line.strip())]
+        if errors:
+            message = '%s refused to remove the jobs: %s' % (
+                self.host, ' '.join(errors))
+            if not reserved:
+                message += (' (not running as root, so the request '
+                            "couldn't come from a reserved port)")
+            raise LPDRefused(message)
+        return received
+
+
+_clients = {}
+
+
+def client_for(host, port=LPD_PORT, timeout=DEFAULT_TIMEOUT):
+    """Return the shared LPDClient for a server, creating it if needed."""
+    key = (host.lower(), port)
+    if key not in _clients:
+        _clients[key] = LPDClient(host, port, timeout)
+    _clients[key].timeout = timeout
+    return _clients[key]
+
+
+__all__ = ['LPDClient',
+           'LPDError',
+           'LPDRefused',
+           'client_for',
+           'LPD_PORT',
+           'PRINT_WAITING_JOBS',
+           'SHORT_QUEUE_STATE',
+           'LONG_QUEUE_STATE',
+           'REMOVE_JOBS',
+           ]
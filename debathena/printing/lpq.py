@@ -7,9 +7,13 @@ for CUPS or LPRng and sends it off in the right direction
 
 
 import os
-import socket
-import subprocess
+import StringIO
 import sys
+import threading
+import time
+
+# cups and the LPD client are imported where they're used, since most
+# invocations just exec cups-lpq
 
 from debathena.printing import common
 from debathena.printing import simple
@@ -23,30 +27,169 @@ opts = (
 queue_opt = '-P'
 
 
+# How long to wait for each queue when querying several at once
+QUEUE_DEADLINE = 10
+
+JOB_ATTRIBUTES = ['job-id', 'job-name', 'job-originating-user-name',
+                  'job-k-octets', 'job-state', 'job-printer-uri']
+IPP_JOB_PROCESSING = 5
+
+
 def cups_version_is_below_1_4():
     """
     On Debian-based systems, return whether cupsys-bsd is older than 1.4.
 
     On non-Debian-based systems, return False unconditionally.
     """
-    try:
-        version = subprocess.Popen(
-                      ["dpkg-query", "-W", "-f", "${Version}",
-                       "cups-bsd"], stdout=subprocess.PIPE).communicate()[0]
-        compare = subprocess.call(
-                      ["dpkg", "--compare-versions",
-                       version,
-                       "lt-nl", "1.4"])
-        return compare == 0
-    except OSError:
-        # Assume the current version of CUPS is fine
-        return False
-
- 
+    return common.compare_package_version('cups-bsd', 'lt-nl', '1.4')
+
+
+def _ordinal(n):
+    if n % 100 in (11, 12, 13):
+        return '%dth' % n
+    return '%d%s' % (n, {1: 'st', 2: 'nd', 3: 'rd'}.get(n % 10, 'th'))
+
+
+def format_jobs(queue, jobs):
+    """Format a list of IPP jobs the way cups-lpq does.
+
+    Args:
+      queue: The name of the queue the jobs are on
+      jobs: A dict mapping job IDs to their IPP attributes
+
+    Returns:
+      The queue listing, as a string
+    """
+    if not jobs:
+        return 'no entries\n'
+
+    lines = ['Rank    Owner   Job     File(s)                         Total Size\n']
+    rank = 0
+    for job_id in sorted(jobs):
+        attrs = jobs[job_id]
+        if attrs.get('job-state') == IPP_JOB_PROCESSING:
+            position = 'active'
+        else:
+            rank += 1
+            position = _ordinal(rank)
+        lines.append('%-7s %-7.7s %-7d %-31.31s %d bytes\n' %
+                     (position,
+                      attrs.get('job-originating-user-name', 'unknown'),
+                      job_id,
+                      attrs.get('job-name', 'unknown'),
+                      attrs.get('job-k-octets', 0) * 1024))
+    return ''.join(lines)
+
+
+def _get_jobs(server, queue):
+    """Fetch the active jobs on a queue over IPP."""
+    jobs = common.ipp_request(server, 'getJobs',
+                              requested_attributes=JOB_ATTRIBUTES)
+    suffix = '/' + queue
+    return dict((job_id, attrs) for job_id, attrs in jobs.iteritems()
+                if attrs.get('job-printer-uri', '').endswith(suffix))
+
+
+def query_queue(queue, long_format=False, timeout=QUEUE_DEADLINE):
+    """Resolve a queue and fetch its state.
+
+    LPD servers are asked over LPD; everything else is asked over IPP.
+
+    Args:
+      queue: The name of a print queue
+      long_format: Whether to ask for the long form of the queue
+        state. Only LPD servers have one.
+      timeout: The LPD socket timeout, in seconds
+
+    Returns:
+      The queue listing, as a string
+    """
+    system, server, queue = common.Resolution(queue).find_queue()
+    if server and (common.is_lpd_server(server) or
+                   cups_version_is_below_1_4()):
+        from debathena.printing import lpd
+        out = StringIO.StringIO()
+        client = lpd.client_for(server, timeout=timeout)
+        if long_format:
+            client.long_queue_state(queue, out=out)
+        else:
+            client.short_queue_state(queue, out=out)
+        return out.getvalue()
+    return format_jobs(queue, _get_jobs(server, queue))
+
+
+class _QueueQuery(threading.Thread):
+    def __init__(self, queue, long_format, timeout):
+        super(_QueueQuery, self).__init__()
+        self.daemon = True
+        self.queue = queue
+        self.long_format = long_format
+        self.timeout = timeout
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = query_queue(self.queue, self.long_format,
+                                      self.timeout)
+        except Exception, e:
+            self.error = e
+
+
+def query_queues(queues, long_format=False, deadline=QUEUE_DEADLINE,
+                 out=None):
+    """Query several queues at once, and print their states.
+
+    Every queue is resolved and queried in its own thread, so the
+    whole thing takes about as long as the slowest queue. The results
+    are printed in the order the queues were given.
+
+    Args:
+      queues: A list of queue names
+      long_format: Whether to ask for the long form of the queue state
+      deadline: How long, in seconds, to wait for each queue
+      out: A file to print the results to (default sys.stdout)
+
+    Returns:
+      0 if every queue was queried successfully, 1 otherwise
+    """
+    if out is None:
+        out = sys.stdout
+    queries = []
+    for q in queues:
+        if q not in [query.queue for query in queries]:
+            queries.append(_QueueQuery(q, long_format, deadline))
+    for query in queries:
+        query.start()
+
+    status = 0
+    end = time.time() + deadline
+    for query in queries:
+        query.join(max(0, end - time.time()))
+        out.write('%s:\n' % query.queue)
+        if query.isAlive():
+            out.write('Timed out after %d seconds\n' % deadline)
+            status = 1
+        elif query.error is not None:
+            out.write('Error: %s\n' % (query.error,))
+            status = 1
+        else:
+            out.write(query.result)
+        out.write('\n')
+        out.flush()
+    return status
+
+
 def _main(args):
     args.pop(0)
+    common.start_deadline()
 
-    queue = common.get_default_printer()
+    # --all queries every queue configured in the local cupsd
+    all_queues = '--all' in args
+    if all_queues:
+        args = [a for a in args if a != '--all']
+
+    queue = None
     try:
         argstyle, options, arguments = common.parse_args(args, opts)
 
@@ -55,6 +198,18 @@ def _main(args):
         if queue_args:
             queue = queue_args[-1][-1]
 
+        if all_queues or len(queue_args) > 1:
+            # Several queues were asked for, so query them all at once
+            # ourselves instead of handing off to cups-lpq
+            long_options, options = common.extract_opt(options, '-l')
+            if options or arguments:
+                common.error(2, "\nOnly the -P and -l options can be used "
+                             "when listing more than one queue.\n\n")
+            queues = [v for o, v in queue_args]
+            if all_queues:
+                queues += common.local_queues()
+            return query_queues(queues, bool(long_options))
+
         # Now that we've sliced up the arguments, put them back
         # together
         args = [o + a for o, a in options] + arguments
@@ -63,6 +218,11 @@ def _main(args):
         # go with the default queue
         pass
 
+    if queue is None:
+        # Only ask for the default printer if no queue was given,
+        # since finding it can take a round trip to the local cupsd
+        queue = common.get_default_printer()
+
     if not queue:
         # We tried and couldn't figure it out, so not our problem
         common.error(2, ("\n"
@@ -70,9 +230,10 @@ def _main(args):
                          "default printer via e.g. System | Administration | Printing.\n"
                          "\n" % queue_opt))
 
-    system, server, queue = common.find_queue(queue)
+    resolution = common.Resolution(queue)
+    system, server, queue = resolution.find_queue()
 
-    if server == None and common.get_cups_uri(queue) == None:
+    if server == None and resolution.uri == None:
         # if there's no Hesiod server and no local queue, 
         # tell the user they're wrong
         # But let it fall through in case the user is doing 
@@ -88,18 +249,19 @@ def _main(args):
         # ourselves since that works
         # Also, a hack to continue to support "lpq -Pbw" until we have
         # a better solution for querying the CUPS queue
-        if cups_version_is_below_1_4() or (server == 'PHAROS-PRODP1.MIT.EDU'):
+        if cups_version_is_below_1_4() or common.is_lpd_server(server):
+            from debathena.printing import lpd
             try:
-                s = socket.socket()
-                s.settimeout(10)
-                s.connect((server, 515))
-                s.send("\x03" + queue + "\n")
-                print s.makefile().read()
+                # If the deadline has passed, LPD gets no time at all,
+                # and we fall back on cups-lpq
+                timeout = common.deadline_timeout(lpd.DEFAULT_TIMEOUT)
+                client = lpd.client_for(server, timeout=timeout)
+                client.short_queue_state(queue)
                 return 0
-            except (socket.error, socket.timeout):
+            except lpd.LPDError:
                 # Oh well.
                 pass
-        
+
     args.insert(0, '%s%s' % (queue_opt, queue))
     if server:
         os.environ['CUPS_SERVER'] = server
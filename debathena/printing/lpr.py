@@ -8,8 +8,11 @@ for CUPS or LPRng and sends it off in the right direction
 
 import getopt
 import os
-import shlex
 import sys
+import threading
+
+# cups, and the modules only --batch needs, are imported where they're
+# used, to keep the common case of printing one file quick to start
 
 from debathena.printing import common
 
@@ -18,11 +21,190 @@ opts = {
     common.SYSTEM_CUPS: 'EH:U:P:#:hlmo:pqrC:J:T:',
 }
 
+
+# How many jobs to submit at once in --batch mode
+BATCH_WORKERS = 4
+
+
+class ManifestError(Exception):
+    """A line of a batch manifest couldn't be understood."""
+
+
+def parse_manifest(f):
+    """Parse a batch manifest.
+
+    Each non-blank line of a manifest is of the form
+
+      queue file [option=value ...]
+
+    where the options are CUPS job options (as for lpr -o). An option
+    with no value is set to 'true'. Quoting works as in the shell, and
+    lines starting with # are ignored.
+
+    Args:
+      f: A file object to read the manifest from
+
+    Returns:
+      A list of (line_number, queue, filename, options) tuples, where
+      options is a dict of CUPS options. Lines that can't be parsed
+      have a ManifestError in place of the queue.
+    """
+    import shlex
+    entries = []
+    for number, line in enumerate(f):
+        number += 1
+        try:
+            fields = shlex.split(line, comments=True)
+        except ValueError, e:
+            entries.append((number, ManifestError(str(e)), None, None))
+            continue
+        if not fields:
+            continue
+        if len(fields) < 2:
+            entries.append((number, ManifestError('expected a queue and a file'),
+                            None, None))
+            continue
+        options = {}
+        for option in fields[2:]:
+            if '=' in option:
+                k, v = option.split('=', 1)
+            else:
+                k, v = option, 'true'
+            options[k] = v
+        entries.append((number, fields[0], fields[1], options))
+    return entries
+
+
+def notification_options():
+    """Return the job options that ask for a notification when it's done.
+
+    lpr passes -m through to the CUPS lpr when ATHENA_USER is set;
+    this is the option that -m turns into, for jobs submitted over
+    IPP directly.
+
+    Returns:
+      A dict of CUPS options, which is empty if ATHENA_USER isn't set
+    """
+    import socket
+    user = os.environ.get('ATHENA_USER')
+    if not user:
+        return {}
+    return {'notify-recipient-uri': 'mailto:%s@%s' % (user,
+                                                      socket.getfqdn())}
+
+
+def submit_batch(entries, workers=BATCH_WORKERS, out=None):
+    """Submit a batch of print jobs.
+
+    Each distinct queue is resolved once (as for a single job, see
+    common.Resolution), and jobs are sent directly
+    to each queue's print server over IPP, reusing connections from
+    the pool in common. Up to workers jobs are submitted at a time. A
+    status line is printed for each job as it finishes.
+
+    As when printing a single file, jobs submitted for an Athena user
+    ask for a notification when they finish (see
+    notification_options).
+
+    Args:
+      entries: A list of entries, as returned by parse_manifest
+      workers: The maximum number of jobs to submit at once
+      out: A file to print status lines to (default sys.stdout)
+
+    Returns:
+      0 if every job was submitted, 1 otherwise
+    """
+    import cups
+    import Queue
+    if out is None:
+        out = sys.stdout
+    user = os.environ.get('ATHENA_USER')
+    notification = notification_options()
+
+    out_lock = threading.Lock()
+    failures = []
+    def report(number, filename, status, failed=False):
+        out_lock.acquire()
+        try:
+            if failed:
+                failures.append(number)
+            out.write('%d: %s: %s\n' % (number, filename, status))
+            out.flush()
+        finally:
+            out_lock.release()
+
+    resolved = {}
+    jobs = Queue.Queue()
+    for number, queue, filename, options in entries:
+        if isinstance(queue, ManifestError):
+            report(number, '-', 'error: %s' % queue, True)
+            continue
+        if queue not in resolved:
+            resolved[queue] = common.Resolution(queue).find_queue()
+        system, server, athena_queue = resolved[queue]
+        job_options = {}
+        if system == common.SYSTEM_CUPS:
+            job_options.update(notification)
+        job_options.update(options)
+        jobs.put((number, server, athena_queue, filename, job_options))
+
+    def work():
+        while True:
+            try:
+                number, server, queue, filename, options = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                if user:
+                    # libcups remembers the user per thread
+                    cups.setUser(user)
+                job_id = common.ipp_request(server, 'printFile', queue,
+                                            filename,
+                                            os.path.basename(filename),
+                                            options)
+                report(number, filename, '%s-%d' % (queue, job_id))
+            except Exception, e:
+                # Whatever went wrong (e.g. an unreadable file), the
+                # rest of the batch still goes out
+                report(number, filename, 'error: %s' % (e,), True)
+
+    threads = [threading.Thread(target=work)
+               for i in range(min(workers, jobs.qsize()))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return failures and 1 or 0
+
+
+def _batch(manifest):
+    if manifest == '-':
+        return submit_batch(parse_manifest(sys.stdin))
+    try:
+        f = open(manifest)
+    except IOError, e:
+        common.error(2, '\nUnable to read batch manifest %s: %s\n\n' %
+                     (manifest, e.strerror))
+    try:
+        entries = parse_manifest(f)
+    finally:
+        f.close()
+    return submit_batch(entries)
+
+
 def _main(args):
     args.pop(0)
+    common.start_deadline()
+
+    if args and args[0] == '--batch':
+        if len(args) != 2:
+            common.error(2, '\nUsage: lpr --batch <manifest>\n\n')
+        return _batch(args[1])
 
-    queue = common.get_default_printer()
+    queue = None
     argstyle = None
+    options = None
     try:
         # common.SYSTEMS is a canonical order of preference for
         # printing systems, and order matters to common.parse_args
@@ -34,21 +216,16 @@ def _main(args):
         queue_args, options = common.extract_opt(options, '-P')
         if queue_args:
             queue = queue_args[-1][-1]
-
-        # Deal with zephyr notifications
-        if os.environ.get('ATHENA_USER'):
-            system = common.find_queue(queue)[0]
-            if system == common.SYSTEM_CUPS:
-                options.append(('-m', ''))
-
-        # Now that we've sliced up the arguments, put them back
-        # together
-        args = [o + a for o, a in options] + arguments
     except ValueError:
         # parse_args returned None, so we learned nothing. We'll just
         # go with the default queue
         pass
 
+    if queue is None:
+        # Only ask for the default printer if no queue was given,
+        # since finding it can take a round trip to the local cupsd
+        queue = common.get_default_printer()
+
     if not queue:
         # We tried and couldn't figure it out, so not our problem
         common.error(2, ("\n"
@@ -56,9 +233,20 @@ def _main(args):
                          "default printer via e.g. System | Administration | Printing.\n"
                          "\n"))
 
-    system, server, queue = common.find_queue(queue)
+    resolution = common.Resolution(queue)
+    if options is not None:
+        # Deal with zephyr notifications, for the default queue too
+        if os.environ.get('ATHENA_USER'):
+            if resolution.system == common.SYSTEM_CUPS:
+                options.append(('-m', ''))
+
+        # Now that we've sliced up the arguments, put them back
+        # together
+        args = [o + a for o, a in options] + arguments
+
+    system, server, queue = resolution.find_queue()
 
-    if server == None and common.get_cups_uri(queue) == None:
+    if server == None and resolution.uri == None:
         # if there's no Hesiod server and no local queue, 
         # tell the user they're wrong
         # But let it fall through in case the user is doing 
@@ -0,0 +1,207 @@
+#!/usr/bin/python
+"""Invalidate cached queue information when the local cupsd changes.
+
+The wrappers cache the local cupsd's destinations, and how each queue
+name resolves (see debathena.printing.common). The destination index
+already notices edits to printers.conf, but a queue that's added,
+changed or removed over IPP can leave a stale resolution behind until
+it expires.
+
+A Watcher holds an IPP subscription to the local cupsd for
+printer-added, printer-modified and printer-deleted events, and polls
+it (the "ippget" pull method, so that nothing has to listen for
+cupsd). Whenever a queue changes, it forgets what's cached about that
+queue, in this process and on disk.
+
+It can run in a thread of a long-running process:
+
+  watcher = notify.Watcher()
+  watcher.start()
+
+or on its own, for the user whose caches it should keep fresh:
+
+  python -m debathena.printing.notify
+"""
+
+
+import sys
+import threading
+import time
+
+from debathena.printing import common
+
+
+EVENTS = ['printer-added', 'printer-modified', 'printer-deleted']
+
+# How often to ask the local cupsd for new events, in seconds
+POLL_INTERVAL = 1.0
+# How long each subscription lasts; it's renewed once it's half over
+LEASE_DURATION = 60 * 60
+
+
+class Watcher(object):
+    """Keeps the wrappers' caches in step with the local cupsd.
+
+    If the subscription is lost (for instance, because cupsd was
+    restarted), events may have been missed, so everything is
+    forgotten and a new subscription is made.
+
+    Args:
+      interval: How often to poll for events, in seconds
+      lease: How long to ask cupsd to keep the subscription, in seconds
+    """
+
+    def __init__(self, interval=POLL_INTERVAL, lease=LEASE_DURATION):
+        self.interval = interval
+        self.lease = lease
+        self.subscription = None
+        self._sequence = 1
+        self._renew_at = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def subscribe(self, now=None):
+        """Subscribe to queue changes in the local cupsd.
+
+        Anything cached before now may already be out of date, so it's
+        all forgotten.
+
+        Raises:
+          cups.IPPError, cups.HTTPError or RuntimeError if cupsd can't
+          be reached, or refuses the subscription
+        """
+        if now is None:
+            now = time.time()
+        self.subscription = common.ipp_request(
+            None, 'createSubscription', '/', events=EVENTS,
+            lease_duration=self.lease)
+        self._sequence = 1
+        self._renew_at = now + self.lease / 2
+        common.invalidate_queue()
+
+    def _renew(self, now):
+        common.ipp_request(None, 'renewSubscription', self.subscription,
+                           lease_duration=self.lease)
+        self._renew_at = now + self.lease / 2
+
+    def poll(self, now=None):
+        """Handle any events since the last poll.
+
+        A subscription is made or renewed if needed.
+
+        Returns:
+          A sorted list of the queues that changed
+
+        Raises:
+          cups.IPPError, cups.HTTPError or RuntimeError if cupsd can't
+          be reached; the subscription is dropped, and made again on
+          the next poll
+        """
+        import cups
+        if now is None:
+            now = time.time()
+        try:
+            if self.subscription is None:
+                self.subscribe(now)
+            elif now >= self._renew_at:
+                self._renew(now)
+            result = common.ipp_request(None, 'getNotifications',
+                                        [self.subscription],
+                                        sequence_numbers=[self._sequence])
+        except (cups.IPPError, cups.HTTPError, RuntimeError):
+            self.subscription = None
+            raise
+
+        changed = set()
+        for event in result.get('events', []):
+            if event.get('notify-subscription-id') not in (
+                    None, self.subscription):
+                continue
+            sequence = event.get('notify-sequence-number', 0)
+            if sequence < self._sequence:
+                continue
+            self._sequence = sequence + 1
+            changed.add(event.get('printer-name'))
+
+        if None in changed:
+            # We can't tell which queue changed
+            common.invalidate_queue()
+        else:
+            for queue in changed:
+                common.invalidate_queue(queue)
+        changed = sorted(filter(None, changed))
+        if changed:
+            common.trace_event('notify', queues=changed)
+        return changed
+
+    def cancel(self):
+        """Cancel the subscription, if there is one."""
+        import cups
+        if self.subscription is None:
+            return
+        try:
+            common.ipp_request(None, 'cancelSubscription', self.subscription)
+        except (cups.IPPError, cups.HTTPError, RuntimeError):
+            pass
+        self.subscription = None
+
+    def run(self):
+        """Poll for events until stop() is called."""
+        import cups
+        try:
+            while not self._stop.isSet():
+                try:
+                    self.poll()
+                except (cups.IPPError, cups.HTTPError, RuntimeError):
+                    pass
+                self._stop.wait(self.interval)
+        finally:
+            self.cancel()
+
+    def start(self):
+        """Poll for events in a background thread."""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop polling, and wait for the background thread to finish."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+
+def parser():
+    import optparse
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option('-i', '--interval', type='float', default=POLL_INTERVAL,
+                      help="Poll for events every SECONDS "
+                      "(default %default)", metavar='SECONDS')
+    return parser
+
+
+def _main(args):
+    options, rest = parser().parse_args(args[1:])
+    if rest:
+        parser().error('unexpected arguments')
+    watcher = Watcher(interval=options.interval)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+__all__ = ['EVENTS',
+           'Watcher',
+           ]
+
+
+def main():
+    sys.exit(_main(sys.argv)) # pragma: nocover
+
+
+if __name__ == '__main__':
+    main() # pragma: nocover
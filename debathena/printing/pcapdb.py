@@ -0,0 +1,292 @@
+#!/usr/bin/python
+"""Precompiled snapshots of the Athena queues' Hesiod pcap records.
+
+Finding an Athena queue's print server normally takes a live Hesiod
+lookup. A snapshot holds the pcap records of all the known Athena
+queues in a compact binary file, which is memory-mapped and searched
+in place, so that a lookup doesn't need the network (or even to read
+the whole file).
+
+The file is laid out like this (all integers big-endian):
+
+  header:  8-byte magic, build time and expiry time (as doubles), and
+           the number of records (uint32)
+  index:   one entry per record, sorted by queue name, each giving the
+           offset and length of the queue name and of its pcap record
+           (four uint32s)
+  data:    the queue names and pcap records themselves
+
+Queue names are stored lower-cased, since Hesiod names are
+case-insensitive.
+
+Snapshots are built by running this module, e.g.:
+
+  python -m debathena.printing.pcapdb --server printers.mit.edu
+"""
+
+
+import mmap
+import os
+import struct
+import sys
+import time
+
+
+MAGIC = 'DAPCAP\x00\x01'
+HEADER = struct.Struct('>8sddI')
+ENTRY = struct.Struct('>IIII')
+
+SNAPSHOT_PATH = '/var/lib/debathena-printing/pcap.db'
+SNAPSHOT_ENV = 'DEBATHENA_PCAP_SNAPSHOT'
+# How long a snapshot is trusted over live Hesiod lookups
+DEFAULT_TTL = 3 * 24 * 60 * 60
+
+
+class SnapshotError(Exception):
+    """A snapshot file is missing or corrupt."""
+
+
+class Snapshot(object):
+    """A memory-mapped pcap snapshot.
+
+    Args:
+      path: The snapshot file
+
+    Raises:
+      SnapshotError if the file can't be read, or isn't a snapshot
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            f = open(path, 'rb')
+        except IOError, e:
+            raise SnapshotError('Unable to open %s: %s' % (path, e.strerror))
+        try:
+            size = os.fstat(f.fileno()).st_size
+            if size < HEADER.size:
+                raise SnapshotError('%s is truncated' % path)
+            try:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (EnvironmentError, ValueError), e:
+                raise SnapshotError('Unable to map %s: %s' % (path, e))
+        finally:
+            f.close()
+
+        magic, self.built, self.expires, self.count = \
+            HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            self.close()
+            raise SnapshotError('%s is not a pcap snapshot' % path)
+        if size < HEADER.size + self.count * ENTRY.size:
+            self.close()
+            raise SnapshotError('%s is truncated' % path)
+
+    def _entry(self, i):
+        key_off, key_len, value_off, value_len = \
+            ENTRY.unpack_from(self._map, HEADER.size + i * ENTRY.size)
+        return key_off, key_len, value_off, value_len
+
+    def get(self, queue):
+        """Look up a queue's pcap record.
+
+        Returns:
+          The pcap record, or None if the queue isn't in the snapshot
+        """
+        key = queue.lower()
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key_off, key_len, value_off, value_len = self._entry(mid)
+            found = self._map[key_off:key_off + key_len]
+            if found < key:
+                lo = mid + 1
+            elif found > key:
+                hi = mid
+            else:
+                return self._map[value_off:value_off + value_len]
+        return None
+
+    def items(self):
+        """List the (queue, pcap record) pairs in the snapshot."""
+        items = []
+        for i in xrange(self.count):
+            key_off, key_len, value_off, value_len = self._entry(i)
+            items.append((self._map[key_off:key_off + key_len],
+                          self._map[value_off:value_off + value_len]))
+        return items
+
+    def expired(self, now=None):
+        """Return whether the snapshot is too old to be trusted."""
+        if now is None:
+            now = time.time()
+        return now >= self.expires
+
+    def close(self):
+        self._map.close()
+
+
+def snapshot_path():
+    """Find the snapshot file.
+
+    It can be overridden with the DEBATHENA_PCAP_SNAPSHOT environment
+    variable; setting it to the empty string disables the snapshot.
+
+    Returns:
+      The path to the snapshot, or None if it's disabled
+    """
+    if SNAPSHOT_ENV in os.environ:
+        return os.environ[SNAPSHOT_ENV] or None
+    return SNAPSHOT_PATH
+
+
+def open_snapshot(path=None):
+    """Open the pcap snapshot, if there is a usable one.
+
+    Returns:
+      A Snapshot, or None
+    """
+    if path is None:
+        path = snapshot_path()
+    if not path:
+        return None
+    try:
+        return Snapshot(path)
+    except SnapshotError:
+        return None
+
+
+def write(path, records, ttl=DEFAULT_TTL, now=None):
+    """Write a pcap snapshot.
+
+    The snapshot is written to a temporary file and renamed into
+    place, so that readers never see a partial one.
+
+    Args:
+      path: Where to write the snapshot
+      records: A dict mapping queue names to their pcap records
+      ttl: How long, in seconds, the snapshot should be trusted
+      now: The time the snapshot was built (default now)
+    """
+    if now is None:
+        now = time.time()
+    items = sorted((queue.lower(), record)
+                   for queue, record in records.iteritems())
+
+    index = []
+    data = []
+    offset = HEADER.size + len(items) * ENTRY.size
+    for queue, record in items:
+        index.append(ENTRY.pack(offset, len(queue),
+                                offset + len(queue), len(record)))
+        data.append(queue)
+        data.append(record)
+        offset += len(queue) + len(record)
+
+    import tempfile
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory)
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write(HEADER.pack(MAGIC, now, now + ttl, len(items)))
+            f.write(''.join(index))
+            f.write(''.join(data))
+        finally:
+            f.close()
+        os.chmod(tmp, 0644)
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+def list_queues(server):
+    """List the queues and classes on a CUPS server."""
+    import cups
+    conn = cups.Connection(host=server)
+    return sorted(set(conn.getPrinters()) | set(conn.getClasses()))
+
+
+def fetch(queues):
+    """Look up the pcap records for a list of queues in Hesiod.
+
+    Returns:
+      A dict mapping queue names to pcap records, for the queues that
+      have one
+    """
+    import hesiod
+    records = {}
+    for queue in queues:
+        try:
+            results = hesiod.Lookup(queue, 'pcap').results
+        except IOError:
+            continue
+        if results:
+            records[queue] = results[0]
+    return records
+
+
+def parser():
+    import optparse
+    parser = optparse.OptionParser(
+        usage="usage: %prog [options] [<queue> ...]")
+    parser.add_option('-o', '--output', default=SNAPSHOT_PATH,
+                      help="Write the snapshot to FILE (default %default)",
+                      metavar='FILE')
+    parser.add_option('-s', '--server', action='append', default=[],
+                      help="Include every queue on the CUPS server HOST",
+                      metavar='HOST')
+    parser.add_option('-f', '--file',
+                      help="Include the queues listed in FILE, one per line",
+                      metavar='FILE')
+    parser.add_option('--ttl', type='int', default=DEFAULT_TTL,
+                      help="Trust the snapshot for SECONDS "
+                      "(default %default)", metavar='SECONDS')
+    return parser
+
+
+def _main(args):
+    options, queues = parser().parse_args(args[1:])
+    queues = list(queues)
+    if options.file:
+        f = open(options.file)
+        try:
+            queues += [l.strip() for l in f
+                       if l.strip() and not l.startswith('#')]
+        finally:
+            f.close()
+    for server in options.server:
+        queues += list_queues(server)
+    if not queues:
+        parser().error('no queues given')
+
+    directory = os.path.dirname(os.path.abspath(options.output))
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0755)
+
+    records = fetch(queues)
+    if not records:
+        # Most likely Hesiod is down, in which case the old snapshot
+        # is better than an empty one
+        sys.stderr.write('No pcap records found; not writing a snapshot\n')
+        return 1
+    write(options.output, records, options.ttl)
+    return 0
+
+
+__all__ = ['Snapshot',
+           'SnapshotError',
+           'open_snapshot',
+           'snapshot_path',
+           'write',
+           'fetch',
+           ]
+
+
+def main():
+    sys.exit(_main(sys.argv)) # pragma: nocover
+
+
+if __name__ == '__main__':
+    main() # pragma: nocover
@@ -0,0 +1,209 @@
+"""A local cache of PPDs downloaded from the Athena print servers.
+
+Installing an Athena queue locally means downloading its PPD, and most
+Athena queues share a handful of printer models. PPDCache keeps the
+PPDs it has downloaded, stored by the SHA-256 hash of their contents
+so that identical PPDs are only stored once. An index records, for
+each queue, which PPD it uses along with the remote make-and-model and
+modification time, so that a later download can be a conditional
+request that usually comes back "not modified". A second index records
+which PPD was last installed on each local queue, since cupsd rewrites
+the PPDs it's given.
+
+The cache is bounded in size; the least recently used PPDs are
+evicted first.
+"""
+
+
+import errno
+import hashlib
+import os
+import shutil
+import tempfile
+
+import cups
+
+from debathena.printing import cache
+
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+# Entries in the index don't expire on their own, since every use
+# checks them against the server
+INDEX_TTL = 365 * 24 * 60 * 60
+
+
+def file_hash(path):
+    """Return the hex SHA-256 hash of a file's contents."""
+    h = hashlib.sha256()
+    f = open(path, 'rb')
+    try:
+        while True:
+            chunk = f.read(65536)
+            if not chunk:
+                break
+            h.update(chunk)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+
+class PPDCache(object):
+    """A content-addressed, size-bounded cache of PPD files.
+
+    Args:
+      directory: Where to keep the cache
+      max_bytes: The most space the cached PPDs may take up
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.objects = os.path.join(directory, 'objects')
+        try:
+            os.makedirs(self.objects, 0755)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.index = cache.FileCache('index', INDEX_TTL, directory=directory)
+        self.installs = cache.FileCache('installed', INDEX_TTL,
+                                        directory=directory)
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects, '%s.ppd' % digest)
+
+    def _touch(self, path):
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    def _cached(self, queue, make_and_model):
+        """Find the cached PPD entry for a queue, if it's usable."""
+        entry, state = self.index.lookup(queue)
+        if state == cache.MISS:
+            return None
+        if entry.get('make-and-model') != make_and_model:
+            return None
+        # Make sure the cached copy is still what was downloaded,
+        # since it's about to be installed into cupsd
+        try:
+            if file_hash(self._object_path(entry['sha256'])) != entry['sha256']:
+                return None
+        except IOError:
+            return None
+        return entry
+
+    def add(self, queue, filename, make_and_model=None, modtime=0):
+        """Move a downloaded PPD into the cache.
+
+        Args:
+          queue: The queue the PPD is for
+          filename: The downloaded PPD. It's moved into the cache (or
+            deleted, if the cache already has a copy).
+          make_and_model: The queue's printer-make-and-model
+          modtime: The PPD's modification time on the server
+
+        Returns:
+          The path to the cached PPD
+        """
+        digest = file_hash(filename)
+        path = self._object_path(digest)
+        if os.path.exists(path) and file_hash(path) == digest:
+            os.unlink(filename)
+            self._touch(path)
+        else:
+            fd, tmp = tempfile.mkstemp(dir=self.objects)
+            os.close(fd)
+            shutil.move(filename, tmp)
+            os.chmod(tmp, 0644)
+            os.rename(tmp, path)
+        self.index.store(queue, {'sha256': digest,
+                                 'make-and-model': make_and_model,
+                                 'modtime': modtime})
+        self.evict()
+        return path
+
+    def get(self, conn, queue, make_and_model=None):
+        """Get a queue's PPD, downloading it only if it has changed.
+
+        The server is always asked. Installing a queue needs the print
+        server anyway, so there's no falling back to a cached copy if
+        it can't be reached.
+
+        Args:
+          conn: A cups.Connection to the queue's print server
+          queue: The name of the queue
+          make_and_model: The queue's printer-make-and-model, which
+            has to match for a cached PPD to be used
+
+        Returns:
+          The path to a cached copy of the PPD. The caller must not
+          modify or delete it.
+
+        Raises:
+          Whatever conn raises if the PPD couldn't be downloaded.
+        """
+        entry = self._cached(queue, make_and_model)
+        if entry:
+            status, modtime, filename = conn.getPPD3(
+                queue, modtime=entry['modtime'])
+        else:
+            status, modtime, filename = conn.getPPD3(queue)
+
+        if status == cups.HTTP_NOT_MODIFIED and entry:
+            path = self._object_path(entry['sha256'])
+            self._touch(path)
+            return path
+        if status != cups.HTTP_OK:
+            raise cups.HTTPError(status)
+        return self.add(queue, filename, make_and_model, modtime)
+
+    def installed(self, queue):
+        """Return the hash of the PPD last installed on a local queue.
+
+        Returns:
+          The hex SHA-256 hash of the PPD, or None if it isn't known
+        """
+        digest, state = self.installs.lookup(queue)
+        if state == cache.MISS:
+            return None
+        return digest
+
+    def set_installed(self, queue, digest):
+        """Record the hash of the PPD installed on a local queue.
+
+        Args:
+          queue: The name of the local queue
+          digest: The hex SHA-256 hash of the PPD, or None if the
+            queue has been deleted
+        """
+        if digest is None:
+            self.installs.invalidate(queue)
+        else:
+            self.installs.store(queue, digest)
+
+    def evict(self):
+        """Delete least recently used PPDs until the cache fits."""
+        files = []
+        total = 0
+        for name in os.listdir(self.objects):
+            path = os.path.join(self.objects, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        files.sort()
+        while files and total > self.max_bytes:
+            mtime, size, path = files.pop(0)
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+
+
+__all__ = ['PPDCache',
+           'file_hash',
+           ]
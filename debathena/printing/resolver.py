@@ -0,0 +1,136 @@
+"""Client for the Debathena printing resolver daemon.
+
+The resolver daemon (debathena.printing.resolverd) keeps the local
+cupsd's destinations, Hesiod answers, print server liveness and
+connections warm across wrapper invocations, and answers queries
+about them over a Unix socket. The wrappers ask it first, and resolve
+queues themselves if it isn't running or doesn't answer promptly.
+
+The protocol is one JSON array per line in each direction. A request
+is the name of a query followed by its arguments, e.g.:
+
+  ["find_queue", "w20"]
+
+and the reply is [true, <answer>] or [false, <error message>].
+Several requests can be sent over one connection.
+"""
+
+
+import os
+import threading
+import time
+
+from debathena.printing import cache
+
+
+SOCKET_PATH = '/run/debathena-printing/resolver.sock'
+SOCKET_ENV = 'DEBATHENA_RESOLVER_SOCKET'
+
+# How long to wait for the daemon to answer, in seconds. The daemon
+# answers from memory, so anything slower than this means it's busy
+# or still starting, and we're better off resolving things ourselves
+TIMEOUT = 0.1
+# After the daemon fails to answer, how long to leave it alone before
+# trying again, in seconds
+RETRY_AFTER = 30
+
+_lock = threading.Lock()
+_sock = None
+_file = None
+_failed_at = None
+# Set in the daemon itself, so that it doesn't ask itself
+_serving = False
+
+
+class ResolverError(Exception):
+    """The resolver daemon couldn't answer a query."""
+
+
+def socket_path():
+    """Find the resolver daemon's socket.
+
+    It can be overridden with the DEBATHENA_RESOLVER_SOCKET
+    environment variable; setting it to the empty string stops the
+    wrappers from using the daemon.
+
+    Returns:
+      The path to the socket, or None if the daemon shouldn't be used
+    """
+    if SOCKET_ENV in os.environ:
+        return os.environ[SOCKET_ENV] or None
+    return SOCKET_PATH
+
+
+def _disconnect():
+    global _sock, _file
+    if _sock is not None:
+        try:
+            _file.close()
+            _sock.close()
+        except EnvironmentError:
+            pass
+    _sock = _file = None
+
+
+def query(name, *args, **kwargs):
+    """Ask the resolver daemon something.
+
+    Args:
+      name: The name of the query (see debathena.printing.resolverd)
+      timeout: How long to wait for an answer, in seconds (default
+        TIMEOUT)
+
+    Any other arguments are the query's arguments.
+
+    Returns:
+      The daemon's answer
+
+    Raises:
+      ResolverError if the daemon isn't in use or running, doesn't
+      answer within timeout, or couldn't answer the query
+    """
+    global _sock, _file, _failed_at
+    import json
+    import socket
+    timeout = kwargs.pop('timeout', TIMEOUT)
+    if _serving:
+        raise ResolverError('This is the resolver')
+    path = socket_path()
+    if not path:
+        raise ResolverError('The resolver is disabled')
+
+    _lock.acquire()
+    try:
+        if _failed_at is not None and time.time() < _failed_at + RETRY_AFTER:
+            raise ResolverError('The resolver recently failed')
+        try:
+            if _sock is None:
+                _sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                _file = _sock.makefile('rb')
+                _sock.settimeout(timeout)
+                _sock.connect(path)
+            else:
+                _sock.settimeout(timeout)
+            _sock.sendall(json.dumps([name] + list(args)) + '\n')
+            line = _file.readline()
+            if not line.endswith('\n'):
+                raise ResolverError('The resolver hung up')
+            ok, answer = json.loads(line)
+        except (socket.error, ResolverError, ValueError, TypeError), e:
+            # A late answer would be taken as the answer to the next
+            # query, so the connection can't be used again
+            _disconnect()
+            _failed_at = time.time()
+            raise ResolverError('The resolver failed: %s' % e)
+    finally:
+        _lock.release()
+
+    if not ok:
+        raise ResolverError(answer)
+    return cache._encode(answer)
+
+
+__all__ = ['ResolverError',
+           'socket_path',
+           'query',
+           ]
@@ -0,0 +1,203 @@
+#!/usr/bin/python
+"""A resolver daemon for the Debathena printing wrappers.
+
+Each wrapper invocation is a new process, which has to connect to the
+local cupsd, look queues up in Hesiod and probe print servers before
+it can do anything. This daemon does that work once, keeps the
+results and connections warm, and answers the wrappers' questions
+over a local Unix socket (see debathena.printing.resolver for the
+protocol). A debathena.printing.notify Watcher keeps what it knows
+about local queues up to date.
+
+It's normally started by systemd when the socket is first used
+(debathena-printing-resolver.socket), but can also be run by hand:
+
+  python -m debathena.printing.resolverd --socket /tmp/resolver.sock
+
+The queries it answers are:
+
+  find_queue <queue>: [system, server, queue, uri], as for
+    Resolution.find_queue, plus the local cupsd's device URI for the
+    resolved queue
+  get_cups_uri <printer>: The printer's device URI, or null
+
+There's deliberately no query for the default printer, since that
+depends on the wrapper's LPDEST and ~/.cups/lpoptions.
+"""
+
+
+import json
+import os
+import socket
+import SocketServer
+import stat
+import sys
+
+from debathena.printing import cache
+from debathena.printing import common
+from debathena.printing import resolver
+
+
+# The first file descriptor systemd passes to socket-activated
+# services (see sd_listen_fds(3))
+SD_LISTEN_FDS_START = 3
+
+def _find_queue(queue):
+    resolution = common.Resolution(queue)
+    system, server, canonical = resolution.find_queue()
+    return [system, server, canonical, resolution.uri]
+
+
+QUERIES = {
+    'find_queue': _find_queue,
+    'get_cups_uri': common.get_cups_uri,
+    }
+
+
+def answer(line):
+    """Answer a single request.
+
+    Args:
+      line: The request, as a JSON array
+
+    Returns:
+      The reply, as a JSON array (without a newline)
+    """
+    try:
+        request = cache._encode(json.loads(line))
+        name, args = request[0], request[1:]
+        query = QUERIES[name]
+    except (ValueError, TypeError, IndexError, KeyError):
+        return json.dumps([False, 'Bad request'])
+
+    try:
+        return json.dumps([True, query(*args)])
+    except Exception, e:
+        # Whatever went wrong, the wrapper can still resolve the
+        # queue itself
+        return json.dumps([False, '%s: %s' % (e.__class__.__name__, e)])
+
+
+class Handler(SocketServer.StreamRequestHandler):
+    """Answers each request on a connection, until it's closed."""
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            try:
+                self.wfile.write(answer(line) + '\n')
+            except socket.error:
+                # The wrapper gave up waiting
+                return
+
+    def finish(self):
+        try:
+            SocketServer.StreamRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """Serves requests from the wrappers, a thread per connection.
+
+    Args:
+      sock: A listening Unix socket, such as one passed in by systemd
+    """
+
+    daemon_threads = True
+
+    def __init__(self, sock):
+        SocketServer.UnixStreamServer.__init__(self, None, Handler,
+                                               bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+        self.server_address = sock.getsockname()
+
+
+def activated_socket():
+    """Return the socket systemd passed us, if any (see sd_listen_fds(3))."""
+    if os.environ.get('LISTEN_PID') != str(os.getpid()):
+        return None
+    try:
+        if int(os.environ.get('LISTEN_FDS', 0)) < 1:
+            return None
+    except ValueError:
+        return None
+    sock = socket.fromfd(SD_LISTEN_FDS_START, socket.AF_UNIX,
+                         socket.SOCK_STREAM)
+    os.close(SD_LISTEN_FDS_START)
+    return sock
+
+
+def listen(path):
+    """Create a socket any local user can connect to.
+
+    A socket left behind by an earlier daemon is replaced.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory, 0755)
+    try:
+        if stat.S_ISSOCK(os.lstat(path).st_mode):
+            os.unlink(path)
+    except OSError:
+        pass
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    os.chmod(path, 0666)
+    sock.listen(SocketServer.UnixStreamServer.request_queue_size)
+    return sock
+
+
+def parser():
+    import optparse
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option('-s', '--socket',
+                      help="Listen on SOCKET, unless started by systemd "
+                      "(default $%s or %s)" % (resolver.SOCKET_ENV,
+                                               resolver.SOCKET_PATH))
+    parser.add_option('--no-watch', action='store_false', dest='watch',
+                      default=True,
+                      help="Don't watch the local cupsd for queue changes")
+    return parser
+
+
+def _main(args):
+    options, rest = parser().parse_args(args[1:])
+    if rest:
+        parser().error('unexpected arguments')
+
+    sock = activated_socket()
+    if sock is None:
+        path = options.socket or resolver.socket_path()
+        if not path:
+            parser().error('no socket to listen on')
+        sock = listen(path)
+
+    resolver._serving = True
+    if options.watch:
+        from debathena.printing import notify
+        notify.Watcher().start()
+
+    server = Server(sock)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+__all__ = ['QUERIES',
+           'answer',
+           'Server',
+           'activated_socket',
+           'listen',
+           ]
+
+
+def main():
+    sys.exit(_main(sys.argv)) # pragma: nocover
+
+
+if __name__ == '__main__':
+    main() # pragma: nocover
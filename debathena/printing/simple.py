@@ -16,6 +16,7 @@ from debathena.printing import common
 
 def simple(command, optinfo, queue_opt, args):
     args.pop(0)
+    common.start_deadline()
     
     # Sigh.  CUPS' lprm, in its infinite wisdom, accepts '-' as a
     # specifier for 'all jobs', which doesn't work with any option
@@ -26,7 +27,8 @@ def simple(command, optinfo, queue_opt, args):
     if (command == 'lprm') and len(args) and (args[-1] == '-'):
         lprmdash=True
 
-    queue = common.get_default_printer()
+    queue = None
+    options = arguments = None
     try:
         argstyle, options, arguments = common.parse_args(args, optinfo)
 
@@ -44,6 +46,11 @@ def simple(command, optinfo, queue_opt, args):
         # go with the default queue
         pass
 
+    if queue is None:
+        # Only ask for the default printer if no queue was given,
+        # since finding it can take a round trip to the local cupsd
+        queue = common.get_default_printer()
+
     if not queue:
         # We tried and couldn't figure it out, so not our problem
         common.error(2, ("\n"
@@ -51,7 +58,31 @@ def simple(command, optinfo, queue_opt, args):
                          "default printer via e.g. System | Administration | Printing.\n"
                          "\n" % queue_opt))
 
-    system, server, queue = common.find_queue(queue)
+    resolution = common.Resolution(queue)
+    system, server, queue = resolution.find_queue()
+
+    if (command == 'lprm' and options == [] and
+        common.is_lpd_server(server)):
+        # Servers that only speak LPD don't understand cups-lprm, so
+        # remove the jobs ourselves
+        import getpass
+        from debathena.printing import lpd
+        agent = os.environ.get('ATHENA_USER') or getpass.getuser()
+        jobs = arguments
+        if lprmdash:
+            # LPD's spelling of "all of my jobs"
+            jobs = [agent]
+        try:
+            timeout = common.deadline_timeout(lpd.DEFAULT_TIMEOUT)
+            client = lpd.client_for(server, timeout=timeout)
+            client.remove_jobs(queue, agent, jobs)
+            return 0
+        except lpd.LPDRefused, e:
+            # cups-lprm couldn't do any better
+            common.error(1, '\n%s\n\n' % (e,))
+        except lpd.LPDError:
+            # Let cups-lprm have a go, then
+            pass
 
     args.insert(0, '%s%s' % (queue_opt, queue))
     if server:
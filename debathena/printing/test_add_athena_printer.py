@@ -0,0 +1,252 @@
+#!/usr/bin/python
+"""Test suite for add-athena-printer"""
+
+
+import imp
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+import cups
+import mox
+
+from debathena.printing import common
+from debathena.printing import ppdcache
+
+
+add_athena_printer = imp.load_source(
+    'add_athena_printer',
+    os.path.join(os.path.dirname(__file__), '..', '..',
+                 'files', 'usr', 'bin', 'add-athena-printer'))
+
+
+class TestRunJobs(mox.MoxTestBase):
+    def setUp(self):
+        super(TestRunJobs, self).setUp()
+
+        self.mox.StubOutWithMock(add_athena_printer, 'releaseConnections')
+
+    def test_errors(self):
+        """Test that each queue's failure is recorded against that queue"""
+        def func(q):
+            if q == 'ajax':
+                raise add_athena_printer.AddPrinterError('no such queue\n')
+            if q == 'w20':
+                raise cups.IPPError(1030, 'client-error-not-found')
+            if q == 'e40':
+                raise OSError(28, 'No space left on device')
+            return q.upper()
+        add_athena_printer.releaseConnections(broken=True)
+        add_athena_printer.releaseConnections()
+
+        self.mox.ReplayAll()
+
+        results = add_athena_printer.runJobs(['ajax', 'w20', 'e40', 'bw'],
+                                             func, jobs=1)
+        self.assertEqual(results['ajax'], (None, 'no such queue'))
+        self.assertEqual(results['w20'][0], None)
+        self.assertEqual(results['e40'],
+                         (None, 'Error: [Errno 28] No space left on device'))
+        self.assertEqual(results['bw'], ('BW', None))
+
+    def test_missing(self):
+        """Test that a queue whose worker died still has a result"""
+        def func(q):
+            raise SystemExit()
+        add_athena_printer.releaseConnections()
+
+        self.mox.ReplayAll()
+
+        results = add_athena_printer.runJobs(['ajax'], func, jobs=1)
+        self.assertEqual(results['ajax'][0], None)
+        self.assertTrue(results['ajax'][1])
+
+
+REMOTE_QUEUES = {
+    'ajax': {'printer-info': 'ajax',
+             'printer-location': 'E40',
+             'printer-make-and-model': 'HP LaserJet 9050',
+             'printer-uri-supported':
+                 'ipp://printers.mit.edu/printers/ajax'},
+    }
+LOCAL_QUEUES = {
+    'ajax': {'device-uri': 'ipp://printers.mit.edu/printers/ajax',
+             'printer-info': 'ajax',
+             'printer-location': 'E40'},
+    'w20': {'device-uri': 'ipp://printers.mit.edu/printers/w20',
+            'printer-info': 'w20',
+            'printer-location': 'W20'},
+    'home': {'device-uri': 'usb://HP/LaserJet%201020'},
+    }
+
+
+class TestSync(mox.MoxTestBase):
+    def setUp(self):
+        super(TestSync, self).setUp()
+
+        self.dir = tempfile.mkdtemp()
+        self.ppd = os.path.join(self.dir, 'ajax.ppd')
+        f = open(self.ppd, 'w')
+        f.write('*PPD-Adobe: "4.3"\n')
+        f.close()
+        self.digest = ppdcache.file_hash(self.ppd)
+
+        self.lc = self.mox.CreateMockAnything()
+        self.rc = self.mox.CreateMockAnything()
+        self.ppds = self.mox.CreateMockAnything()
+        self.mox.stubs.Set(add_athena_printer, 'local_connection',
+                           lambda: self.lc)
+        self.mox.stubs.Set(add_athena_printer, 'remote_connection',
+                           lambda: self.rc)
+        self.mox.stubs.Set(add_athena_printer, 'releaseConnections',
+                           lambda broken=False: None)
+        self.mox.stubs.Set(add_athena_printer, 'getPrinterLists',
+                           lambda: (REMOTE_QUEUES, LOCAL_QUEUES))
+        self.mox.stubs.Set(add_athena_printer, 'open_ppd_cache',
+                           lambda: self.ppds)
+        self.mox.stubs.Set(common, '_get_cups_backends',
+                           lambda: ['mulch.mit.edu'])
+
+    def tearDown(self):
+        super(TestSync, self).tearDown()
+        shutil.rmtree(self.dir)
+
+    def expect_ppd(self, installed):
+        self.ppds.get(self.rc, 'ajax', 'HP LaserJet 9050').AndReturn(self.ppd)
+        self.ppds.installed('ajax').AndReturn(installed)
+
+    def test_unchanged(self):
+        """Test that an up to date queue isn't touched"""
+        self.expect_ppd(self.digest)
+        self.lc.getPrinterAttributes('ajax').AndReturn(
+            {'sides-default': 'two-sided-long-edge'})
+        self.rc.getPrinterAttributes('ajax').AndReturn(
+            {'sides-default': 'two-sided-long-edge', 'copies-default': 0})
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(add_athena_printer.planSync(
+                'ajax', REMOTE_QUEUES, LOCAL_QUEUES, self.ppds),
+                         ([], self.digest))
+
+    def test_changed(self):
+        """Test that only what differs is changed"""
+        local_queues = dict(LOCAL_QUEUES)
+        local_queues['ajax'] = dict(LOCAL_QUEUES['ajax'],
+                                    **{'printer-location': 'E40-342'})
+        self.expect_ppd('0' * 64)
+        self.rc.getPrinterAttributes('ajax').AndReturn(
+            {'sides-default': 'two-sided-long-edge'})
+
+        self.mox.ReplayAll()
+
+        changes, digest = add_athena_printer.planSync(
+            'ajax', REMOTE_QUEUES, local_queues, self.ppds)
+        self.assertEqual(digest, self.digest)
+        self.assertEqual([c[1:] for c in changes], [
+                ('setPrinterLocation', ('E40',), {}),
+                ('addPrinter', (), {'filename': self.ppd}),
+                ('addPrinterOptionDefault',
+                 ('sides', 'two-sided-long-edge'), {}),
+                ])
+
+    def test_prune(self):
+        """Test that unlisted local Athena queues are removed"""
+        self.mox.StubOutWithMock(add_athena_printer, 'planSync')
+        add_athena_printer.planSync('ajax', REMOTE_QUEUES, LOCAL_QUEUES,
+                                    self.ppds).AndReturn(([], self.digest))
+        self.lc.deletePrinter('w20')
+        self.ppds.set_installed('w20', None)
+
+        self.mox.ReplayAll()
+
+        queues, results = add_athena_printer.syncAthenaPrinters(
+            ['ajax'], prune=True, jobs=1)
+        self.assertEqual(queues, ['ajax', 'w20'])
+        self.assertEqual(results, {'ajax': ([], None),
+                                   'w20': (['delete queue'], None)})
+
+    def test_prune_all(self):
+        """Test that --all only removes queues the print servers lack"""
+        self.mox.StubOutWithMock(add_athena_printer, 'planSync')
+        add_athena_printer.planSync('ajax', REMOTE_QUEUES, LOCAL_QUEUES,
+                                    self.ppds).AndReturn(([], self.digest))
+
+        self.mox.ReplayAll()
+
+        queues, results = add_athena_printer.syncAthenaPrinters(
+            [], prune=True, dry_run=True, jobs=1, all_local=True)
+        self.assertEqual(queues, ['ajax', 'w20'])
+        self.assertEqual(results['w20'], (['delete queue'], None))
+
+    def test_dry_run(self):
+        """Test that a dry run changes nothing"""
+        local_queues = dict(LOCAL_QUEUES)
+        del local_queues['ajax']
+        self.mox.stubs.Set(add_athena_printer, 'getPrinterLists',
+                           lambda: (REMOTE_QUEUES, local_queues))
+        self.ppds.get(self.rc, 'ajax', 'HP LaserJet 9050').AndReturn(self.ppd)
+        self.rc.getPrinterAttributes('ajax').AndReturn({})
+
+        self.mox.ReplayAll()
+
+        queues, results = add_athena_printer.syncAthenaPrinters(
+            ['ajax'], prune=True, dry_run=True, jobs=1)
+        self.assertEqual(queues, ['ajax', 'w20'])
+        self.assertEqual(results['ajax'],
+                         (['add queue', 'accept jobs', 'enable'], None))
+        self.assertEqual(results['w20'], (['delete queue'], None))
+
+    def test_add_records_ppd(self):
+        """Test that installing a queue records which PPD it got"""
+        self.ppds.get(self.rc, 'ajax', 'HP LaserJet 9050').AndReturn(self.ppd)
+        self.lc.addPrinter('ajax', filename=self.ppd, info='ajax',
+                           location='E40',
+                           device='ipp://printers.mit.edu/printers/ajax')
+        self.rc.getPrinterAttributes('ajax').AndReturn({})
+        self.lc.acceptJobs('ajax')
+        self.lc.enablePrinter('ajax')
+        self.ppds.set_installed('ajax', self.digest)
+
+        self.mox.ReplayAll()
+
+        add_athena_printer.addAthenaPrinter('ajax', False, REMOTE_QUEUES,
+                                            {}, self.ppds)
+
+
+class TestIsAthenaQueue(mox.MoxTestBase):
+    def test_servers(self):
+        """Test that queues on any Athena print server count"""
+        self.mox.stubs.Set(common, '_get_cups_backends',
+                           lambda: ['mulch.mit.edu'])
+        for uri, athena in [
+            ('ipp://printers.mit.edu/printers/ajax', True),
+            ('ipp://CLUSTER-PRINTERS.MIT.EDU:631/printers/w20', True),
+            ('ipp://mulch.mit.edu/printers/ajax', True),
+            ('ipp://printers.example.com/printers/ajax', False),
+            ('usb://HP/LaserJet%201020', False),
+            ]:
+            self.assertEqual(add_athena_printer.isAthenaQueue(
+                    {'device-uri': uri}), athena, uri)
+        self.assertFalse(add_athena_printer.isAthenaQueue({}))
+
+
+class TestMain(mox.MoxTestBase):
+    def test_prune_needs_queues(self):
+        """Test that --prune won't delete every queue by default"""
+        self.mox.stubs.Set(sys, 'argv', ['add-athena-printer', '--sync',
+                                         '--prune'])
+        self.mox.stubs.Set(sys, 'stderr', StringIO.StringIO())
+        self.mox.StubOutWithMock(add_athena_printer, 'syncAthenaPrinters')
+
+        self.mox.ReplayAll()
+
+        self.assertRaises(SystemExit, add_athena_printer.main)
+        self.assertTrue('--all' in sys.stderr.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
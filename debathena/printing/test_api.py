@@ -0,0 +1,130 @@
+#!/usr/bin/python
+"""Test suite for debathena.printing.api"""
+
+
+import unittest
+
+import cups
+import mox
+
+from debathena.printing import api
+from debathena.printing import common
+
+
+class TestSpooler(mox.MoxTestBase):
+    def setUp(self):
+        super(TestSpooler, self).setUp()
+
+        self.conn = self.mox.CreateMock(cups.Connection)
+        self.other = self.mox.CreateMock(cups.Connection)
+        self.mox.stubs.Set(common, '_connections', common.ConnectionPool())
+        self.mox.StubOutWithMock(api.Spooler, 'resolve')
+        self.mox.StubOutWithMock(cups, 'Connection', use_mock_anything=True)
+        self.spooler = api.Spooler(workers=1)
+
+    def test_submit(self):
+        """Test that connections are reused between jobs"""
+        self.spooler.resolve('w20').AndReturn(('GET-PRINT.MIT.EDU', 'ajax'))
+        cups.Connection(host='GET-PRINT.MIT.EDU').AndReturn(self.conn)
+        self.conn.printFile('ajax', 'dir/a.pdf', 'a.pdf',
+                            {'copies': '2'}).AndReturn(12)
+        self.spooler.resolve('ajax').AndReturn(('GET-PRINT.MIT.EDU', 'ajax'))
+        self.conn.printFiles('ajax', ['a.pdf', 'b.pdf'], 'psets',
+                             {}).AndReturn(13)
+
+        self.mox.ReplayAll()
+
+        job = self.spooler.submit('dir/a.pdf', 'w20', {'copies': 2})
+        self.assertEqual((job.queue, job.server, job.id),
+                         ('ajax', 'GET-PRINT.MIT.EDU', 12))
+        self.assertEqual(job.name, 'ajax-12')
+        job = self.spooler.submit(['a.pdf', 'b.pdf'], 'ajax', title='psets')
+        self.assertEqual(job.id, 13)
+
+    def test_local(self):
+        """Test printing to a queue on the local cupsd"""
+        self.spooler.resolve('home').AndReturn((None, 'home'))
+        cups.Connection().AndReturn(self.conn)
+        self.conn.printFile('home', 'a.pdf', 'a.pdf', {}).AndReturn(1)
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(self.spooler.submit(['a.pdf'], 'home').server, None)
+
+    def test_ipp_error(self):
+        """Test that a refused job keeps its connection"""
+        self.spooler.resolve('ajax').AndReturn(('GET-PRINT.MIT.EDU', 'ajax'))
+        cups.Connection(host='GET-PRINT.MIT.EDU').AndReturn(self.conn)
+        self.conn.printFile('ajax', 'a.pdf', 'a.pdf', {}).AndRaise(
+            cups.IPPError(1030, 'client-error-not-found'))
+        self.spooler.resolve('ajax').AndReturn(('GET-PRINT.MIT.EDU', 'ajax'))
+        self.conn.printFile('ajax', 'a.pdf', 'a.pdf', {}).AndReturn(2)
+
+        self.mox.ReplayAll()
+
+        self.assertRaises(api.PrintError, self.spooler.submit, 'a.pdf', 'ajax')
+        self.assertEqual(self.spooler.submit('a.pdf', 'ajax').id, 2)
+
+    def test_http_error(self):
+        """Test that a broken connection isn't reused"""
+        self.spooler.resolve('ajax').AndReturn(('GET-PRINT.MIT.EDU', 'ajax'))
+        cups.Connection(host='GET-PRINT.MIT.EDU').AndReturn(self.conn)
+        self.conn.printFile('ajax', 'a.pdf', 'a.pdf', {}).AndRaise(
+            cups.HTTPError(500))
+        self.spooler.resolve('ajax').AndReturn(('GET-PRINT.MIT.EDU', 'ajax'))
+        cups.Connection(host='GET-PRINT.MIT.EDU').AndReturn(self.other)
+        self.other.printFile('ajax', 'a.pdf', 'a.pdf', {}).AndReturn(2)
+
+        self.mox.ReplayAll()
+
+        self.assertRaises(api.PrintError, self.spooler.submit, 'a.pdf', 'ajax')
+        self.assertEqual(self.spooler.submit('a.pdf', 'ajax').id, 2)
+
+    def test_submit_async(self):
+        """Test submitting jobs in the background"""
+        self.spooler.resolve('ajax').AndReturn(('GET-PRINT.MIT.EDU', 'ajax'))
+        cups.Connection(host='GET-PRINT.MIT.EDU').AndReturn(self.conn)
+        self.conn.printFile('ajax', 'a.pdf', 'a.pdf', {}).AndReturn(1)
+        self.spooler.resolve('ajax').AndReturn(('GET-PRINT.MIT.EDU', 'ajax'))
+        self.conn.printFile('ajax', 'b.pdf', 'b.pdf', {}).AndRaise(
+            cups.IPPError(1030, 'client-error-not-found'))
+
+        self.mox.ReplayAll()
+
+        pending = [self.spooler.submit_async('a.pdf', 'ajax'),
+                   self.spooler.submit_async('b.pdf', 'ajax')]
+        self.assertEqual(pending[0].result(5).id, 1)
+        self.assertRaises(api.PrintError, pending[1].result, 5)
+        self.assertTrue(pending[1].done())
+
+    def test_job_state(self):
+        """Test finding out what's happened to a job"""
+        cups.Connection(host='GET-PRINT.MIT.EDU').AndReturn(self.conn)
+        self.conn.getJobAttributes(
+            12, requested_attributes=['job-state']).AndReturn({'job-state': 9})
+
+        self.mox.ReplayAll()
+
+        job = api.Job('ajax', 'GET-PRINT.MIT.EDU', 12, ['a.pdf'])
+        self.assertEqual(self.spooler.job_state(job), 'completed')
+
+
+class TestResolve(mox.MoxTestBase):
+    def test_resolve(self):
+        """Test that queues are resolved the way the wrappers do it"""
+        self.mox.StubOutWithMock(common, 'find_queue')
+        self.mox.StubOutWithMock(common, 'select_cups_server')
+        resolution = mox.IsA(common.Resolution)
+        common.find_queue('w20', resolution).AndReturn(
+            (common.SYSTEM_CUPS, 'GET-PRINT.MIT.EDU', 'ajax'))
+        common.select_cups_server('GET-PRINT.MIT.EDU').AndReturn(
+            'printers.mit.edu')
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(api.Spooler().resolve('w20'),
+                         ('printers.mit.edu', 'ajax'))
+
+
+if __name__ == '__main__':
+    unittest.main()
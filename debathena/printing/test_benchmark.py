@@ -0,0 +1,66 @@
+#!/usr/bin/python
+"""Test suite for debathena.printing.benchmark"""
+
+
+import json
+import os
+import sys
+import unittest
+
+import mox
+
+from debathena.printing import benchmark
+
+
+class TestPercentile(mox.MoxTestBase):
+    def test_percentile(self):
+        """Test the nearest-rank percentile"""
+        samples = range(100, 0, -1)
+        self.assertEqual(benchmark.percentile(samples, 50), 50)
+        self.assertEqual(benchmark.percentile(samples, 99), 99)
+        self.assertEqual(benchmark.percentile(samples, 100), 100)
+        self.assertEqual(benchmark.percentile([7], 99), 7)
+
+    def test_summarize(self):
+        """Test that timings are summarized in milliseconds"""
+        summary = benchmark.summarize([0.001, 0.002, 0.003])
+        self.assertEqual(summary['n'], 3)
+        self.assertAlmostEqual(summary['p50'], 2)
+        self.assertAlmostEqual(summary['max'], 3)
+
+
+class TestFakes(mox.MoxTestBase):
+    def test_uninstall(self):
+        """Test that the stand-ins are taken away again"""
+        execvp = os.execvp
+        cups = sys.modules.get('cups')
+
+        fakes = benchmark.Fakes()
+        fakes.install()
+        try:
+            self.assertRaises(benchmark.Dispatched,
+                              os.execvp, 'cups-lpr', ['lpr'])
+            self.assertTrue(sys.modules['cups'] is not cups)
+        finally:
+            fakes.uninstall()
+
+        self.assertTrue(os.execvp is execvp)
+        self.assertTrue(sys.modules.get('cups') is cups)
+
+
+class TestRun(mox.MoxTestBase):
+    def test_run(self):
+        """Test a short run of every wrapper"""
+        results = benchmark.run(iterations=3, latency=0, hesiod_latency=0,
+                                import_samples=0)
+
+        json.dumps(results)
+        for state in ('cold', 'warm'):
+            self.assertEqual(sorted(results['dispatch'][state]),
+                             sorted(benchmark.WRAPPERS))
+            for summary in results['dispatch'][state].values():
+                self.assertEqual(summary['n'], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,205 @@
+#!/usr/bin/python
+"""Test suite for debathena.printing.cache"""
+
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import mox
+
+from debathena.printing import cache
+
+
+class TestCacheDir(mox.MoxTestBase):
+    def setUp(self):
+        super(TestCacheDir, self).setUp()
+
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super(TestCacheDir, self).tearDown()
+        shutil.rmtree(self.dir)
+
+    def test_disabled(self):
+        """Test that an empty DEBATHENA_PRINTING_CACHE disables caching"""
+        self.mox.stubs.Set(os, 'environ', {cache.CACHE_ENV: ''})
+        self.assertEqual(cache.cache_dir(), None)
+
+    def test_override(self):
+        """Test that DEBATHENA_PRINTING_CACHE picks the cache directory"""
+        path = os.path.join(self.dir, 'cache')
+        self.mox.stubs.Set(os, 'environ', {cache.CACHE_ENV: path})
+        self.assertEqual(cache.cache_dir(), path)
+        self.assertTrue(os.path.isdir(path))
+
+    def test_runtime_dir(self):
+        """Test that the cache lives under $XDG_RUNTIME_DIR"""
+        self.mox.stubs.Set(os, 'environ', {'XDG_RUNTIME_DIR': self.dir})
+        self.assertEqual(cache.cache_dir(),
+                         os.path.join(self.dir, 'debathena-printing'))
+
+    def test_unsafe(self):
+        """Test that a world-writable cache directory is rejected"""
+        path = os.path.join(self.dir, 'cache')
+        os.mkdir(path)
+        os.chmod(path, 0777)
+        self.mox.stubs.Set(os, 'environ', {cache.CACHE_ENV: path})
+        self.assertEqual(cache.cache_dir(), None)
+
+
+class TestFileCache(mox.MoxTestBase):
+    def setUp(self):
+        super(TestFileCache, self).setUp()
+
+        self.dir = tempfile.mkdtemp()
+        self.cache = cache.FileCache('test', 10, 20, directory=self.dir)
+
+    def tearDown(self):
+        super(TestFileCache, self).tearDown()
+        shutil.rmtree(self.dir)
+
+    def test_miss(self):
+        """Test looking up a key that was never stored"""
+        self.assertEqual(self.cache.lookup('ajax'), (None, cache.MISS))
+
+    def test_states(self):
+        """Test that entries go from fresh to stale to expired"""
+        self.cache.store('ajax', ['GET-PRINT.MIT.EDU', 'ajax'], now=100)
+        self.assertEqual(self.cache.lookup('ajax', now=105),
+                         (['GET-PRINT.MIT.EDU', 'ajax'], cache.FRESH))
+        self.assertEqual(self.cache.lookup('ajax', now=115),
+                         (['GET-PRINT.MIT.EDU', 'ajax'], cache.STALE))
+        self.assertEqual(self.cache.lookup('ajax', now=135),
+                         (None, cache.MISS))
+
+    def test_byte_strings(self):
+        """Test that cached strings come back as byte strings"""
+        self.cache.store('ajax', 'ajax')
+        value, state = self.cache.lookup('ajax')
+        self.assertTrue(isinstance(value, str))
+
+    def test_shared(self):
+        """Test that separate cache objects share the same file"""
+        self.cache.store('ajax', 1)
+        other = cache.FileCache('test', 10, 20, directory=self.dir)
+        other.store('w20', 2)
+        self.assertEqual(self.cache.lookup('ajax')[0], 1)
+        self.assertEqual(self.cache.lookup('w20')[0], 2)
+
+    def test_invalidate(self):
+        """Test invalidating a single key and the whole cache"""
+        self.cache.store('ajax', 1)
+        self.cache.store('w20', 2)
+        self.cache.invalidate('ajax')
+        self.assertEqual(self.cache.lookup('ajax'), (None, cache.MISS))
+        self.assertEqual(self.cache.lookup('w20')[0], 2)
+        self.cache.invalidate()
+        self.assertEqual(self.cache.lookup('w20'), (None, cache.MISS))
+
+    def test_invalidate_matching(self):
+        """Test invalidating every key that matches"""
+        self.cache.store('w20', 1)
+        self.cache.store('w20/2sided', 2)
+        self.cache.store('ajax', 3)
+        self.cache.invalidate_matching(lambda key: key.startswith('w20'))
+        self.assertEqual(self.cache.items(), [('ajax', 3)])
+
+    def test_corrupt(self):
+        """Test that a corrupt cache file is treated as empty"""
+        f = open(os.path.join(self.dir, 'test.json'), 'w')
+        f.write('{not json')
+        f.close()
+        self.assertEqual(self.cache.lookup('ajax'), (None, cache.MISS))
+        self.cache.store('ajax', 1)
+        self.assertEqual(self.cache.lookup('ajax')[0], 1)
+
+    def test_get_computes_once(self):
+        """Test that get only computes a missing value"""
+        calls = []
+        def compute():
+            calls.append(None)
+            return 42
+        self.assertEqual(self.cache.get('answer', compute), 42)
+        self.assertEqual(self.cache.get('answer', compute), 42)
+        self.assertEqual(len(calls), 1)
+
+    def test_get_stale(self):
+        """Test that get returns stale values and revalidates them"""
+        self.cache.store('answer', 41, now=0)
+        self.cache.ttl = 0
+        self.cache.stale = 1e12
+        revalidated = []
+        self.assertEqual(self.cache.get('answer', lambda: 42,
+                                        lambda: revalidated.append(True)),
+                         41)
+        self.assertEqual(revalidated, [True])
+
+    def test_in_background(self):
+        """Test that a process with other threads doesn't fork"""
+        self.mox.StubOutWithMock(cache, 'detach')
+        done = threading.Event()
+        other = threading.Thread(target=done.wait)
+        other.start()
+        ran = threading.Event()
+
+        self.mox.ReplayAll()
+
+        try:
+            cache.in_background(ran.set, forked=None)
+            self.assertTrue(ran.wait(5))
+        finally:
+            done.set()
+            other.join()
+
+    def test_per_entry_ttl(self):
+        """Test that store can override the cache's ttl"""
+        self.cache.store('ajax', 1, now=100, ttl=1000)
+        self.assertEqual(self.cache.lookup('ajax', now=500),
+                         (1, cache.FRESH))
+
+    def test_max_entries(self):
+        """Test that the oldest entries are evicted first"""
+        self.cache.max_entries = 2
+        now = 1000000
+        self.cache.store('a', 1, now=now)
+        self.cache.store('b', 2, now=now + 1)
+        self.cache.store('c', 3, now=now + 2)
+        self.assertEqual(self.cache.lookup('a', now=now + 3), (None, cache.MISS))
+        self.assertEqual(self.cache.lookup('b', now=now + 3), (2, cache.FRESH))
+        self.assertEqual(self.cache.lookup('c', now=now + 3), (3, cache.FRESH))
+
+
+class TestLRUCache(mox.MoxTestBase):
+    def test_expiry(self):
+        """Test that entries expire after their ttl"""
+        c = cache.LRUCache(10)
+        c.store('ajax', 1, 10, now=100)
+        self.assertEqual(c.lookup('ajax', now=105), (1, True))
+        self.assertEqual(c.lookup('ajax', now=110), (None, False))
+
+    def test_eviction(self):
+        """Test that the least recently used entry is evicted"""
+        c = cache.LRUCache(2)
+        c.store('a', 1, 10)
+        c.store('b', 2, 10)
+        c.lookup('a')
+        c.store('c', 3, 10)
+        self.assertEqual(c.lookup('a'), (1, True))
+        self.assertEqual(c.lookup('b'), (None, False))
+        self.assertEqual(c.lookup('c'), (3, True))
+        self.assertEqual(len(c), 2)
+
+
+class TestNullCache(mox.MoxTestBase):
+    def test_null(self):
+        """Test that a NullCache never remembers anything"""
+        c = cache.NullCache()
+        c.store('ajax', 1)
+        self.assertEqual(c.lookup('ajax'), (None, cache.MISS))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,20 +2,45 @@
 """Test suite for debathena.printing.common"""
 
 
+import json
 import os
+import shutil
+import StringIO
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
 import cups
 import hesiod
 import mox
 
+from debathena.printing import cache
 from debathena.printing import common
+from debathena.printing import pcapdb
+from debathena.printing import resolver
+
+
+def synchronously(func, *args):
+    """Stands in for common._in_background, calling func right away.
+
+    mox doesn't allow mocks to be called from several threads at
+    once, or in an unpredictable order.
+    """
+    result = func(*args)
+    return lambda: result
 
 
 class TestHesiodLookup(mox.MoxTestBase):
     def setUp(self):
         super(TestHesiodLookup, self).setUp()
 
+        self.mox.stubs.Set(common, '_hesiod_memory', cache.LRUCache(10))
+        self.mox.stubs.Set(common, '_hesiod_cache', cache.NullCache())
+        self.mox.stubs.Set(common, '_hesiod_stats',
+                           {'hits': 0, 'negative_hits': 0, 'misses': 0})
         self.mox.StubOutWithMock(hesiod, 'Lookup', use_mock_anything=True)
 
     def test_valid(self):
@@ -41,6 +66,63 @@ class TestHesiodLookup(mox.MoxTestBase):
         self.assertEqual(common._hesiod_lookup('doesnt_exist', 'pcap'),
                          [])
 
+    def test_cached(self):
+        """Test that _hesiod_lookup only looks up a record once"""
+        class FakeResults(object): pass
+        h = FakeResults()
+        h.results = ['ajax:rp=ajax:rm=GET-PRINT.MIT.EDU:ka#0:mc#0:']
+
+        hesiod.Lookup('ajax', 'pcap').AndReturn(h)
+
+        self.mox.ReplayAll()
+
+        for i in range(3):
+            self.assertEqual(common._hesiod_lookup('ajax', 'pcap'),
+                             h.results)
+        self.assertEqual(common.hesiod_cache_stats(),
+                         {'hits': 2, 'negative_hits': 0, 'misses': 1})
+
+    def test_negative_cached(self):
+        """Test that _hesiod_lookup remembers nonexistent records"""
+        hesiod.Lookup('doesnt_exist', 'pcap').AndRaise(
+            IOError(2, 'No such file or directory'))
+
+        self.mox.ReplayAll()
+
+        for i in range(2):
+            self.assertEqual(common._hesiod_lookup('doesnt_exist', 'pcap'),
+                             [])
+        self.assertEqual(common.hesiod_cache_stats(),
+                         {'hits': 0, 'negative_hits': 1, 'misses': 1})
+
+    def test_error_not_cached(self):
+        """Test that _hesiod_lookup doesn't remember transient errors"""
+        for i in range(2):
+            hesiod.Lookup('ajax', 'pcap').AndRaise(
+                IOError(110, 'Connection timed out'))
+
+        self.mox.ReplayAll()
+
+        failures = common._lookup_failures
+        for i in range(2):
+            self.assertEqual(common._hesiod_lookup('ajax', 'pcap'), [])
+        self.assertEqual(common._lookup_failures, failures + 2)
+
+    def test_disk_cache(self):
+        """Test that _hesiod_lookup shares answers through the disk cache"""
+        d = tempfile.mkdtemp()
+        try:
+            self.mox.stubs.Set(common, '_hesiod_cache',
+                               cache.FileCache('hesiod', 60, directory=d))
+            common._hesiod_cache.store('ajax.pcap', ['ajax:rm=GET-PRINT.MIT.EDU:'])
+
+            self.mox.ReplayAll()
+
+            self.assertEqual(common._hesiod_lookup('ajax', 'pcap'),
+                             ['ajax:rm=GET-PRINT.MIT.EDU:'])
+        finally:
+            shutil.rmtree(d)
+
 
 class TestParseArgs(mox.MoxTestBase):
     def setUp(self):
@@ -76,11 +158,10 @@ class TestCanonicalizeQueue(mox.MoxTestBase):
     def setUp(self):
         super(TestCanonicalizeQueue, self).setUp()
 
-        def _setup_side_effects():
-            common.CUPS_FRONTENDS = ['printers.mit.edu', 'cluster-printers.mit.edu']
-            common.CUPS_BACKENDS = ['get-print.mit.edu']
-        self.mox.StubOutWithMock(common, '_setup')
-        common._setup().WithSideEffects(_setup_side_effects)
+        self.mox.stubs.Set(common, 'CUPS_FRONTENDS',
+                           ['printers.mit.edu', 'cluster-printers.mit.edu'])
+        self.mox.stubs.Set(common, 'CUPS_BACKENDS', ['get-print.mit.edu'])
+        self.mox.stubs.Set(common, '_materialized', set(['backends']))
 
         self.mox.StubOutWithMock(common, 'get_cups_uri')
 
@@ -126,35 +207,499 @@ class TestCanonicalizeQueue(mox.MoxTestBase):
         self.assertEqual(common.canonicalize_queue('ajax2'),
                          'ajax2')
 
+    def test_valid_backend(self):
+        """Test a local bounce queue pointing directly at a backend server"""
+        common.get_cups_uri('ajax').AndReturn('ipp://GET-PRINT.MIT.EDU:631/printers/ajax')
+        self.mox.ReplayAll()
+        self.assertEqual(common.canonicalize_queue('ajax'),
+                         'ajax')
+
+
+class TestLazySetup(mox.MoxTestBase):
+    def setUp(self):
+        super(TestLazySetup, self).setUp()
+
+        self.mox.stubs.Set(common, '_materialized', set())
+        self.mox.stubs.Set(common, 'CUPS_BACKENDS', [])
+        self.mox.stubs.Set(common, 'cupsd', None)
+        self.mox.stubs.Set(common, '_destinations', None)
+        self.mox.stubs.Set(common, '_destinations_cache', cache.NullCache())
+        self.mox.stubs.Set(common, '_connections', common.ConnectionPool())
+        self.mox.StubOutWithMock(common, '_hesiod_lookup')
+        self.mox.stubs.Set(common, '_in_background', synchronously)
+        self.cupsd = self.mox.CreateMock(cups.Connection)
+        self.mox.StubOutWithMock(cups, 'Connection', use_mock_anything=True)
+
+    def test_default_printer_from_environ(self):
+        """Test that $PRINTER doesn't require any setup"""
+        self.mox.stubs.Set(os, 'environ', {'PRINTER': 'ajax'})
+        self.mox.ReplayAll()
+        self.assertEqual(common.get_default_printer(), 'ajax')
+        self.assertEqual(common.materialized(), [])
+
+    def test_frontend_uri(self):
+        """Test that a frontend URI doesn't require looking up the backends"""
+        cups.Connection().AndReturn(self.cupsd)
+        self.cupsd.getPrinters().AndReturn(
+            {'w20': {'device-uri': 'ipp://printers.mit.edu:631/printers/ajax'}})
+        self.cupsd.getClasses().AndReturn({})
+        self.mox.ReplayAll()
+        self.assertEqual(common.canonicalize_queue('w20'), 'ajax')
+        self.assertEqual(common.materialized(), ['cupsd', 'destinations'])
+
+    def test_backend_uri(self):
+        """Test that the backends are looked up once, when needed"""
+        cups.Connection().AndReturn(self.cupsd)
+        self.cupsd.getPrinters().AndReturn(
+            {'w20': {'device-uri': 'ipp://get-print.mit.edu:631/printers/ajax'},
+             'w21': {'device-uri': 'ipp://get-print.mit.edu:631/printers/ajax'}})
+        self.cupsd.getClasses().AndReturn({})
+        common._hesiod_lookup('cups-cluster', 'sloc').AndReturn([])
+        common._hesiod_lookup('cups-print', 'sloc').AndReturn(['GET-PRINT.MIT.EDU'])
+        self.mox.ReplayAll()
+        self.assertEqual(common.canonicalize_queue('w20'), 'ajax')
+        self.assertEqual(common.canonicalize_queue('w21'), 'ajax')
+        self.assertEqual(common.materialized(),
+                         ['backends', 'cupsd', 'destinations'])
+
+
+class TestConnectionPool(mox.MoxTestBase):
+    def setUp(self):
+        super(TestConnectionPool, self).setUp()
+
+        self.conns = [self.mox.CreateMock(cups.Connection) for i in range(2)]
+        self.mox.StubOutWithMock(cups, 'Connection', use_mock_anything=True)
+        self.mox.StubOutWithMock(time, 'time')
+        self.pool = common.ConnectionPool(idle_timeout=60, check_after=5)
+
+    def test_reuse(self):
+        """Test that connections are reused, and only by one caller at a time"""
+        time.time().MultipleTimes().AndReturn(0)
+        cups.Connection(host='printers.mit.edu').AndReturn(self.conns[0])
+        cups.Connection(host='PRINTERS.MIT.EDU').AndReturn(self.conns[1])
+
+        self.mox.ReplayAll()
+
+        a = self.pool.get('printers.mit.edu')
+        b = self.pool.get('PRINTERS.MIT.EDU')
+        self.assertFalse(a is b)
+        self.pool.put(a)
+        self.assertTrue(self.pool.get('printers.mit.edu') is a)
+
+    def test_keys(self):
+        """Test that connections are kept apart by server, port and encryption"""
+        time.time().MultipleTimes().AndReturn(0)
+        cups.Connection().AndReturn(self.conns[0])
+        cups.Connection(host='printers.mit.edu', port=443).AndReturn(
+            self.conns[1])
+
+        self.mox.ReplayAll()
+
+        self.pool.put(self.pool.get())
+        self.pool.put(self.pool.get('printers.mit.edu', 443))
+        self.assertTrue(self.pool.get() is self.conns[0])
+        self.assertTrue(self.pool.get('printers.mit.edu', 443) is
+                        self.conns[1])
+
+    def test_health_check(self):
+        """Test that connections idle for a while are checked first"""
+        time.time().AndReturn(0)
+        cups.Connection().AndReturn(self.conns[0])
+        time.time().AndReturn(0)
+        time.time().AndReturn(10)
+        self.conns[0].getDefault().AndRaise(cups.HTTPError(500))
+        time.time().AndReturn(10)
+        cups.Connection().AndReturn(self.conns[1])
+
+        self.mox.ReplayAll()
+
+        self.pool.put(self.pool.get())
+        self.assertTrue(self.pool.get() is self.conns[1])
+
+    def test_idle_timeout(self):
+        """Test that connections idle for too long are closed"""
+        time.time().AndReturn(0)
+        cups.Connection().AndReturn(self.conns[0])
+        time.time().AndReturn(0)
+        time.time().AndReturn(100)
+        cups.Connection().AndReturn(self.conns[1])
+
+        self.mox.ReplayAll()
+
+        self.pool.put(self.pool.get())
+        self.assertTrue(self.pool.get() is self.conns[1])
+
+    def test_discard(self):
+        """Test that broken connections aren't reused"""
+        time.time().MultipleTimes().AndReturn(0)
+        cups.Connection().AndReturn(self.conns[0])
+        cups.Connection().AndReturn(self.conns[1])
+
+        self.mox.ReplayAll()
+
+        self.pool.discard(self.pool.get())
+        self.assertTrue(self.pool.get() is self.conns[1])
+
+
+class TestDestinations(mox.MoxTestBase):
+    def setUp(self):
+        super(TestDestinations, self).setUp()
+
+        self.dir = tempfile.mkdtemp()
+        self.printers_conf = os.path.join(self.dir, 'printers.conf')
+        open(self.printers_conf, 'w').close()
+        self.mox.stubs.Set(common, 'PRINTERS_CONF', self.printers_conf)
+        self.mox.stubs.Set(common, 'CLASSES_CONF',
+                           os.path.join(self.dir, 'classes.conf'))
+        self.mox.stubs.Set(common, '_destinations_cache',
+                           cache.FileCache('destinations', 60,
+                                           directory=self.dir))
+        self.mox.stubs.Set(common, '_materialized', set(['cupsd']))
+        self.mox.stubs.Set(common, '_destinations', None)
+        self.mox.stubs.Set(common, 'cupsd',
+                           self.mox.CreateMock(cups.Connection))
+
+    def tearDown(self):
+        super(TestDestinations, self).tearDown()
+        shutil.rmtree(self.dir)
+
+    def expect_fetch(self):
+        common.cupsd.getPrinters().AndReturn(
+            {'w20': {'device-uri': 'ipp://printers.mit.edu/printers/ajax'},
+             'patience': {'device-uri': 'mdns://patience._printer._tcp.local.'}})
+        common.cupsd.getClasses().AndReturn({'lab': ['w20', 'patience']})
+
+    def test_index(self):
+        """Test that every lookup is answered from one fetch"""
+        self.expect_fetch()
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(common.get_cups_uri('w20'),
+                         'ipp://printers.mit.edu/printers/ajax')
+        self.assertEqual(common.get_cups_uri('lab'), None)
+        self.assertEqual(common.get_cups_uri('ajax'), None)
+        self.assertTrue(common.is_local('patience'))
+        self.assertTrue(common.is_local('lab'))
+        self.assertFalse(common.is_local('ajax'))
+        self.assertEqual(common.local_queues(), ['lab', 'patience', 'w20'])
+
+    def test_case_insensitive(self):
+        """Test that destinations are found whatever the case"""
+        common.cupsd.getPrinters().AndReturn(
+            {'W20': {'device-uri': 'ipp://printers.mit.edu/printers/ajax'}})
+        common.cupsd.getClasses().AndReturn({'Lab': ['W20']})
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(common.get_cups_uri('w20'),
+                         'ipp://printers.mit.edu/printers/ajax')
+        self.assertEqual(common.get_cups_uri('W20'),
+                         'ipp://printers.mit.edu/printers/ajax')
+        self.assertTrue(common.is_local('LAB'))
+        self.assertEqual(common.local_queues(), ['Lab', 'W20'])
+
+    def test_known(self):
+        """Test that the index is only known once fetched or cached"""
+        self.expect_fetch()
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(common._known_destinations(), None)
+        index = common.get_destinations()
+        self.assertEqual(common._known_destinations(), index)
+        common._materialized.discard('destinations')
+        self.assertEqual(common._known_destinations(), index)
+        os.utime(self.printers_conf, (0, 0))
+        self.assertEqual(common._known_destinations(), None)
+
+    def test_cached_across_invocations(self):
+        """Test that the index is reused until printers.conf changes"""
+        self.expect_fetch()
+        self.expect_fetch()
+
+        self.mox.ReplayAll()
+
+        common.get_destinations()
+        for i in range(2):
+            # Simulate a new invocation
+            common._destinations = None
+            common._materialized.discard('destinations')
+            common.get_destinations()
+        os.utime(self.printers_conf, (0, 0))
+        common._destinations = None
+        common._materialized.discard('destinations')
+        common.get_destinations()
+
+    def test_invalidate(self):
+        """Test that invalidate_destinations forces a new fetch"""
+        self.expect_fetch()
+        self.expect_fetch()
+
+        self.mox.ReplayAll()
+
+        common.get_destinations()
+        common.invalidate_destinations()
+        common.get_destinations()
+
+    def test_invalidate_queue(self):
+        """Test that invalidate_queue forgets the queue's resolutions"""
+        self.mox.stubs.Set(common, '_resolution_cache',
+                           cache.FileCache('resolution', 60,
+                                           directory=self.dir))
+        for queue in ('w20', 'W20/2sided', 'w20x', 'ajax'):
+            common._resolution_cache.store(
+                queue, [[common.SYSTEM_CUPS, None, queue], None])
+        self.expect_fetch()
+        self.expect_fetch()
+
+        self.mox.ReplayAll()
+
+        common.get_destinations()
+        common.invalidate_queue('w20')
+        common.get_destinations()
+        self.assertEqual(sorted(k for k, v in common._resolution_cache.items()),
+                         ['ajax', 'w20x'])
+        common.invalidate_queue()
+        self.assertEqual(common._resolution_cache.items(), [])
+
+
+class TestGetDefaultPrinter(mox.MoxTestBase):
+    def setUp(self):
+        super(TestGetDefaultPrinter, self).setUp()
+
+        self.mox.stubs.Set(os, 'environ', {resolver.SOCKET_ENV: ''})
+        self.mox.stubs.Set(common, '_clusterinfo_cache', cache.NullCache())
+        self.mox.StubOutWithMock(common, '_get_cupsd')
+        self.mox.StubOutWithMock(common, 'get_os_release')
+        self.mox.StubOutWithMock(subprocess, 'Popen', use_mock_anything=True)
+
+    def test_cupsd_default(self):
+        """Test that the local cupsd's default printer is used"""
+        cupsd = self.mox.CreateMockAnything()
+        common._get_cupsd().AndReturn(cupsd)
+        cupsd.getDefault().AndReturn('ajax')
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(common.get_default_printer(), 'ajax')
+
+    def test_cluster_default(self):
+        """Test that the cluster's LPR printer is used, without a shell"""
+        common._get_cupsd().AndReturn(None)
+        common.get_os_release().AndReturn('14.04')
+        p = self.mox.CreateMockAnything()
+        subprocess.Popen(['getcluster', '-p', '14.04'],
+                         stdout=subprocess.PIPE).AndReturn(p)
+        p.communicate().AndReturn(('SYSPREFIX /afs/athena/system\n'
+                                   'LPR  ajax \n'
+                                   'BOGUS\n', None))
+        p.returncode = 0
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(common.get_default_printer(), 'ajax')
+
+    def test_getcluster_missing(self):
+        """Test that a missing getcluster just means no default"""
+        common._get_cupsd().AndReturn(None)
+        common.get_os_release().AndReturn('14.04')
+        subprocess.Popen(['getcluster', '-p', '14.04'],
+                         stdout=subprocess.PIPE).AndRaise(OSError(2, 'No such file or directory'))
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(common.get_default_printer(), None)
+
+    def test_not_resolver(self):
+        """Test that the resolver daemon isn't asked for the default printer"""
+        # It can't see this process's LPDEST or ~/.cups/lpoptions
+        os.environ[resolver.SOCKET_ENV] = '/run/resolver.sock'
+        os.environ['LPDEST'] = 'w20'
+        self.mox.StubOutWithMock(resolver, 'query')
+        cupsd = self.mox.CreateMockAnything()
+        common._get_cupsd().AndReturn(cupsd)
+        cupsd.getDefault().AndReturn('w20')
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(common.get_default_printer(), 'w20')
+
+
+class TestGetOSRelease(mox.MoxTestBase):
+    def setUp(self):
+        super(TestGetOSRelease, self).setUp()
+
+        self.dir = tempfile.mkdtemp()
+        for name in ('LSB_RELEASE', 'DEBIAN_VERSION', 'OS_RELEASE'):
+            self.mox.stubs.Set(common, name, os.path.join(self.dir, name))
+
+    def tearDown(self):
+        super(TestGetOSRelease, self).tearDown()
+        shutil.rmtree(self.dir)
+
+    def write(self, name, contents):
+        f = open(getattr(common, name), 'w')
+        f.write(contents)
+        f.close()
+
+    def test_lsb_release(self):
+        """Test reading the release from /etc/lsb-release"""
+        self.write('LSB_RELEASE', 'DISTRIB_ID=Ubuntu\nDISTRIB_RELEASE=14.04\n')
+        self.write('DEBIAN_VERSION', 'jessie/sid\n')
+        self.assertEqual(common.get_os_release(), '14.04')
+
+    def test_debian_version(self):
+        """Test reading the point release on Debian"""
+        self.write('DEBIAN_VERSION', '8.6\n')
+        self.write('OS_RELEASE', 'VERSION_ID="8"\n')
+        self.assertEqual(common.get_os_release(), '8.6')
+
+    def test_os_release(self):
+        """Test falling back to /etc/os-release"""
+        self.write('DEBIAN_VERSION', 'stretch/sid\n')
+        self.write('OS_RELEASE', 'NAME="Foo"\nVERSION_ID="16.04"\n')
+        self.assertEqual(common.get_os_release(), '16.04')
+
+    def test_nothing(self):
+        """Test that get_os_release copes with no release files"""
+        self.assertEqual(common.get_os_release(), None)
+
+
+class TestComparePackageVersion(mox.MoxTestBase):
+    def setUp(self):
+        super(TestComparePackageVersion, self).setUp()
+
+        self.dir = tempfile.mkdtemp()
+        self.status = os.path.join(self.dir, 'status')
+        open(self.status, 'w').close()
+        self.mox.stubs.Set(common, 'DPKG_STATUS', self.status)
+        self.mox.stubs.Set(common, '_capability_cache',
+                           cache.FileCache('capabilities', 60,
+                                           directory=self.dir))
+        self.mox.StubOutWithMock(common, '_compare_package_version')
+
+    def tearDown(self):
+        super(TestComparePackageVersion, self).tearDown()
+        shutil.rmtree(self.dir)
+
+    def test_cached(self):
+        """Test that package versions are only compared once"""
+        common._compare_package_version('cups-bsd', 'lt-nl', '1.4').AndReturn(False)
+
+        self.mox.ReplayAll()
+
+        for i in range(2):
+            self.assertEqual(
+                common.compare_package_version('cups-bsd', 'lt-nl', '1.4'),
+                False)
+
+    def test_dpkg_changed(self):
+        """Test that changes to the dpkg database invalidate the cache"""
+        common._compare_package_version('cups-bsd', 'lt-nl', '1.4').AndReturn(True)
+        common._compare_package_version('cups-bsd', 'lt-nl', '1.4').AndReturn(False)
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(
+            common.compare_package_version('cups-bsd', 'lt-nl', '1.4'),
+            True)
+        os.utime(self.status, (0, 0))
+        self.assertEqual(
+            common.compare_package_version('cups-bsd', 'lt-nl', '1.4'),
+            False)
+
+    def test_not_debian(self):
+        """Test that non-Debian systems don't run dpkg at all"""
+        os.unlink(self.status)
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(
+            common.compare_package_version('cups-bsd', 'lt-nl', '1.4'),
+            False)
+
 
 class TestGetHesiodPrintServer(mox.MoxTestBase):
     def setUp(self):
         super(TestGetHesiodPrintServer, self).setUp()
 
+        self.dir = tempfile.mkdtemp()
+        self.mox.stubs.Set(common, '_materialized', set(['pcap']))
+        self.mox.stubs.Set(common, '_pcap_snapshot', None)
+        self.mox.StubOutWithMock(common, '_hesiod_lookup')
+
+    def tearDown(self):
+        super(TestGetHesiodPrintServer, self).tearDown()
+        shutil.rmtree(self.dir)
+
+    def use_snapshot(self, ttl):
+        path = os.path.join(self.dir, 'pcap.db')
+        pcapdb.write(path, {'ajax': 'ajax:rp=ajax:rm=SNAPSHOT.MIT.EDU:ka#0:mc#0:'},
+                     ttl=ttl)
+        common._pcap_snapshot = pcapdb.Snapshot(path)
+
     def test_parse_pcap(self):
         """Test get_hesiod_print_server's ability to parse pcap records"""
-        self.mox.StubOutWithMock(common, '_hesiod_lookup')
+        common._hesiod_lookup('ajax', 'pcap').AndReturn(
+            ['ajax:rp=ajax:rm=GET-PRINT.MIT.EDU:ka#0:mc#0:'])
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(common.get_hesiod_print_server('ajax'),
+                         'GET-PRINT.MIT.EDU')
+
+    def test_snapshot(self):
+        """Test that a fresh snapshot is used without a live lookup"""
+        self.use_snapshot(60)
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(common.get_hesiod_print_server('AJAX'),
+                         'SNAPSHOT.MIT.EDU')
+
+    def test_snapshot_miss(self):
+        """Test that queues missing from the snapshot are looked up live"""
+        self.use_snapshot(60)
+        common._hesiod_lookup('w20', 'pcap').AndReturn(
+            ['w20:rp=w20:rm=GET-PRINT.MIT.EDU:ka#0:mc#0:'])
 
+        self.mox.ReplayAll()
+
+        self.assertEqual(common.get_hesiod_print_server('w20'),
+                         'GET-PRINT.MIT.EDU')
+
+    def test_expired_snapshot(self):
+        """Test that an expired snapshot is only used if Hesiod fails"""
+        self.use_snapshot(-1)
         common._hesiod_lookup('ajax', 'pcap').AndReturn(
             ['ajax:rp=ajax:rm=GET-PRINT.MIT.EDU:ka#0:mc#0:'])
+        common._hesiod_lookup('ajax', 'pcap').AndReturn([])
 
         self.mox.ReplayAll()
 
         self.assertEqual(common.get_hesiod_print_server('ajax'),
                          'GET-PRINT.MIT.EDU')
+        self.assertEqual(common.get_hesiod_print_server('ajax'),
+                         'SNAPSHOT.MIT.EDU')
 
 
 class TestFindQueue(mox.MoxTestBase):
     def setUp(self):
         super(TestFindQueue, self).setUp()
 
+        self.mox.stubs.Set(common, '_resolution_cache', cache.NullCache())
         self.mox.StubOutWithMock(common, 'canonicalize_queue')
         self.mox.StubOutWithMock(common, 'get_hesiod_print_server')
         self.mox.StubOutWithMock(common, 'is_cups_server')
+        self.mox.stubs.Set(common, '_in_background', synchronously)
+        self.mox.stubs.Set(common, '_known_destinations', lambda: None)
 
     def test_local_mdns_queue(self):
         """Verify that find_queue doesn't interfere with truly local printers."""
-        common.canonicalize_queue('foo').AndReturn(None)
+        # The speculative lookup is wasted
+        common.get_hesiod_print_server('foo').AndReturn(None)
+        common.canonicalize_queue('foo', None).AndReturn(None)
 
         self.mox.ReplayAll()
 
@@ -163,8 +708,8 @@ class TestFindQueue(mox.MoxTestBase):
 
     def test_athena_cups_queue(self):
         """Verify that find_queue can find non-local Athena queues on CUPS"""
-        common.canonicalize_queue('ajax').AndReturn('ajax')
         common.get_hesiod_print_server('ajax').AndReturn('GET-PRINT.MIT.EDU')
+        common.canonicalize_queue('ajax', None).AndReturn('ajax')
         # We no longer call "is_cups_server"
         # common.is_cups_server('GET-PRINT.MIT.EDU').AndReturn(True)
 
@@ -175,7 +720,7 @@ class TestFindQueue(mox.MoxTestBase):
 
     # def test_athena_lprng_queue(self):
     #     """Verify that find_queue can find non-local Athena queues on LPRng"""
-    #     common.canonicalize_queue('ashdown').AndReturn('ashdown')
+    #     common.canonicalize_queue('ashdown', None).AndReturn('ashdown')
     #     common.get_hesiod_print_server('ashdown').AndReturn('MULCH.MIT.EDU')
     #     common.is_cups_server('MULCH.MIT.EDU').AndReturn(False)
 
@@ -186,7 +731,8 @@ class TestFindQueue(mox.MoxTestBase):
 
     def test_misnamed_local_queue(self):
         """Verify that find_queue will use canonicalized queue names"""
-        common.canonicalize_queue('w20').AndReturn('ajax')
+        common.get_hesiod_print_server('w20').AndReturn(None)
+        common.canonicalize_queue('w20', None).AndReturn('ajax')
         common.get_hesiod_print_server('ajax').AndReturn('GET-PRINT.MIT.EDU')
         # We no longer call "is_cups_server"
         # common.is_cups_server('GET-PRINT.MIT.EDU').AndReturn(True)
@@ -198,8 +744,8 @@ class TestFindQueue(mox.MoxTestBase):
 
     def test_queue_with_instance(self):
         """Verify that find_queue will strip instances"""
-        common.canonicalize_queue('ajax/2sided').AndReturn('ajax/2sided')
         common.get_hesiod_print_server('ajax').AndReturn('GET-PRINT.MIT.EDU')
+        common.canonicalize_queue('ajax/2sided', None).AndReturn('ajax/2sided')
         # We no longer call "is_cups_server"
         # common.is_cups_server('GET-PRINT.MIT.EDU').AndReturn(True)
 
@@ -210,14 +756,493 @@ class TestFindQueue(mox.MoxTestBase):
 
     def test_canonicalize_queue_confusion(self):
         """Test that find_queue will bail in case of confusion"""
-        common.canonicalize_queue('ajax').AndReturn('ajax')
         common.get_hesiod_print_server('ajax').AndReturn(None)
+        common.canonicalize_queue('ajax', None).AndReturn('ajax')
 
         self.mox.ReplayAll()
 
         self.assertEqual(common.find_queue('ajax'),
                          (common.SYSTEM_CUPS, None, 'ajax'))
 
+    def test_known_local_queue(self):
+        """Verify that Hesiod isn't asked about queues known to be local"""
+        self.mox.stubs.Set(common, '_known_destinations',
+                           lambda: {'foo': ['foo', 'usb://HP/LaserJet%201020']})
+        common.canonicalize_queue('foo', None).AndReturn(None)
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(common.find_queue('foo'),
+                         (common.SYSTEM_CUPS, None, 'foo'))
+
+    def test_refresh_not_speculative(self):
+        """Verify that re-resolving a cached queue doesn't guess"""
+        self.mox.stubs.Set(common, '_cached_resolution', lambda queue: (
+                (common.SYSTEM_CUPS, 'GET-PRINT.MIT.EDU', 'ajax'),
+                cache.STALE))
+        common.canonicalize_queue('ajax', None).AndReturn('ajax')
+        common.get_hesiod_print_server('ajax').AndReturn('GET-PRINT.MIT.EDU')
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(common._find_queue('ajax'),
+                         (common.SYSTEM_CUPS, 'GET-PRINT.MIT.EDU', 'ajax'))
+
+
+class TestInBackground(mox.MoxTestBase):
+    def test_concurrent(self):
+        """Test that a lookup runs alongside the caller"""
+        started = threading.Event()
+        def lookup(queue):
+            started.set()
+            release.wait(5)
+            return queue.upper()
+        release = threading.Event()
+
+        wait = common._in_background(lookup, 'ajax')
+        # If the lookup didn't run in the background, we'd never get
+        # here to release it
+        self.assertTrue(started.wait(5))
+        release.set()
+        self.assertEqual(wait(), 'AJAX')
+
+    def test_exception(self):
+        """Test that exceptions are raised when the result is collected"""
+        def lookup():
+            raise IOError(110, 'Connection timed out')
+        wait = common._in_background(lookup)
+        self.assertRaises(IOError, wait)
+
+    def test_find_queue_latency(self):
+        """Test that the cupsd and Hesiod lookups overlap"""
+        self.mox.stubs.Set(common, '_resolution_cache', cache.NullCache())
+        def canonicalize_queue(queue, resolution=None):
+            time.sleep(0.1)
+            return queue
+        def get_hesiod_print_server(queue):
+            time.sleep(0.1)
+            return 'GET-PRINT.MIT.EDU'
+        self.mox.stubs.Set(common, 'canonicalize_queue', canonicalize_queue)
+        self.mox.stubs.Set(common, 'get_hesiod_print_server',
+                           get_hesiod_print_server)
+
+        start = time.time()
+        self.assertEqual(common.find_queue('ajax'),
+                         (common.SYSTEM_CUPS, 'GET-PRINT.MIT.EDU', 'ajax'))
+        self.assertTrue(time.time() - start < 0.19)
+
+
+class TestResolution(mox.MoxTestBase):
+    def setUp(self):
+        super(TestResolution, self).setUp()
+
+        self.mox.stubs.Set(os, 'environ', {resolver.SOCKET_ENV: ''})
+        self.mox.stubs.Set(common, '_resolution_cache', cache.NullCache())
+        self.mox.StubOutWithMock(common, 'get_cups_uri')
+        self.mox.StubOutWithMock(common, 'get_hesiod_print_server')
+        self.mox.StubOutWithMock(common, 'select_cups_server')
+        self.mox.stubs.Set(common, '_in_background', synchronously)
+
+    def test_nonexistent(self):
+        """Test that a Resolution looks each thing up once"""
+        common.get_hesiod_print_server('stark').AndReturn(None)
+        common.get_cups_uri('stark').AndReturn(None)
+
+        self.mox.ReplayAll()
+
+        r = common.Resolution('stark')
+        self.assertEqual(r.system, common.SYSTEM_CUPS)
+        self.assertEqual(r.server, None)
+        self.assertEqual(r.canonical, 'stark')
+        self.assertEqual(r.uri, None)
+        self.assertEqual(r.find_queue(), (common.SYSTEM_CUPS, None, 'stark'))
+
+    def test_misnamed(self):
+        """Test a Resolution for a local queue bouncing to an Athena queue"""
+        self.mox.stubs.Set(common, '_materialized', set(['backends']))
+        common.get_hesiod_print_server('w20').AndReturn(None)
+        common.get_cups_uri('w20').AndReturn('ipp://printers.mit.edu:631/printers/ajax')
+        common.get_hesiod_print_server('ajax').AndReturn('GET-PRINT.MIT.EDU')
+        common.select_cups_server('GET-PRINT.MIT.EDU').AndReturn('GET-PRINT.MIT.EDU')
+        common.get_cups_uri('ajax').AndReturn(None)
+
+        self.mox.ReplayAll()
+
+        r = common.Resolution('w20')
+        self.assertEqual(r.canonical, 'ajax')
+        self.assertEqual(r.server, 'GET-PRINT.MIT.EDU')
+        self.assertEqual(r.uri, None)
+        self.assertEqual(r.uri, None)
+
+
+class TestAskResolver(mox.MoxTestBase):
+    def setUp(self):
+        super(TestAskResolver, self).setUp()
+
+        self.mox.stubs.Set(os, 'environ', {})
+        self.mox.stubs.Set(common, '_deadline', None)
+        self.mox.StubOutWithMock(resolver, 'query')
+        self.mox.StubOutWithMock(common, 'get_cups_uri')
+
+    def test_answered(self):
+        """Test that a Resolution takes the daemon's answers"""
+        resolver.query('find_queue', 'w20', timeout=resolver.TIMEOUT).AndReturn(
+            [common.SYSTEM_CUPS, 'GET-PRINT.MIT.EDU', 'ajax', None])
+        resolver.query('get_cups_uri', 'w20',
+                       timeout=resolver.TIMEOUT).AndReturn(
+            'ipp://printers.mit.edu/printers/ajax')
+
+        self.mox.ReplayAll()
+
+        r = common.Resolution('w20')
+        self.assertEqual(r.find_queue(),
+                         (common.SYSTEM_CUPS, 'GET-PRINT.MIT.EDU', 'ajax'))
+        self.assertEqual(r.uri, None)
+        self.assertEqual(r.get_cups_uri('w20'),
+                         'ipp://printers.mit.edu/printers/ajax')
+
+    def test_unanswered(self):
+        """Test that questions the daemon can't answer are answered here"""
+        resolver.query('get_cups_uri', 'w20', timeout=resolver.TIMEOUT).AndRaise(
+            resolver.ResolverError('The resolver is disabled'))
+        common.get_cups_uri('w20').AndReturn(None)
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(common.Resolution('w20').get_cups_uri('w20'), None)
+
+    def test_cups_server(self):
+        """Test that the daemon isn't asked about other CUPS servers"""
+        os.environ['CUPS_SERVER'] = 'localhost:8631'
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(common._ask_resolver('get_cups_uri', 'w20'),
+                         (False, None))
+
+
+class TestProbeCupsServers(mox.MoxTestBase):
+    def setUp(self):
+        super(TestProbeCupsServers, self).setUp()
+
+        self.probed = []
+        self.delays = {}
+        self.live = set()
+        self.mox.stubs.Set(common, 'is_cups_server', self.is_cups_server)
+
+    def is_cups_server(self, host, timeout=common.PROBE_TIMEOUT):
+        self.probed.append(host)
+        time.sleep(self.delays.get(host, 0))
+        return host in self.live
+
+    def test_first_live(self):
+        """Test that probing stops at the first host to answer"""
+        self.live = set(['a', 'b'])
+        found = common.probe_cups_servers(['a', 'b', 'c'], stagger=1)
+        self.assertEqual(found.keys(), ['a'])
+        self.assertEqual(self.probed, ['a'])
+
+    def test_failed_host(self):
+        """Test that a host that fails doesn't hold up the next"""
+        self.live = set(['b'])
+        start = time.time()
+        found = common.probe_cups_servers(['a', 'b', 'c'], stagger=10)
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(found['a'], None)
+        self.assertTrue(found['b'] is not None)
+        self.assertFalse('c' in found)
+
+    def test_slow_host(self):
+        """Test that a slow host loses to a quicker one"""
+        self.live = set(['a', 'b'])
+        self.delays['a'] = 0.5
+        found = common.probe_cups_servers(['a', 'b'], timeout=1,
+                                          stagger=0.05)
+        self.assertEqual(found.keys(), ['b'])
+
+    def test_none_live(self):
+        """Test probing when nothing answers"""
+        found = common.probe_cups_servers(['a', 'b'], stagger=0)
+        self.assertEqual(found, {'a': None, 'b': None})
+
+
+class TestSelectCupsServer(mox.MoxTestBase):
+    def setUp(self):
+        super(TestSelectCupsServer, self).setUp()
+
+        self.dir = tempfile.mkdtemp()
+        self.mox.stubs.Set(common, '_liveness_cache',
+                           cache.FileCache('liveness', 60,
+                                           directory=self.dir))
+        self.mox.stubs.Set(common, 'CUPS_FRONTENDS',
+                           ['printers.mit.edu', 'cluster-printers.mit.edu'])
+        self.mox.StubOutWithMock(common, 'probe_cups_servers')
+
+    def tearDown(self):
+        super(TestSelectCupsServer, self).tearDown()
+        shutil.rmtree(self.dir)
+
+    def test_live(self):
+        """Test that a live server is used, and remembered"""
+        common.probe_cups_servers(['GET-PRINT.MIT.EDU', 'printers.mit.edu',
+                                   'cluster-printers.mit.edu']).AndReturn(
+            {'GET-PRINT.MIT.EDU': 0.01})
+
+        self.mox.ReplayAll()
+
+        for i in range(2):
+            self.assertEqual(common.select_cups_server('GET-PRINT.MIT.EDU'),
+                             'GET-PRINT.MIT.EDU')
+
+    def test_failover(self):
+        """Test failing over to a frontend when the server is down"""
+        common.probe_cups_servers(['GET-PRINT.MIT.EDU', 'printers.mit.edu',
+                                   'cluster-printers.mit.edu']).AndReturn(
+            {'GET-PRINT.MIT.EDU': None, 'printers.mit.edu': 0.02})
+
+        self.mox.ReplayAll()
+
+        for i in range(2):
+            self.assertEqual(common.select_cups_server('GET-PRINT.MIT.EDU'),
+                             'printers.mit.edu')
+
+    def test_frontend(self):
+        """Test that a frontend isn't probed twice"""
+        common.probe_cups_servers(['PRINTERS.MIT.EDU',
+                                   'cluster-printers.mit.edu']).AndReturn(
+            {'PRINTERS.MIT.EDU': 0.01})
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(common.select_cups_server('PRINTERS.MIT.EDU'),
+                         'PRINTERS.MIT.EDU')
+
+    def test_all_down(self):
+        """Test that the server is kept when nothing is answering"""
+        common.probe_cups_servers(['GET-PRINT.MIT.EDU', 'printers.mit.edu',
+                                   'cluster-printers.mit.edu']).AndReturn(
+            {'GET-PRINT.MIT.EDU': None, 'printers.mit.edu': None,
+             'cluster-printers.mit.edu': None})
+
+        self.mox.ReplayAll()
+
+        for i in range(2):
+            self.assertEqual(common.select_cups_server('GET-PRINT.MIT.EDU'),
+                             'GET-PRINT.MIT.EDU')
+
+    def test_lpd_server(self):
+        """Test that LPD servers aren't probed"""
+        self.mox.ReplayAll()
+
+        self.assertEqual(common.select_cups_server('PHAROS-PRODP1.MIT.EDU'),
+                         'PHAROS-PRODP1.MIT.EDU')
+        self.assertEqual(common.select_cups_server(None), None)
+
+
+class TestDeadline(mox.MoxTestBase):
+    def setUp(self):
+        super(TestDeadline, self).setUp()
+
+        self.mox.stubs.Set(common, '_deadline', None)
+
+    def test_start(self):
+        """Test configuring the deadline"""
+        self.mox.stubs.Set(os, 'environ', {})
+        self.assertTrue(common.start_deadline().remaining() <= common.DEADLINE)
+        os.environ[common.DEADLINE_ENV] = '0'
+        self.assertEqual(common.start_deadline(), None)
+        self.assertEqual(common.deadline_timeout(10), 10)
+        os.environ[common.DEADLINE_ENV] = '0.5'
+        common.start_deadline()
+        self.assertTrue(common.deadline_timeout(10) <= 0.5)
+
+    def test_no_deadline(self):
+        """Test that without a deadline, functions are just called"""
+        self.assertEqual(common.run_within_deadline('test', lambda: 1, None),
+                         1)
+
+    def test_within(self):
+        """Test that results and exceptions are passed on"""
+        common.start_deadline(10)
+        self.assertEqual(common.run_within_deadline('test', lambda: 1, None),
+                         1)
+        self.assertRaises(KeyError, common.run_within_deadline,
+                          'test', lambda: {}['ajax'], None)
+
+    def test_expired(self):
+        """Test that the fallback is used once the deadline has passed"""
+        release = threading.Event()
+        common.start_deadline(0.01)
+        self.assertEqual(common.run_within_deadline('test', release.wait,
+                                                    lambda: 'fallback'),
+                         'fallback')
+        release.set()
+        self.assertEqual(common.run_within_deadline('test', lambda: 1,
+                                                    lambda: 'fallback'),
+                         'fallback')
+
+
+class TestFallbackResolution(mox.MoxTestBase):
+    def setUp(self):
+        super(TestFallbackResolution, self).setUp()
+
+        self.mox.stubs.Set(common, '_resolution_cache', cache.NullCache())
+        self.mox.stubs.Set(common, '_materialized', set(['destinations']))
+        self.mox.stubs.Set(common, '_destinations',
+                           {'home': ['Home', 'usb://HP/LaserJet%201020']})
+
+    def test_cached(self):
+        """Test that a cached resolution is used, even a stale one"""
+        dir = tempfile.mkdtemp()
+        try:
+            self.mox.stubs.Set(common, '_resolution_cache',
+                               cache.FileCache('resolution', 0, 60,
+                                               directory=dir))
+            common._resolution_cache.store(
+                'w20', [[common.SYSTEM_CUPS, 'GET-PRINT.MIT.EDU', 'ajax'],
+                        common._resolution_context()])
+            self.assertEqual(common._fallback_resolution('w20'),
+                             (common.SYSTEM_CUPS, 'GET-PRINT.MIT.EDU', 'ajax'))
+        finally:
+            shutil.rmtree(dir)
+
+    def test_local(self):
+        """Test that local queues are left to the local cupsd"""
+        self.assertEqual(common._fallback_resolution('home'),
+                         (common.SYSTEM_CUPS, None, 'home'))
+
+    def test_frontend(self):
+        """Test that anything else goes to the first frontend"""
+        self.assertEqual(common._fallback_resolution('ajax/2sided'),
+                         (common.SYSTEM_CUPS, common.CUPS_FRONTENDS[0],
+                          'ajax'))
+
+
+class TestFindQueueCache(mox.MoxTestBase):
+    def setUp(self):
+        super(TestFindQueueCache, self).setUp()
+
+        self.dir = tempfile.mkdtemp()
+        self.mox.stubs.Set(common, '_resolution_cache',
+                           cache.FileCache('resolution', 60, 60,
+                                           directory=self.dir))
+        self.mox.StubOutWithMock(common, '_find_queue')
+        self.mox.StubOutWithMock(cache, 'detach')
+        self.context = ['localhost', [1, 2]]
+        self.mox.stubs.Set(common, '_resolution_context',
+                           lambda: list(self.context))
+
+    def tearDown(self):
+        super(TestFindQueueCache, self).tearDown()
+        shutil.rmtree(self.dir)
+
+    def test_miss_then_hit(self):
+        """Verify that find_queue only resolves a queue once"""
+        common._find_queue('ajax', None).AndReturn(
+            (common.SYSTEM_CUPS, 'GET-PRINT.MIT.EDU', 'ajax'))
+
+        self.mox.ReplayAll()
+
+        for i in range(2):
+            self.assertEqual(common.find_queue('ajax'),
+                             (common.SYSTEM_CUPS, 'GET-PRINT.MIT.EDU', 'ajax'))
+
+    def test_stale(self):
+        """Verify that stale resolutions are used and refreshed in the background"""
+        common._resolution_cache.store(
+            'ajax', [[common.SYSTEM_CUPS, 'GET-PRINT.MIT.EDU', 'ajax'],
+                     self.context],
+            now=0)
+        common._resolution_cache.ttl = 0
+        common._resolution_cache.stale = 1e12
+        self.mox.stubs.Set(threading, 'active_count', lambda: 1)
+        cache.detach(common._refresh_queue, 'ajax')
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(common.find_queue('ajax'),
+                         (common.SYSTEM_CUPS, 'GET-PRINT.MIT.EDU', 'ajax'))
+
+    def test_stale_threaded(self):
+        """Verify that a threaded process refreshes in a thread, not a fork"""
+        common._resolution_cache.store(
+            'ajax', [[common.SYSTEM_CUPS, 'GET-PRINT.MIT.EDU', 'ajax'],
+                     self.context],
+            now=0)
+        common._resolution_cache.ttl = 0
+        common._resolution_cache.stale = 1e12
+        refreshed = threading.Event()
+        def find_queue(queue, resolution=None):
+            # As get_destinations would
+            common._cupsd_lock.acquire()
+            common._cupsd_lock.release()
+            refreshed.set()
+            return common.SYSTEM_CUPS, 'MULCH.MIT.EDU', 'ajax'
+        self.mox.stubs.Set(common, '_find_queue', find_queue)
+
+        self.mox.ReplayAll()
+
+        # Another thread is busy with the local cupsd
+        locked = threading.Event()
+        release = threading.Event()
+        def hold():
+            common._cupsd_lock.acquire()
+            locked.set()
+            release.wait(5)
+            common._cupsd_lock.release()
+        holder = threading.Thread(target=hold)
+        holder.start()
+        locked.wait(5)
+        try:
+            self.assertEqual(common.find_queue('ajax'),
+                             (common.SYSTEM_CUPS, 'GET-PRINT.MIT.EDU', 'ajax'))
+            self.assertFalse(refreshed.isSet())
+        finally:
+            release.set()
+            holder.join()
+        refreshed.wait(5)
+        refreshed = (common.SYSTEM_CUPS, 'MULCH.MIT.EDU', 'ajax')
+        for i in range(100):
+            if common._cached_resolution('ajax')[0] == refreshed:
+                break
+            time.sleep(0.01)
+        self.assertEqual(common._cached_resolution('ajax')[0], refreshed)
+
+    def test_failed_lookup(self):
+        """Verify that a resolution made while a lookup failed isn't cached"""
+        common._find_queue('ajax', None).WithSideEffects(
+            lambda *args: common._note_lookup_failure()).AndReturn(
+            (common.SYSTEM_CUPS, None, 'ajax'))
+        common._find_queue('ajax', None).AndReturn(
+            (common.SYSTEM_CUPS, 'GET-PRINT.MIT.EDU', 'ajax'))
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(common.find_queue('ajax'),
+                         (common.SYSTEM_CUPS, None, 'ajax'))
+        for i in range(2):
+            self.assertEqual(common.find_queue('ajax'),
+                             (common.SYSTEM_CUPS, 'GET-PRINT.MIT.EDU', 'ajax'))
+
+    def test_context_changed(self):
+        """Verify that resolutions are redone for another CUPS server or configuration"""
+        common._find_queue('ajax', None).AndReturn(
+            (common.SYSTEM_CUPS, 'GET-PRINT.MIT.EDU', 'ajax'))
+        common._find_queue('ajax', None).AndReturn(
+            (common.SYSTEM_CUPS, None, 'ajax'))
+        common._find_queue('ajax', None).AndReturn(
+            (common.SYSTEM_CUPS, 'GET-PRINT.MIT.EDU', 'ajax'))
+
+        self.mox.ReplayAll()
+
+        common.find_queue('ajax')
+        self.context[1] = [1, 3]
+        self.assertEqual(common.find_queue('ajax'),
+                         (common.SYSTEM_CUPS, None, 'ajax'))
+        self.context[0] = 'cups.example.com'
+        self.assertEqual(common.find_queue('ajax'),
+                         (common.SYSTEM_CUPS, 'GET-PRINT.MIT.EDU', 'ajax'))
+
 
 class TestDispatchCommand(mox.MoxTestBase):
     def setUp(self):
@@ -255,5 +1280,85 @@ class TestDispatchCommand(mox.MoxTestBase):
                           ['the_universe', 'everything'])
 
 
+class TestTrace(mox.MoxTestBase):
+    def setUp(self):
+        super(TestTrace, self).setUp()
+
+        self.dir = tempfile.mkdtemp()
+        self.trace = os.path.join(self.dir, 'trace')
+
+    def tearDown(self):
+        super(TestTrace, self).tearDown()
+        shutil.rmtree(self.dir)
+
+    def records(self):
+        f = open(self.trace)
+        try:
+            return [json.loads(line) for line in f]
+        finally:
+            f.close()
+
+    def test_disabled(self):
+        """Test that nothing is traced without DEBATHENA_DEBUG"""
+        self.mox.stubs.Set(os, 'environ', {common.TRACE_FILE_ENV: self.trace})
+
+        span = common.trace_span('find_queue', queue='ajax')
+        span.finish()
+
+        self.assertTrue(span is common._null_span)
+        self.assertFalse(os.path.exists(self.trace))
+
+    def test_file(self):
+        """Test that spans are appended to DEBATHENA_TRACE_FILE"""
+        self.mox.stubs.Set(os, 'environ', {'DEBATHENA_DEBUG': '1',
+                                           common.TRACE_FILE_ENV: self.trace})
+
+        outer = common.trace_span('find_queue', queue='ajax')
+        inner = common.trace_span('_hesiod_lookup')
+        inner.finish(source='hesiod')
+        outer.set(server='GET-PRINT.MIT.EDU')
+        outer.finish()
+        common.trace_event('exec', command='cups-lpr')
+
+        inner, outer, event = self.records()
+        self.assertEqual(inner['span'], '_hesiod_lookup')
+        self.assertEqual(inner['parent'], 'find_queue')
+        self.assertEqual(inner['source'], 'hesiod')
+        self.assertEqual(outer['queue'], 'ajax')
+        self.assertEqual(outer['server'], 'GET-PRINT.MIT.EDU')
+        self.assertTrue('parent' not in outer)
+        self.assertTrue(outer['duration'] >= inner['duration'])
+        self.assertEqual(event['command'], 'cups-lpr')
+        self.assertEqual(event['pid'], os.getpid())
+
+    def test_stderr(self):
+        """Test that spans go to stderr by default"""
+        self.mox.stubs.Set(os, 'environ', {'DEBATHENA_DEBUG': '1'})
+        self.mox.stubs.Set(sys, 'stderr', StringIO.StringIO())
+
+        common.trace_event('exec', command='cups-lpr')
+
+        self.assertEqual(json.loads(sys.stderr.getvalue())['span'], 'exec')
+
+    def test_hesiod_lookup(self):
+        """Test that _hesiod_lookup records where its answer came from"""
+        self.mox.stubs.Set(os, 'environ', {'DEBATHENA_DEBUG': '1',
+                                           common.TRACE_FILE_ENV: self.trace})
+        self.mox.stubs.Set(common, '_hesiod_memory', cache.LRUCache(10))
+        self.mox.stubs.Set(common, '_hesiod_cache', cache.NullCache())
+        self.mox.StubOutWithMock(hesiod, 'Lookup', use_mock_anything=True)
+        result = self.mox.CreateMockAnything()
+        result.results = ['GET-PRINT.MIT.EDU']
+        hesiod.Lookup('cups-print', 'sloc').AndReturn(result)
+
+        self.mox.ReplayAll()
+
+        common._hesiod_lookup('cups-print', 'sloc')
+        common._hesiod_lookup('cups-print', 'sloc')
+
+        self.assertEqual([r['source'] for r in self.records()],
+                         ['hesiod', 'memory'])
+
+
 if __name__ == '__main__':
     unittest.main()
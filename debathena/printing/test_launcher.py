@@ -0,0 +1,106 @@
+#!/usr/bin/python
+"""Test suite for debathena.printing.launcher"""
+
+
+import os
+import StringIO
+import subprocess
+import sys
+import unittest
+
+import mox
+
+from debathena.printing import launcher
+from debathena.printing import lp
+from debathena.printing import lpq
+from debathena.printing import lpr
+
+
+# How long importing debathena.printing.lpr may take, in seconds
+STARTUP_BUDGET = 0.1
+STARTUP_SAMPLES = 3
+
+
+class TestLauncher(mox.MoxTestBase):
+    def test_wrapper_name(self):
+        """Test recognizing the names the wrappers are installed as"""
+        self.assertEqual(launcher.wrapper_name('/usr/bin/lpr.debathena'), 'lpr')
+        self.assertEqual(launcher.wrapper_name('/usr/bin/lpq'), 'lpq')
+        self.assertEqual(launcher.wrapper_name('lp'), 'lp')
+        self.assertEqual(launcher.wrapper_name('lpstat'), None)
+        self.assertEqual(launcher.wrapper_name('/usr/bin/debathena-printing'),
+                         None)
+
+    def test_dispatch(self):
+        """Test dispatching on argv[0]"""
+        self.mox.StubOutWithMock(lpr, '_main')
+        lpr._main(['/usr/bin/lpr.debathena', '-Pajax']).AndReturn(0)
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(launcher._main(['/usr/bin/lpr.debathena', '-Pajax']),
+                         0)
+
+    def test_dispatch_displaced(self):
+        """Test dispatching when run through the displaced name"""
+        self.mox.StubOutWithMock(lp, '_main')
+        lp._main(['/usr/bin/lp', '-d', 'ajax']).AndReturn(0)
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(launcher._main(['/usr/bin/lp', '-d', 'ajax']), 0)
+
+    def test_dispatch_explicit(self):
+        """Test naming the wrapper as the first argument"""
+        self.mox.StubOutWithMock(lpq, '_main')
+        lpq._main(['lpq', '-Pajax']).AndReturn(1)
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(launcher._main(['/usr/bin/debathena-printing',
+                                         'lpq', '-Pajax']),
+                         1)
+
+    def test_unknown(self):
+        """Test that an unknown wrapper is a usage error"""
+        self.mox.stubs.Set(sys, 'stderr', StringIO.StringIO())
+        self.assertEqual(launcher._main(['/usr/bin/debathena-printing']), 2)
+        self.assertEqual(launcher._main(['/usr/bin/debathena-printing',
+                                         'lpstat']),
+                         2)
+
+
+class TestStartup(mox.MoxTestBase):
+    def test_import_budget(self):
+        """Test that importing lpr is quick and doesn't load cups or hesiod"""
+        # The debathena namespace package goes through pkg_resources,
+        # which isn't ours to speed up, so it's imported before timing
+        code = ('import sys, time\n'
+                'import debathena\n'
+                'start = time.time()\n'
+                'import debathena.printing.lpr\n'
+                'elapsed = time.time() - start\n'
+                'sys.stdout.write("%r %d %d" % (elapsed,\n'
+                '                               "cups" in sys.modules,\n'
+                '                               "hesiod" in sys.modules))\n')
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, sys.path))
+
+        times = []
+        for i in range(STARTUP_SAMPLES):
+            p = subprocess.Popen([sys.executable, '-c', code], env=env,
+                                 stdout=subprocess.PIPE)
+            output = p.communicate()[0]
+            self.assertEqual(p.returncode, 0)
+            elapsed, has_cups, has_hesiod = output.split()
+            self.assertEqual(has_cups, '0')
+            self.assertEqual(has_hesiod, '0')
+            times.append(float(elapsed))
+
+        # The first import may have had to byte-compile the modules
+        self.assertTrue(min(times) < STARTUP_BUDGET,
+                        'import took %.1fms' % (1000 * min(times)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+#!/usr/bin/python
+"""Test suite for debathena.printing.lpd
+
+The tests run against a stand-in LPD server listening on localhost,
+which records the commands it receives and answers them with canned
+replies.
+"""
+
+
+import os
+import socket
+import StringIO
+import threading
+import unittest
+
+import mox
+
+from debathena.printing import lpd
+
+
+class FakeLPDServer(threading.Thread):
+    """A minimal LPD server that answers a fixed number of commands.
+
+    Each reply is sent in several chunks, to exercise the client's
+    streaming.
+    """
+
+    def __init__(self, replies):
+        super(FakeLPDServer, self).__init__()
+        self.daemon = True
+        self.replies = list(replies)
+        self.commands = []
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+
+    def run(self):
+        for reply in self.replies:
+            conn, _ = self.sock.accept()
+            f = conn.makefile()
+            self.commands.append(f.readline())
+            f.close()
+            for i in range(0, len(reply), 5):
+                conn.sendall(reply[i:i + 5])
+            conn.close()
+        self.sock.close()
+
+
+class RecordingFile(object):
+    """A file that remembers each write separately."""
+
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(data)
+
+    def flush(self):
+        pass
+
+
+class TestLPDClient(mox.MoxTestBase):
+    def start(self, *replies):
+        server = FakeLPDServer(replies)
+        server.start()
+        return server, lpd.LPDClient('127.0.0.1', server.port, timeout=5)
+
+    def test_short_queue_state(self):
+        """Test requesting the short queue state"""
+        reply = 'ajax is ready\nno entries\n'
+        server, client = self.start(reply)
+        out = StringIO.StringIO()
+
+        self.assertEqual(client.short_queue_state('ajax', out=out),
+                         len(reply))
+        server.join(5)
+
+        self.assertEqual(server.commands, ['\x03ajax\n'])
+        self.assertEqual(out.getvalue(), reply)
+
+    def test_long_queue_state(self):
+        """Test requesting the long queue state for particular jobs"""
+        server, client = self.start('jdreed: 1st [job 123]\n')
+        out = StringIO.StringIO()
+
+        client.long_queue_state('ajax', ['jdreed', '123'], out=out)
+        server.join(5)
+
+        self.assertEqual(server.commands, ['\x04ajax jdreed 123\n'])
+
+    def test_remove_jobs(self):
+        """Test removing jobs"""
+        server, client = self.start('')
+        out = StringIO.StringIO()
+
+        self.assertEqual(client.remove_jobs('ajax', 'jdreed', ['123'], out=out),
+                         0)
+        server.join(5)
+
+        self.assertEqual(server.commands, ['\x05ajax jdreed 123\n'])
+
+    def test_remove_dequeued(self):
+        """Test that a list of dequeued files means success"""
+        reply = ('dfA123ajax.mit.edu dequeued\n'
+                 'Printer ajax@pharos-prodp1:\n'
+                 "  checking perms 'cfA123ajax.mit.edu'\n"
+                 "  dequeued 'cfA123ajax.mit.edu'\n")
+        server, client = self.start(reply)
+        out = StringIO.StringIO()
+
+        client.remove_jobs('ajax', 'jdreed', ['123'], out=out)
+        server.join(5)
+
+        self.assertEqual(out.getvalue(), reply)
+
+    def test_remove_refused(self):
+        """Test that an error reply to a removal raises LPDRefused"""
+        self.mox.StubOutWithMock(os, 'geteuid')
+        os.geteuid().AndReturn(1000)
+        server, client = self.start('Permission denied\n')
+        out = StringIO.StringIO()
+
+        self.mox.ReplayAll()
+
+        try:
+            client.remove_jobs('ajax', 'jdreed', ['123'], out=out)
+        except lpd.LPDRefused, e:
+            self.assertTrue('Permission denied' in str(e))
+            self.assertTrue('reserved port' in str(e))
+        else:
+            self.fail('LPDRefused not raised')
+        server.join(5)
+
+        self.assertEqual(out.getvalue(), 'Permission denied\n')
+
+    def test_streaming(self):
+        """Test that replies are written out as they arrive"""
+        reply = 'x' * 20
+        server, client = self.start(reply)
+        out = RecordingFile()
+
+        client.short_queue_state('ajax', out=out)
+        server.join(5)
+
+        self.assertEqual(''.join(out.writes), reply)
+
+    def test_reuse(self):
+        """Test that one client can query several queues"""
+        server, client = self.start('ajax\n', 'w20\n')
+        out = StringIO.StringIO()
+
+        client.short_queue_state('ajax', out=out)
+        client.short_queue_state('w20', out=out)
+        server.join(5)
+
+        self.assertEqual(server.commands, ['\x03ajax\n', '\x03w20\n'])
+        self.assertEqual(out.getvalue(), 'ajax\nw20\n')
+
+    def test_connection_refused(self):
+        """Test that failing to connect raises LPDError"""
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+
+        client = lpd.LPDClient('127.0.0.1', port, timeout=5)
+        self.assertRaises(lpd.LPDError,
+                          client.short_queue_state, 'ajax',
+                          out=StringIO.StringIO())
+
+
+class TestClientFor(mox.MoxTestBase):
+    def test_shared(self):
+        """Test that client_for returns one client per server"""
+        self.mox.stubs.Set(lpd, '_clients', {})
+        a = lpd.client_for('PHAROS-PRODP1.MIT.EDU')
+        b = lpd.client_for('pharos-prodp1.mit.edu')
+        self.assertTrue(a is b)
+        self.assertFalse(a is lpd.client_for('printers.mit.edu'))
+
+
+if __name__ == '__main__':
+    unittest.main()
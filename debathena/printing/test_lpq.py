@@ -0,0 +1,161 @@
+#!/usr/bin/python
+"""Test suite for debathena.printing.lpq"""
+
+
+import os
+import StringIO
+import threading
+import time
+import unittest
+
+import cups
+import mox
+
+from debathena.printing import common
+from debathena.printing import lpq
+from debathena.printing import test_lpr
+
+
+class TestFormatJobs(mox.MoxTestBase):
+    def test_empty(self):
+        """Test formatting an empty queue"""
+        self.assertEqual(lpq.format_jobs('ajax', {}), 'no entries\n')
+
+    def test_jobs(self):
+        """Test formatting active and pending jobs"""
+        jobs = {
+            12: {'job-originating-user-name': 'jdreed',
+                 'job-name': 'thesis.pdf',
+                 'job-k-octets': 2,
+                 'job-state': 3},
+            11: {'job-originating-user-name': 'quentin',
+                 'job-name': 'puppies.jpg',
+                 'job-k-octets': 1,
+                 'job-state': lpq.IPP_JOB_PROCESSING},
+            }
+        lines = lpq.format_jobs('ajax', jobs).splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[1].split(),
+                         ['active', 'quentin', '11', 'puppies.jpg', '1024', 'bytes'])
+        self.assertEqual(lines[2].split(),
+                         ['1st', 'jdreed', '12', 'thesis.pdf', '2048', 'bytes'])
+
+
+class TestQueryQueue(mox.MoxTestBase):
+    def test_resolution(self):
+        """Test that queues are resolved as the other wrappers do"""
+        self.mox.StubOutWithMock(common, 'Resolution', use_mock_anything=True)
+        self.mox.StubOutWithMock(common, 'is_lpd_server')
+        self.mox.StubOutWithMock(lpq, 'cups_version_is_below_1_4')
+        self.mox.StubOutWithMock(lpq, '_get_jobs')
+        resolution = self.mox.CreateMockAnything()
+        common.Resolution('w20').AndReturn(resolution)
+        # e.g. after failing over to another frontend
+        resolution.find_queue().AndReturn(
+            (common.SYSTEM_CUPS, 'CLUSTER-PRINT.MIT.EDU', 'ajax'))
+        common.is_lpd_server('CLUSTER-PRINT.MIT.EDU').AndReturn(False)
+        lpq.cups_version_is_below_1_4().AndReturn(False)
+        lpq._get_jobs('CLUSTER-PRINT.MIT.EDU', 'ajax').AndReturn({})
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(lpq.query_queue('w20'), 'no entries\n')
+
+
+class TestQueryQueues(mox.MoxTestBase):
+    def setUp(self):
+        super(TestQueryQueues, self).setUp()
+
+        self.delays = {}
+        self.running = []
+        self.overlapped = threading.Event()
+        def query_queue(queue, long_format=False, timeout=None):
+            self.running.append(queue)
+            if len(self.running) > 1:
+                self.overlapped.set()
+            time.sleep(self.delays.get(queue, 0))
+            if queue == 'broken':
+                raise cups.IPPError(1, 'client-error-not-found')
+            self.running.remove(queue)
+            return '%s is ready\n' % queue
+        self.mox.stubs.Set(lpq, 'query_queue', query_queue)
+
+    def test_order(self):
+        """Test that results come out in the order queues were given"""
+        self.delays = {'ajax': 0.2, 'w20': 0.1}
+        out = StringIO.StringIO()
+
+        self.assertEqual(lpq.query_queues(['ajax', 'w20', 'ajax', 'meadow'],
+                                          out=out),
+                         0)
+        self.assertEqual(out.getvalue(),
+                         'ajax:\najax is ready\n\n'
+                         'w20:\nw20 is ready\n\n'
+                         'meadow:\nmeadow is ready\n\n')
+
+    def test_concurrent(self):
+        """Test that queues are queried at the same time"""
+        self.delays = {'ajax': 0.2, 'w20': 0.2, 'meadow': 0.2}
+
+        lpq.query_queues(['ajax', 'w20', 'meadow'], out=StringIO.StringIO())
+
+        self.assertTrue(self.overlapped.isSet())
+
+    def test_deadline(self):
+        """Test that a slow queue doesn't hold up the others"""
+        self.delays = {'slow': 5}
+        out = StringIO.StringIO()
+
+        start = time.time()
+        self.assertEqual(lpq.query_queues(['slow', 'ajax'], deadline=0.2,
+                                          out=out),
+                         1)
+        self.assertTrue(time.time() - start < 2)
+        self.assertTrue('slow:\nTimed out' in out.getvalue())
+        self.assertTrue('ajax:\najax is ready\n' in out.getvalue())
+
+    def test_error(self):
+        """Test that one failing queue is reported with the rest"""
+        out = StringIO.StringIO()
+
+        self.assertEqual(lpq.query_queues(['broken', 'ajax'], out=out), 1)
+        self.assertTrue('broken:\nError:' in out.getvalue())
+        self.assertTrue('ajax:\najax is ready\n' in out.getvalue())
+
+
+class TestLpqAthenaQueue(test_lpr.TestLpr):
+    environ = {}
+
+    def test(self):
+        """Test checking an Athena queue looks it up only once"""
+        common._hesiod_lookup('ajax', 'pcap').AndReturn(['ajax:rp=ajax:rm=GET-PRINT.MIT.EDU:ka#0:mc#0:'])
+        common.get_cups_uri('ajax').AndReturn(None)
+
+        # Result:
+        os.execvp('cups-lpq', ['lpq', '-Pajax', '-a'])
+
+        self.mox.ReplayAll()
+
+        lpq._main(['lpq', '-Pajax', '-a'])
+        self.assertBudget(dns=1, ipp=1, tcp=1)
+
+
+class TestLpqNonexistentQueue(test_lpr.TestLpr):
+    environ = {}
+
+    def test(self):
+        """Test that the nonexistent queue warning reuses the first lookup"""
+        common._hesiod_lookup('stark', 'pcap').AndReturn([])
+        common.get_cups_uri('stark').AndReturn(None)
+
+        # Result:
+        os.execvp('cups-lpq', ['lpq', '-Pstark'])
+
+        self.mox.ReplayAll()
+
+        lpq._main(['lpq', '-Pstark'])
+        self.assertBudget(dns=1, ipp=1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,13 +9,59 @@ any functions or objects which have not been stubbed out by TestLpr.
 
 
 import os
+import socket
+import StringIO
+import subprocess
+import threading
+import time
 import unittest
 
 import cups
 import mox
 
+from debathena.printing import cache
 from debathena.printing import common
 from debathena.printing import lpr
+from debathena.printing import resolver
+
+
+# The kinds of operation TestLpr accounts for, and the stubbed-out
+# functions (or, for the local cupsd, objects) that perform them
+DNS = 'dns'
+IPP = 'ipp'
+TCP = 'tcp'
+SUBPROCESS = 'subprocess'
+RESOLVER = 'resolver'
+
+
+class CountingProxy(object):
+    """Counts the calls made through it to an object's methods."""
+
+    def __init__(self, obj, kind, calls):
+        self._obj = obj
+        self._kind = kind
+        self._calls = calls
+
+    def __getattr__(self, name):
+        return counted(getattr(self._obj, name), self._kind, self._calls)
+
+
+# Lookups can run in several threads at once, but mox can't cope with
+# mocks being called concurrently, so calls across the boundary are
+# made one at a time
+_boundary_lock = threading.Lock()
+
+
+def counted(func, kind, calls):
+    """Wrap func so that each call to it is counted in calls[kind]."""
+    def wrapper(*args, **kwargs):
+        _boundary_lock.acquire()
+        try:
+            calls[kind] = calls.get(kind, 0) + 1
+            return func(*args, **kwargs)
+        finally:
+            _boundary_lock.release()
+    return wrapper
 
 
 class TestLpr(mox.MoxTestBase):
@@ -36,34 +82,128 @@ class TestLpr(mox.MoxTestBase):
       * debathena.printing.common._hesiod_lookup
       * debathena.printing.common.get_cups_uri
       * debathena.printing.common.is_cups_server
+      * debathena.printing.common.probe_cups_servers
       * debathena.printing.common.cupsd
+      * debathena.printing.resolver.query
+      * subprocess.Popen
+      * subprocess.call
       * os.execvp
 
     Additionally, while d.p.common.get_direct_printer is not strictly
     at the boundry of Debathena code and the environment, it has been
     stubbed out to avoid pointless boilerplate.
 
+    The on-disk resolution cache is replaced with one that never
+    remembers anything, so that each test sees a cold cache, and the
+    pcap snapshot is hidden, so that every queue is looked up in
+    Hesiod. Likewise, nothing is known about which print servers are
+    up, so each invocation probes them; the servers in the live
+    attribute of the test class answer (all of them, if it's None).
+    The resolver daemon isn't running, unless the test class's daemon
+    attribute maps queries (tuples of the query's name and arguments)
+    to its answers.
+
     Finally, os.environ and d.p.common.CUPS_BACKENDS are populated by
     the environ and backends (respectively) attributes of the test
     class.
+
+    Calls across the boundary are counted by kind: Hesiod lookups
+    (DNS), requests to cupsd (IPP, including get_cups_uri and
+    get_default_printer), port probes (TCP, one per host probed),
+    queries the resolver daemon answers (RESOLVER) and subprocesses
+    (SUBPROCESS). Counting starts when the test calls ReplayAll, and
+    tests use assertBudget to check that a wrapper invocation stays
+    within a budget for each kind.
+
+    A queue's Hesiod lookup runs alongside the local cupsd lookup, so
+    tests should expect those two in any order. Tests where a lookup
+    is abandoned should call finishThreads before they end.
     """
     environ = {}
     backends = []
+    live = None
+    daemon = None
 
     def setUp(self):
         super(TestLpr, self).setUp()
 
         self.mox.stubs.Set(os, 'environ', self.environ)
         self.mox.stubs.Set(common, 'CUPS_BACKENDS', self.backends)
-        self.mox.stubs.Set(common, 'cupsd', self.mox.CreateMock(cups.Connection))
-        self.mox.stubs.Set(common, '_loaded', True)
-
-        self.mox.StubOutWithMock(common, '_hesiod_lookup')
-        self.mox.StubOutWithMock(common, 'get_cups_uri')
-        self.mox.StubOutWithMock(common, 'is_cups_server')
-        self.mox.StubOutWithMock(common, 'get_default_printer')
+        self.calls = {}
+        self.mox.stubs.Set(common, 'cupsd',
+                           CountingProxy(self.mox.CreateMock(cups.Connection),
+                                         IPP, self.calls))
+        self.mox.stubs.Set(common, '_materialized',
+                           set(['backends', 'cupsd', 'pcap']))
+        self.mox.stubs.Set(common, '_pcap_snapshot', None)
+        self.mox.stubs.Set(common, '_deadline', None)
+        # Nothing is remembered between tests, or read from the real
+        # cache directory
+        for name in ('_resolution_cache', '_liveness_cache',
+                     '_clusterinfo_cache', '_destinations_cache',
+                     '_capability_cache', '_hesiod_cache'):
+            self.mox.stubs.Set(common, name, cache.NullCache())
+        self.mox.stubs.Set(common, '_hesiod_memory',
+                           cache.LRUCache(common.HESIOD_CACHE_SIZE))
+        self.mox.stubs.Set(common, 'probe_cups_servers',
+                           self._probe_cups_servers)
+        self.mox.stubs.Set(resolver, 'query', self._query)
+        self.threads = threading.enumerate()
+
+        for obj, name, kind in [(common, '_hesiod_lookup', DNS),
+                                (common, 'get_cups_uri', IPP),
+                                (common, 'is_cups_server', TCP),
+                                (common, 'get_default_printer', IPP),
+                                (subprocess, 'Popen', SUBPROCESS),
+                                (subprocess, 'call', SUBPROCESS),
+                                ]:
+            self.mox.StubOutWithMock(obj, name, use_mock_anything=True)
+            self.mox.stubs.Set(obj, name,
+                               counted(getattr(obj, name), kind, self.calls))
         self.mox.StubOutWithMock(os, 'execvp')
 
+        # Recording expectations goes through the same counters, so
+        # start counting afresh once the test switches to replay
+        replay = self.mox.ReplayAll
+        def ReplayAll():
+            replay()
+            self.calls.clear()
+        self.mox.ReplayAll = ReplayAll
+
+    def _probe_cups_servers(self, hosts, timeout=common.PROBE_TIMEOUT,
+                            stagger=common.PROBE_STAGGER):
+        found = {}
+        for host in hosts:
+            self.calls[TCP] = self.calls.get(TCP, 0) + 1
+            if self.live is None or host in self.live:
+                found[host] = 0.001
+                break
+            found[host] = None
+        return found
+
+    def _query(self, name, *args, **kwargs):
+        if self.daemon is None:
+            raise resolver.ResolverError('The resolver is not running')
+        self.calls[RESOLVER] = self.calls.get(RESOLVER, 0) + 1
+        return self.daemon[(name,) + args]
+
+    def finishThreads(self):
+        """Wait for threads the test started, while the stubs are in place."""
+        for t in threading.enumerate():
+            if t not in self.threads:
+                t.join(5)
+
+    def assertBudget(self, **budget):
+        """Check that each kind of operation was done at most so many times.
+
+        Kinds that aren't mentioned have a budget of 0.
+        """
+        for kind in (DNS, IPP, TCP, RESOLVER, SUBPROCESS):
+            used = self.calls.get(kind, 0)
+            self.assertTrue(used <= budget.get(kind, 0),
+                            '%d %s operations, budget is %d' %
+                            (used, kind, budget.get(kind, 0)))
+
 
 class TestNonexistentPrinter(TestLpr):
     # LPROPT, PRINTER are unset
@@ -73,13 +213,10 @@ class TestNonexistentPrinter(TestLpr):
         """Test printing to a printer that is not in Hesiod.
 
         Taken from -c debathena, reported by quentin on May 14, 2010."""
-        # We now call common.find_queue twice
-        common._hesiod_lookup('stark', 'pcap').AndReturn([])
-        common.get_cups_uri('stark').AndReturn(None)
-        common.get_default_printer().AndReturn(None)
-        common._hesiod_lookup('stark', 'pcap').AndReturn([])
-        common.get_cups_uri('stark').AndReturn(None)
-        common.get_cups_uri('stark').AndReturn(None)
+        # Each lookup happens exactly once, even though the queue is
+        # needed both for the zephyr decision and for dispatch
+        common._hesiod_lookup('stark', 'pcap').InAnyOrder().AndReturn([])
+        common.get_cups_uri('stark').InAnyOrder().AndReturn(None)
 
         # Result:
         os.execvp('cups-lpr', ['lpr', '-Uquentin', '-Pstark', '-m', 'puppies biting nose.jpg'])
@@ -87,6 +224,7 @@ class TestNonexistentPrinter(TestLpr):
         self.mox.ReplayAll()
 
         lpr._main(['lpr', '-Pstark', 'puppies biting nose.jpg'])
+        self.assertBudget(dns=1, ipp=1)
 
 
 class TestNoLpropt(TestLpr):
@@ -97,14 +235,9 @@ class TestNoLpropt(TestLpr):
         """Test printing with LPROPT unset.
 
         Taken from Trac #509, reported on Mar 12, 2010."""
-        # We now call common.find_queue twice
-        common._hesiod_lookup('ajax', 'pcap').AndReturn(['ajax:rp=ajax:rm=GET-PRINT.MIT.EDU:ka#0:mc#0:'])
-        common.get_default_printer().AndReturn(None)
-        common.get_cups_uri('ajax').AndReturn(None)
-        # We no longer call "is_cups_server"
-        # common.is_cups_server('GET-PRINT.MIT.EDU').AndReturn(True)
-        common._hesiod_lookup('ajax', 'pcap').AndReturn(['ajax:rp=ajax:rm=GET-PRINT.MIT.EDU:ka#0:mc#0:'])
-        common.get_cups_uri('ajax').AndReturn(None)
+        # Each lookup happens exactly once
+        common._hesiod_lookup('ajax', 'pcap').InAnyOrder().AndReturn(['ajax:rp=ajax:rm=GET-PRINT.MIT.EDU:ka#0:mc#0:'])
+        common.get_cups_uri('ajax').InAnyOrder().AndReturn(None)
         # We no longer call "is_cups_server"
         # common.is_cups_server('GET-PRINT.MIT.EDU').AndReturn(True)
 
@@ -114,6 +247,146 @@ class TestNoLpropt(TestLpr):
         self.mox.ReplayAll()
 
         lpr._main(['lpr', '-P', 'ajax'])
+        # A known Athena queue costs one Hesiod lookup, one IPP call
+        # and, since nothing is known about its server, one probe
+        self.assertBudget(dns=1, ipp=1, tcp=1)
+
+
+class TestDefaultQueue(TestLpr):
+    environ = {}
+
+    def test(self):
+        """Test printing to the default queue"""
+        common.get_default_printer().AndReturn('ajax')
+        common._hesiod_lookup('ajax', 'pcap').InAnyOrder().AndReturn(['ajax:rp=ajax:rm=GET-PRINT.MIT.EDU:ka#0:mc#0:'])
+        common.get_cups_uri('ajax').InAnyOrder().AndReturn(None)
+
+        # Result:
+        os.execvp('cups-lpr', ['lpr', '-Pajax', 'thesis.pdf'])
+
+        self.mox.ReplayAll()
+
+        lpr._main(['lpr', 'thesis.pdf'])
+        self.assertBudget(dns=1, ipp=2, tcp=1)
+
+
+class TestDefaultQueueZephyr(TestLpr):
+    environ = {'ATHENA_USER': 'quentin'}
+
+    def test(self):
+        """Test that printing to the default queue still asks for a zephyr"""
+        common.get_default_printer().AndReturn('ajax')
+        common._hesiod_lookup('ajax', 'pcap').InAnyOrder().AndReturn(['ajax:rp=ajax:rm=GET-PRINT.MIT.EDU:ka#0:mc#0:'])
+        common.get_cups_uri('ajax').InAnyOrder().AndReturn(None)
+
+        # Result:
+        os.execvp('cups-lpr', ['lpr', '-Uquentin', '-Pajax', '-m', 'thesis.pdf'])
+
+        self.mox.ReplayAll()
+
+        lpr._main(['lpr', 'thesis.pdf'])
+        self.assertBudget(dns=1, ipp=2, tcp=1)
+
+
+class TestLocalQueue(TestLpr):
+    environ = {}
+
+    def test(self):
+        """Test printing to a local queue that bounces to an Athena queue"""
+        common.get_cups_uri('w20').InAnyOrder().AndReturn('ipp://printers.mit.edu/printers/ajax')
+        common._hesiod_lookup('ajax', 'pcap').InAnyOrder().AndReturn(['ajax:rp=ajax:rm=GET-PRINT.MIT.EDU:ka#0:mc#0:'])
+        # The speculative lookup of w20 is wasted
+        common._hesiod_lookup('w20', 'pcap').InAnyOrder().AndReturn([])
+
+        # Result:
+        os.execvp('cups-lpr', ['lpr', '-Pajax', 'thesis.pdf'])
+
+        self.mox.ReplayAll()
+
+        lpr._main(['lpr', '-Pw20', 'thesis.pdf'])
+        self.finishThreads()
+        self.assertBudget(dns=2, ipp=1, tcp=1)
+
+
+class TestFailover(TestLpr):
+    environ = {}
+    live = ['printers.mit.edu']
+
+    def test(self):
+        """Test that jobs go to a frontend when the queue's server is down"""
+        common._hesiod_lookup('ajax', 'pcap').InAnyOrder().AndReturn(['ajax:rp=ajax:rm=GET-PRINT.MIT.EDU:ka#0:mc#0:'])
+        common.get_cups_uri('ajax').InAnyOrder().AndReturn(None)
+
+        # Result:
+        os.execvp('cups-lpr', ['lpr', '-Pajax', 'thesis.pdf'])
+
+        self.mox.ReplayAll()
+
+        lpr._main(['lpr', '-Pajax', 'thesis.pdf'])
+        self.assertEqual(os.environ['CUPS_SERVER'], 'printers.mit.edu')
+        self.assertBudget(dns=1, ipp=1, tcp=2)
+
+
+class TestDeadline(TestLpr):
+    environ = {common.DEADLINE_ENV: '0.05'}
+
+    def test(self):
+        """Test that a slow lookup is given up on at the deadline"""
+        release = threading.Event()
+        common.get_cups_uri('ajax').InAnyOrder().AndReturn(None)
+        common._hesiod_lookup('ajax', 'pcap').InAnyOrder().WithSideEffects(
+            lambda *args: release.wait(5)).AndReturn(
+            ['ajax:rp=ajax:rm=GET-PRINT.MIT.EDU:ka#0:mc#0:'])
+
+        # Result:
+        os.execvp('cups-lpr', ['lpr', '-Pajax', 'thesis.pdf'])
+
+        self.mox.ReplayAll()
+
+        start = time.time()
+        lpr._main(['lpr', '-Pajax', 'thesis.pdf'])
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(os.environ['CUPS_SERVER'], common.CUPS_FRONTENDS[0])
+
+        # Let the abandoned lookup finish while everything's still
+        # stubbed out
+        release.set()
+        self.finishThreads()
+
+
+class TestResolverDaemon(TestLpr):
+    environ = {}
+    daemon = {
+        ('find_queue', 'w20'): [common.SYSTEM_CUPS, 'GET-PRINT.MIT.EDU',
+                                'ajax', None],
+        }
+
+    def test(self):
+        """Test that the resolver daemon resolves a queue in one round trip"""
+        # Result:
+        os.execvp('cups-lpr', ['lpr', '-Pajax', 'thesis.pdf'])
+
+        self.mox.ReplayAll()
+
+        lpr._main(['lpr', '-Pw20', 'thesis.pdf'])
+        self.assertEqual(os.environ['CUPS_SERVER'], 'GET-PRINT.MIT.EDU')
+        self.assertBudget(resolver=1)
+
+
+class TestBudget(TestLpr):
+    environ = {}
+
+    def test(self):
+        """Test that going over budget is caught"""
+        common._hesiod_lookup('ajax', 'pcap').AndReturn([])
+        common._hesiod_lookup('ajax', 'pcap').AndReturn([])
+
+        self.mox.ReplayAll()
+
+        common._hesiod_lookup('ajax', 'pcap')
+        self.assertBudget(dns=1)
+        common._hesiod_lookup('ajax', 'pcap')
+        self.assertRaises(AssertionError, self.assertBudget, dns=1)
 
 # class TestLPRngQueue(TestLpr):
 #     environ = {'ATHENA_USER': 'jdreed'}
@@ -140,5 +413,120 @@ class TestNoLpropt(TestLpr):
 
 #         lpr._main(['lpr', '-P', 'w20thesis'])
 
+class TestParseManifest(mox.MoxTestBase):
+    def test_parse(self):
+        """Test parsing a batch manifest"""
+        manifest = StringIO.StringIO(
+            '# graded psets\n'
+            '\n'
+            'ajax pset1.pdf\n'
+            'w20 "pset 2.pdf" sides=two-sided-long-edge landscape\n'
+            'meadow\n')
+        entries = lpr.parse_manifest(manifest)
+        self.assertEqual(entries[:2],
+                         [(3, 'ajax', 'pset1.pdf', {}),
+                          (4, 'w20', 'pset 2.pdf',
+                           {'sides': 'two-sided-long-edge',
+                            'landscape': 'true'})])
+        self.assertEqual(entries[2][0], 5)
+        self.assertTrue(isinstance(entries[2][1], lpr.ManifestError))
+
+
+class TestSubmitBatch(mox.MoxTestBase):
+    def setUp(self):
+        super(TestSubmitBatch, self).setUp()
+
+        self.mox.stubs.Set(os, 'environ', {})
+        self.mox.stubs.Set(common, '_connections', common.ConnectionPool())
+        self.conn = self.mox.CreateMock(cups.Connection)
+        self.mox.StubOutWithMock(common, 'Resolution', use_mock_anything=True)
+        self.mox.StubOutWithMock(cups, 'Connection', use_mock_anything=True)
+
+    def expect_resolve(self, queue):
+        resolution = self.mox.CreateMockAnything()
+        common.Resolution(queue).AndReturn(resolution)
+        resolution.find_queue().AndReturn(
+            (common.SYSTEM_CUPS, 'GET-PRINT.MIT.EDU', queue))
+
+    def test_submit(self):
+        """Test that queues are resolved and connected to once"""
+        self.expect_resolve('ajax')
+        cups.Connection(host='GET-PRINT.MIT.EDU').AndReturn(self.conn)
+        self.conn.printFile('ajax', 'a.pdf', 'a.pdf', {}).AndReturn(1)
+        self.conn.printFile('ajax', 'dir/b.pdf', 'b.pdf',
+                            {'copies': '2'}).AndReturn(2)
+
+        self.mox.ReplayAll()
+
+        out = StringIO.StringIO()
+        entries = [(1, 'ajax', 'a.pdf', {}),
+                   (2, 'ajax', 'dir/b.pdf', {'copies': '2'})]
+        self.assertEqual(lpr.submit_batch(entries, workers=1, out=out), 0)
+        self.assertEqual(out.getvalue(),
+                         '1: a.pdf: ajax-1\n2: dir/b.pdf: ajax-2\n')
+
+    def test_failures(self):
+        """Test that failed jobs are reported without stopping the batch"""
+        self.expect_resolve('ajax')
+        cups.Connection(host='GET-PRINT.MIT.EDU').AndReturn(self.conn)
+        self.conn.printFile('ajax', 'missing.pdf', 'missing.pdf', {}).AndRaise(
+            cups.IPPError(1030, 'client-error-not-found'))
+
+        self.mox.ReplayAll()
+
+        out = StringIO.StringIO()
+        entries = [(1, lpr.ManifestError('expected a queue and a file'),
+                    None, None),
+                   (2, 'ajax', 'missing.pdf', {})]
+        self.assertEqual(lpr.submit_batch(entries, out=out), 1)
+        self.assertTrue('1: -: error: expected a queue' in out.getvalue())
+        self.assertTrue('2: missing.pdf: error:' in out.getvalue())
+
+    def test_unexpected_failure(self):
+        """Test that any job's failure is reported against that job"""
+        self.expect_resolve('ajax')
+        cups.Connection(host='GET-PRINT.MIT.EDU').AndReturn(self.conn)
+        self.conn.printFile('ajax', 'secret.pdf', 'secret.pdf', {}).AndRaise(
+            IOError(13, 'Permission denied'))
+        # The connection can't be trusted after an unexpected error
+        cups.Connection(host='GET-PRINT.MIT.EDU').AndReturn(self.conn)
+        self.conn.printFile('ajax', 'a.pdf', 'a.pdf', {}).AndReturn(1)
+
+        self.mox.ReplayAll()
+
+        out = StringIO.StringIO()
+        entries = [(1, 'ajax', 'secret.pdf', {}),
+                   (2, 'ajax', 'a.pdf', {})]
+        self.assertEqual(lpr.submit_batch(entries, workers=1, out=out), 1)
+        self.assertEqual(out.getvalue(),
+                         '1: secret.pdf: error: [Errno 13] Permission denied\n'
+                         '2: a.pdf: ajax-1\n')
+
+    def test_notification(self):
+        """Test that Athena users' jobs ask for a notification, like lpr -m"""
+        os.environ['ATHENA_USER'] = 'quentin'
+        self.mox.StubOutWithMock(cups, 'setUser')
+        self.mox.StubOutWithMock(socket, 'getfqdn')
+        socket.getfqdn().AndReturn('w20-575-1.mit.edu')
+        self.expect_resolve('ajax')
+        # libcups remembers the user per thread, so it has to be set
+        # on the thread that submits the job
+        users = []
+        cups.setUser('quentin').WithSideEffects(
+            lambda user: users.append(threading.currentThread()))
+        cups.Connection(host='GET-PRINT.MIT.EDU').AndReturn(self.conn)
+        self.conn.printFile('ajax', 'a.pdf', 'a.pdf', {
+                'notify-recipient-uri': 'mailto:quentin@w20-575-1.mit.edu',
+                'copies': '2'}).AndReturn(1)
+
+        self.mox.ReplayAll()
+
+        out = StringIO.StringIO()
+        self.assertEqual(lpr.submit_batch([(1, 'ajax', 'a.pdf',
+                                            {'copies': '2'})], out=out), 0)
+        self.assertEqual(len(users), 1)
+        self.assertNotEqual(users[0], threading.currentThread())
+
+
 if __name__ == '__main__':
     unittest.main()
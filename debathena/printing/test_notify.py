@@ -0,0 +1,138 @@
+#!/usr/bin/python
+"""Test suite for debathena.printing.notify"""
+
+
+import threading
+import unittest
+
+import cups
+import mox
+
+from debathena.printing import common
+from debathena.printing import notify
+
+
+class TestWatcher(mox.MoxTestBase):
+    def setUp(self):
+        super(TestWatcher, self).setUp()
+
+        self.mox.StubOutWithMock(common, 'ipp_request')
+        self.mox.StubOutWithMock(common, 'invalidate_queue')
+        self.watcher = notify.Watcher(lease=100)
+
+    def expect_subscribe(self, subscription=7):
+        common.ipp_request(None, 'createSubscription', '/',
+                           events=notify.EVENTS,
+                           lease_duration=100).AndReturn(subscription)
+        common.invalidate_queue()
+
+    def expect_events(self, sequence, events, subscription=7):
+        common.ipp_request(None, 'getNotifications', [subscription],
+                           sequence_numbers=[sequence]).AndReturn(
+            {'notify-get-interval': 60, 'events': events})
+
+    def test_events(self):
+        """Test that only the queues that changed are forgotten"""
+        self.expect_subscribe()
+        self.expect_events(1, [])
+        self.expect_events(1, [
+                {'notify-subscription-id': 7, 'notify-sequence-number': 1,
+                 'notify-subscribed-event': 'printer-modified',
+                 'printer-name': 'w20'},
+                {'notify-subscription-id': 7, 'notify-sequence-number': 2,
+                 'notify-subscribed-event': 'printer-deleted',
+                 'printer-name': 'w20'},
+                {'notify-subscription-id': 7, 'notify-sequence-number': 3,
+                 'notify-subscribed-event': 'printer-added',
+                 'printer-name': 'home'}])
+        common.invalidate_queue('home')
+        common.invalidate_queue('w20')
+        self.expect_events(4, [
+                # Already seen
+                {'notify-subscription-id': 7, 'notify-sequence-number': 3,
+                 'printer-name': 'home'}])
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(self.watcher.poll(now=0), [])
+        self.assertEqual(self.watcher.poll(now=1), ['home', 'w20'])
+        self.assertEqual(self.watcher.poll(now=2), [])
+
+    def test_unnamed(self):
+        """Test that an event without a queue name forgets everything"""
+        self.expect_subscribe()
+        self.expect_events(1, [{'notify-sequence-number': 1}])
+        common.invalidate_queue()
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(self.watcher.poll(now=0), [])
+
+    def test_renew(self):
+        """Test that the subscription is renewed half way through its lease"""
+        self.expect_subscribe()
+        self.expect_events(1, [])
+        common.ipp_request(None, 'renewSubscription', 7, lease_duration=100)
+        self.expect_events(1, [])
+        self.expect_events(1, [])
+
+        self.mox.ReplayAll()
+
+        self.watcher.poll(now=0)
+        self.watcher.poll(now=50)
+        self.watcher.poll(now=60)
+
+    def test_resubscribe(self):
+        """Test that a lost subscription is replaced"""
+        self.expect_subscribe()
+        self.expect_events(1, [{'notify-subscription-id': 7,
+                                'notify-sequence-number': 1,
+                                'printer-name': 'w20'}])
+        common.invalidate_queue('w20')
+        common.ipp_request(None, 'getNotifications', [7],
+                           sequence_numbers=[2]).AndRaise(
+            cups.IPPError(1030, 'client-error-not-found'))
+        self.expect_subscribe(8)
+        self.expect_events(1, [], subscription=8)
+
+        self.mox.ReplayAll()
+
+        self.watcher.poll(now=0)
+        self.assertRaises(cups.IPPError, self.watcher.poll, now=1)
+        self.assertEqual(self.watcher.subscription, None)
+        self.watcher.poll(now=2)
+
+    def test_cancel(self):
+        """Test cancelling the subscription"""
+        self.expect_subscribe()
+        self.expect_events(1, [])
+        common.ipp_request(None, 'cancelSubscription', 7).AndRaise(
+            RuntimeError('failed to connect to server'))
+
+        self.mox.ReplayAll()
+
+        self.watcher.cancel()
+        self.watcher.poll(now=0)
+        self.watcher.cancel()
+        self.assertEqual(self.watcher.subscription, None)
+
+    def test_thread(self):
+        """Test polling in a background thread until stopped"""
+        self.watcher.interval = 0.01
+        self.mox.StubOutWithMock(self.watcher, 'poll')
+        self.mox.StubOutWithMock(self.watcher, 'cancel')
+        self.watcher.poll().AndRaise(RuntimeError('failed to connect to server'))
+        polled = threading.Event()
+        self.watcher.poll().WithSideEffects(polled.set).MultipleTimes()
+        self.watcher.cancel()
+
+        self.mox.ReplayAll()
+
+        self.watcher.start()
+        polled.wait(5)
+        self.watcher.stop(5)
+        self.assertEqual(self.watcher._thread, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
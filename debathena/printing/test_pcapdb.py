@@ -0,0 +1,94 @@
+#!/usr/bin/python
+"""Test suite for debathena.printing.pcapdb"""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import hesiod
+import mox
+
+from debathena.printing import pcapdb
+
+
+class TestSnapshot(mox.MoxTestBase):
+    def setUp(self):
+        super(TestSnapshot, self).setUp()
+
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'pcap.db')
+
+    def tearDown(self):
+        super(TestSnapshot, self).tearDown()
+        shutil.rmtree(self.dir)
+
+    def test_lookup(self):
+        """Test looking up queues in a snapshot"""
+        records = dict(('q%03d' % i, 'q%03d:rp=q%03d:rm=GET-PRINT.MIT.EDU:' %
+                        (i, i))
+                       for i in range(100))
+        pcapdb.write(self.path, records)
+        snapshot = pcapdb.Snapshot(self.path)
+
+        self.assertEqual(snapshot.count, 100)
+        for queue, record in records.items():
+            self.assertEqual(snapshot.get(queue), record)
+        self.assertEqual(snapshot.get('Q042'), records['q042'])
+        self.assertEqual(snapshot.get('q1000'), None)
+        self.assertEqual(snapshot.get(''), None)
+        self.assertEqual(snapshot.items(), sorted(records.items()))
+
+    def test_empty(self):
+        """Test a snapshot with no records"""
+        pcapdb.write(self.path, {})
+        self.assertEqual(pcapdb.Snapshot(self.path).get('ajax'), None)
+
+    def test_expiry(self):
+        """Test that snapshots expire after their TTL"""
+        pcapdb.write(self.path, {'ajax': 'ajax:rm=GET-PRINT.MIT.EDU:'},
+                     ttl=60, now=1000)
+        snapshot = pcapdb.Snapshot(self.path)
+        self.assertFalse(snapshot.expired(now=1059))
+        self.assertTrue(snapshot.expired(now=1060))
+
+    def test_corrupt(self):
+        """Test that a missing or corrupt snapshot isn't used"""
+        self.assertEqual(pcapdb.open_snapshot(self.path), None)
+
+        f = open(self.path, 'w')
+        f.write('ajax:rp=ajax:rm=GET-PRINT.MIT.EDU:ka#0:mc#0:\n')
+        f.close()
+        self.assertEqual(pcapdb.open_snapshot(self.path), None)
+
+        pcapdb.write(self.path, {'ajax': 'ajax:rm=GET-PRINT.MIT.EDU:'})
+        f = open(self.path, 'r+')
+        f.truncate(pcapdb.HEADER.size + 1)
+        f.close()
+        self.assertEqual(pcapdb.open_snapshot(self.path), None)
+
+    def test_disabled(self):
+        """Test that an empty DEBATHENA_PCAP_SNAPSHOT disables the snapshot"""
+        self.mox.stubs.Set(os, 'environ', {pcapdb.SNAPSHOT_ENV: ''})
+        self.assertEqual(pcapdb.snapshot_path(), None)
+        self.assertEqual(pcapdb.open_snapshot(), None)
+
+
+class TestFetch(mox.MoxTestBase):
+    def test_fetch(self):
+        """Test fetching pcap records from Hesiod"""
+        self.mox.StubOutWithMock(hesiod, 'Lookup', use_mock_anything=True)
+        result = self.mox.CreateMockAnything()
+        result.results = ['ajax:rp=ajax:rm=GET-PRINT.MIT.EDU:ka#0:mc#0:']
+        hesiod.Lookup('ajax', 'pcap').AndReturn(result)
+        hesiod.Lookup('stark', 'pcap').AndRaise(IOError(2, 'No such file'))
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(pcapdb.fetch(['ajax', 'stark']),
+                         {'ajax': 'ajax:rp=ajax:rm=GET-PRINT.MIT.EDU:ka#0:mc#0:'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+#!/usr/bin/python
+"""Test suite for debathena.printing.ppdcache"""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import cups
+import mox
+
+from debathena.printing import ppdcache
+
+
+class TestPPDCache(mox.MoxTestBase):
+    def setUp(self):
+        super(TestPPDCache, self).setUp()
+
+        self.dir = tempfile.mkdtemp()
+        self.ppds = ppdcache.PPDCache(os.path.join(self.dir, 'cache'))
+        self.conn = self.mox.CreateMockAnything()
+
+    def tearDown(self):
+        super(TestPPDCache, self).tearDown()
+        shutil.rmtree(self.dir)
+
+    def download(self, contents):
+        fd, path = tempfile.mkstemp(dir=self.dir)
+        os.write(fd, contents)
+        os.close(fd)
+        return path
+
+    def read(self, path):
+        f = open(path)
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def test_download(self):
+        """Test that a downloaded PPD is kept and later revalidated"""
+        self.conn.getPPD3('ajax').AndReturn(
+            (cups.HTTP_OK, 1234, self.download('*PPD-Adobe: "4.3"\n')))
+        self.conn.getPPD3('ajax', modtime=1234).AndReturn(
+            (cups.HTTP_NOT_MODIFIED, 1234, ''))
+
+        self.mox.ReplayAll()
+
+        first = self.ppds.get(self.conn, 'ajax', 'HP LaserJet 9050')
+        self.assertEqual(self.read(first), '*PPD-Adobe: "4.3"\n')
+        self.assertEqual(self.ppds.get(self.conn, 'ajax', 'HP LaserJet 9050'),
+                         first)
+
+    def test_changed_model(self):
+        """Test that a PPD isn't revalidated if the model has changed"""
+        self.conn.getPPD3('ajax').AndReturn(
+            (cups.HTTP_OK, 1234, self.download('old\n')))
+        self.conn.getPPD3('ajax').AndReturn(
+            (cups.HTTP_OK, 5678, self.download('new\n')))
+
+        self.mox.ReplayAll()
+
+        self.ppds.get(self.conn, 'ajax', 'HP LaserJet 9050')
+        path = self.ppds.get(self.conn, 'ajax', 'HP LaserJet P4015')
+        self.assertEqual(self.read(path), 'new\n')
+
+    def test_tampered(self):
+        """Test that a cached PPD that's been changed isn't used"""
+        self.conn.getPPD3('ajax').AndReturn(
+            (cups.HTTP_OK, 1234, self.download('ajax\n')))
+        self.conn.getPPD3('ajax').AndReturn(
+            (cups.HTTP_OK, 1234, self.download('ajax\n')))
+
+        self.mox.ReplayAll()
+
+        path = self.ppds.get(self.conn, 'ajax', 'HP LaserJet 9050')
+        f = open(path, 'w')
+        f.write('*cupsFilter: "application/vnd.cups-postscript 0 evil"\n')
+        f.close()
+        self.assertEqual(self.ppds.get(self.conn, 'ajax', 'HP LaserJet 9050'),
+                         path)
+        self.assertEqual(self.read(path), 'ajax\n')
+
+    def test_dedupe(self):
+        """Test that identical PPDs are only stored once"""
+        self.conn.getPPD3('ajax').AndReturn(
+            (cups.HTTP_OK, 1234, self.download('same\n')))
+        self.conn.getPPD3('w20').AndReturn(
+            (cups.HTTP_OK, 1234, self.download('same\n')))
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(self.ppds.get(self.conn, 'ajax', 'HP LaserJet 9050'),
+                         self.ppds.get(self.conn, 'w20', 'HP LaserJet 9050'))
+        self.assertEqual(len(os.listdir(self.ppds.objects)), 1)
+
+    def test_unreachable(self):
+        """Test that cached PPDs aren't used without the server"""
+        self.conn.getPPD3('ajax').AndReturn(
+            (cups.HTTP_OK, 1234, self.download('ajax\n')))
+        self.conn.getPPD3('w20').AndRaise(RuntimeError('server unreachable'))
+        self.conn.getPPD3('ajax', modtime=1234).AndRaise(
+            RuntimeError('server unreachable'))
+
+        self.mox.ReplayAll()
+
+        self.ppds.get(self.conn, 'ajax', 'HP LaserJet 9050')
+        # Not even another queue's PPD for the same model
+        self.assertRaises(RuntimeError,
+                          self.ppds.get, self.conn, 'w20', 'HP LaserJet 9050')
+        self.assertRaises(RuntimeError,
+                          self.ppds.get, self.conn, 'ajax', 'HP LaserJet 9050')
+
+    def test_evict(self):
+        """Test that the least recently used PPDs are evicted"""
+        self.ppds.max_bytes = 10
+        self.conn.getPPD3('ajax').AndReturn(
+            (cups.HTTP_OK, 1234, self.download('123456')))
+        self.conn.getPPD3('w20').AndReturn(
+            (cups.HTTP_OK, 1234, self.download('abcdef')))
+
+        self.mox.ReplayAll()
+
+        ajax = self.ppds.get(self.conn, 'ajax', 'HP LaserJet 9050')
+        os.utime(ajax, (0, 0))
+        w20 = self.ppds.get(self.conn, 'w20', 'HP LaserJet P4015')
+        self.assertFalse(os.path.exists(ajax))
+        self.assertTrue(os.path.exists(w20))
+
+
+if __name__ == '__main__':
+    unittest.main()
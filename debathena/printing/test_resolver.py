@@ -0,0 +1,99 @@
+#!/usr/bin/python
+"""Test suite for debathena.printing.resolver"""
+
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import mox
+
+from debathena.printing import resolver
+from debathena.printing import resolverd
+
+
+class TestQuery(mox.MoxTestBase):
+    def setUp(self):
+        super(TestQuery, self).setUp()
+
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'resolver.sock')
+        self.mox.stubs.Set(os, 'environ', {resolver.SOCKET_ENV: self.path})
+        self.mox.stubs.Set(resolver, '_sock', None)
+        self.mox.stubs.Set(resolver, '_file', None)
+        self.mox.stubs.Set(resolver, '_failed_at', None)
+        self.release = threading.Event()
+        self.mox.stubs.Set(resolverd, 'QUERIES', {
+                'echo': lambda *args: list(args),
+                'fail': self.fail_query,
+                'slow': lambda: self.release.wait(5),
+                })
+        self.server = None
+        self.threads = threading.enumerate()
+
+    def tearDown(self):
+        self.release.set()
+        resolver._disconnect()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        # Don't leave handlers running into interpreter shutdown
+        for t in threading.enumerate():
+            if t not in self.threads:
+                t.join(5)
+        super(TestQuery, self).tearDown()
+        shutil.rmtree(self.dir)
+
+    def fail_query(self):
+        raise RuntimeError('failed to connect to server')
+
+    def serve(self):
+        self.server = resolverd.Server(resolverd.listen(self.path))
+        t = threading.Thread(target=self.server.serve_forever, args=(0.01,))
+        t.setDaemon(True)
+        t.start()
+
+    def test_query(self):
+        """Test several queries over one connection"""
+        self.serve()
+        self.assertEqual(resolver.query('echo', 'w20', None), ['w20', None])
+        sock = resolver._sock
+        self.assertEqual(resolver.query('echo', u'ajax'), ['ajax'])
+        self.assertTrue(isinstance(resolver.query('echo', u'ajax')[0], str))
+        self.assertTrue(resolver._sock is sock)
+
+    def test_failed_query(self):
+        """Test that a query the daemon can't answer is an error"""
+        self.serve()
+        self.assertRaises(resolver.ResolverError, resolver.query, 'fail')
+        self.assertRaises(resolver.ResolverError, resolver.query, 'bogus')
+        self.assertEqual(resolver.query('echo'), [])
+
+    def test_not_running(self):
+        """Test that a missing daemon isn't asked again for a while"""
+        self.assertRaises(resolver.ResolverError, resolver.query, 'echo')
+        self.serve()
+        self.assertRaises(resolver.ResolverError, resolver.query, 'echo')
+        resolver._failed_at -= resolver.RETRY_AFTER
+        self.assertEqual(resolver.query('echo'), [])
+
+    def test_timeout(self):
+        """Test that a slow daemon is given up on"""
+        self.serve()
+        self.assertRaises(resolver.ResolverError,
+                          resolver.query, 'slow', timeout=0.01)
+        self.assertEqual(resolver._sock, None)
+
+    def test_disabled(self):
+        """Test that the daemon can be turned off"""
+        os.environ[resolver.SOCKET_ENV] = ''
+        self.assertEqual(resolver.socket_path(), None)
+        self.assertRaises(resolver.ResolverError, resolver.query, 'echo')
+        del os.environ[resolver.SOCKET_ENV]
+        self.assertEqual(resolver.socket_path(), resolver.SOCKET_PATH)
+
+
+if __name__ == '__main__':
+    unittest.main()
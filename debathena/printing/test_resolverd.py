@@ -0,0 +1,99 @@
+#!/usr/bin/python
+"""Test suite for debathena.printing.resolverd"""
+
+
+import json
+import os
+import shutil
+import socket
+import stat
+import tempfile
+import unittest
+
+import mox
+
+from debathena.printing import common
+from debathena.printing import resolverd
+
+
+class TestAnswer(mox.MoxTestBase):
+    def setUp(self):
+        super(TestAnswer, self).setUp()
+
+        self.mox.StubOutWithMock(common, 'Resolution', use_mock_anything=True)
+        self.mox.StubOutWithMock(common, 'get_cups_uri')
+        self.mox.stubs.Set(resolverd, 'QUERIES', dict(resolverd.QUERIES))
+        resolverd.QUERIES['get_cups_uri'] = common.get_cups_uri
+
+    def test_find_queue(self):
+        """Test that find_queue answers with the queue's URI"""
+        resolution = self.mox.CreateMockAnything()
+        common.Resolution('w20').AndReturn(resolution)
+        resolution.find_queue().AndReturn(
+            (common.SYSTEM_CUPS, 'GET-PRINT.MIT.EDU', 'ajax'))
+        resolution.uri = None
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(json.loads(resolverd.answer('["find_queue", "w20"]\n')),
+                         [True, [common.SYSTEM_CUPS, 'GET-PRINT.MIT.EDU',
+                                 'ajax', None]])
+
+    def test_cups_uri(self):
+        """Test a query answered with a plain value"""
+        common.get_cups_uri('w20').AndReturn('ipp://printers.mit.edu/printers/ajax')
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(resolverd.answer('["get_cups_uri", "w20"]'),
+                         '[true, "ipp://printers.mit.edu/printers/ajax"]')
+
+    def test_errors(self):
+        """Test that bad requests and failed queries are answered"""
+        common.get_cups_uri('w20').AndRaise(RuntimeError('no cupsd'))
+
+        self.mox.ReplayAll()
+
+        for line in ('{not json', '[]', '{}', '["rm", "-rf"]',
+                     '["get_default_printer"]'):
+            self.assertEqual(json.loads(resolverd.answer(line)),
+                             [False, 'Bad request'])
+        self.assertEqual(json.loads(resolverd.answer('["get_cups_uri", "w20"]')),
+                         [False, 'RuntimeError: no cupsd'])
+
+
+class TestSockets(mox.MoxTestBase):
+    def setUp(self):
+        super(TestSockets, self).setUp()
+
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super(TestSockets, self).tearDown()
+        shutil.rmtree(self.dir)
+
+    def test_listen(self):
+        """Test that a leftover socket is replaced"""
+        path = os.path.join(self.dir, 'run', 'resolver.sock')
+        resolverd.listen(path).close()
+        sock = resolverd.listen(path)
+        try:
+            self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0666)
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.connect(path)
+            client.close()
+        finally:
+            sock.close()
+
+    def test_not_activated(self):
+        """Test that sockets meant for another process are ignored"""
+        self.mox.stubs.Set(os, 'environ', {'LISTEN_PID': '1',
+                                           'LISTEN_FDS': '1'})
+        self.assertEqual(resolverd.activated_socket(), None)
+        os.environ['LISTEN_PID'] = str(os.getpid())
+        os.environ['LISTEN_FDS'] = '0'
+        self.assertEqual(resolverd.activated_socket(), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+#!/usr/bin/python
+"""Test suite for debathena.printing.simple
+
+These are end-to-end tests of the lp and lprm wrappers, with the same
+restrictions on stubbing as the tests in test_lpr.
+"""
+
+
+import os
+import unittest
+
+import mox
+
+from debathena.printing import common
+from debathena.printing import lp
+from debathena.printing import lpd
+from debathena.printing import lprm
+from debathena.printing import test_lpr
+
+
+class TestLpAthenaQueue(test_lpr.TestLpr):
+    environ = {}
+
+    def test(self):
+        """Test printing to an Athena queue with lp"""
+        common._hesiod_lookup('ajax', 'pcap').AndReturn(['ajax:rp=ajax:rm=GET-PRINT.MIT.EDU:ka#0:mc#0:'])
+        common.get_cups_uri('ajax').AndReturn(None)
+
+        # Result:
+        os.execvp('cups-lp', ['lp', '-dajax', 'thesis.pdf'])
+
+        self.mox.ReplayAll()
+
+        lp._main(['lp', '-d', 'ajax', 'thesis.pdf'])
+        self.assertEqual(os.environ['CUPS_SERVER'], 'GET-PRINT.MIT.EDU')
+        self.assertBudget(dns=1, ipp=1, tcp=1)
+
+
+class TestLprmDefaultQueue(test_lpr.TestLpr):
+    environ = {}
+
+    def test(self):
+        """Test removing a job from the default queue"""
+        common._hesiod_lookup('ajax', 'pcap').AndReturn(['ajax:rp=ajax:rm=GET-PRINT.MIT.EDU:ka#0:mc#0:'])
+        common.get_default_printer().AndReturn('ajax')
+        common.get_cups_uri('ajax').AndReturn(None)
+
+        # Result:
+        os.execvp('cups-lprm', ['lprm', '-Pajax', '123'])
+
+        self.mox.ReplayAll()
+
+        lprm._main(['lprm', '123'])
+        self.assertBudget(dns=1, ipp=2, tcp=1)
+
+
+
+class TestLprmRefused(test_lpr.TestLpr):
+    environ = {'ATHENA_USER': 'quentin'}
+
+    def test(self):
+        """Test that lprm fails when an LPD server refuses the removal"""
+        common._hesiod_lookup('mitprint', 'pcap').AndReturn(['mitprint:rp=mitprint:rm=PHAROS-PRODP1.MIT.EDU:ka#0:mc#0:'])
+        common.get_cups_uri('mitprint').AndReturn(None)
+        client = self.mox.CreateMock(lpd.LPDClient)
+        self.mox.StubOutWithMock(lpd, 'client_for')
+        lpd.client_for('PHAROS-PRODP1.MIT.EDU',
+                       timeout=mox.IsA(float)).AndReturn(client)
+        client.remove_jobs('mitprint', 'quentin', ['123']).AndRaise(
+            lpd.LPDRefused('PHAROS-PRODP1.MIT.EDU refused to remove the '
+                           'jobs: Permission denied'))
+        self.mox.StubOutWithMock(common, 'error')
+        common.error(1, mox.StrContains('Permission denied')).AndRaise(
+            SystemExit(1))
+
+        self.mox.ReplayAll()
+
+        self.assertRaises(SystemExit, lprm._main, ['lprm', '-Pmitprint', '123'])
+
+if __name__ == '__main__':
+    unittest.main()